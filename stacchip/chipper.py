@@ -1,11 +1,20 @@
+import asyncio
 import math
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 from urllib.parse import urlparse
 
-import rasterio
+import numpy as np
 from numpy.typing import ArrayLike
+from pystac import Item
 from rasterio.enums import Resampling
+from rasterio.io import DatasetReader
+from rasterio.vrt import WarpedVRT
 from rasterio.windows import Window
 
 from stacchip.indexer import ChipIndexer
@@ -22,6 +31,7 @@ class Chipper:
         mountpath: Optional[str] = None,
         assets: Optional[List[str]] = None,
         asset_blacklist: Optional[List[str]] = None,
+        keep_open: bool = False,
     ) -> None:
         """
         Initializes the Chipper class.
@@ -34,12 +44,18 @@ class Chipper:
                 If not provided, all assets are processed. Defaults to None.
             asset_blacklist (Optional[List[str]]): List of asset names to exclude from
                 processing. Defaults to None.
+            keep_open (bool): Keep the asset datasets open between chips, so that
+                headers are only read once when retrieving multiple chips. The
+                datasets are released with ``close``. Defaults to False.
 
         """
         self.mountpath = None if mountpath is None else Path(mountpath)
         self.assets = assets
         self.asset_blacklist = asset_blacklist
         self.indexer = indexer
+        self.keep_open = keep_open
+        self._datasets: Dict[str, Union[DatasetReader, WarpedVRT]] = {}
+        self._exit_stack = ExitStack()
 
     def __len__(self) -> int:
         """
@@ -76,6 +92,103 @@ class Chipper:
             yield self[counter]
             counter += 1
 
+    def __enter__(self) -> "Chipper":
+        """
+        Enters the context manager.
+        """
+        return self
+
+    def __exit__(self, *args) -> None:
+        """
+        Closes open datasets when leaving the context manager.
+        """
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes the asset datasets kept open by this chipper.
+        """
+        self._exit_stack.close()
+        self._datasets = {}
+
+    def asset_keys(self) -> List[str]:
+        """
+        Returns the asset keys that will be read for each chip.
+
+        Returns:
+            List[str]: Asset keys after applying the assets filter and blacklist.
+        """
+        if self.assets is not None:
+            keys = self.assets
+        else:
+            keys = list(self.indexer.item.assets.keys())
+
+        if self.asset_blacklist is not None:
+            keys = [key for key in keys if key not in self.asset_blacklist]
+
+        return keys
+
+    def asset_path(self, key: str) -> Union[str, Path]:
+        """
+        Returns the path to open for an asset, patched with the mountpath if set.
+
+        Args:
+            key (str): The asset key.
+
+        Returns:
+            Union[str, Path]: The href or local path of the asset.
+        """
+        srcpath = self.indexer.item.assets[key].href
+        if self.mountpath:
+            url = urlparse(srcpath, allow_fragments=False)
+            srcpath = self.mountpath / Path(url.path.lstrip("/"))
+        return srcpath
+
+    def read_chip(
+        self, src: Union[DatasetReader, WarpedVRT], x: int, y: int
+    ) -> ArrayLike:
+        """
+        Reads the chip pixel values from an open raster dataset.
+
+        Args:
+            src (Union[DatasetReader, WarpedVRT]): Open dataset for the asset.
+            x (int): The x index of the chip.
+            y (int): The y index of the chip.
+
+        Returns:
+            ArrayLike: Array of pixel values for the chip.
+
+        Raises:
+            ValueError: If asset dimensions are not multiples of the highest resolution dimensions.
+        """
+        # Currently assume that different assets may be at different
+        # resolutions, but are aligned and the gsd differs by an integer
+        # multiplier.
+        if self.indexer.shape[0] % src.height:
+            raise ValueError(
+                f"Asset height {src.height} is not a multiple of highest resolution height {self.indexer.shape[0]}"  # noqa: E501
+            )
+
+        if self.indexer.shape[1] % src.width:
+            raise ValueError(
+                f"Asset width {src.width} is not a multiple of highest resolution width {self.indexer.shape[1]}"  # noqa: E501
+            )
+
+        factor = self.indexer.shape[0] / src.height
+
+        chip_window = Window(
+            math.floor(x * self.indexer.chip_size / factor),
+            math.floor(y * self.indexer.chip_size / factor),
+            math.ceil(self.indexer.chip_size / factor),
+            math.ceil(self.indexer.chip_size / factor),
+        )
+
+        return src.read(
+            window=chip_window,
+            out_shape=(src.count, self.indexer.chip_size, self.indexer.chip_size),
+            resampling=Resampling.nearest,
+        )
+
     def get_pixels_for_asset(self, key: str, x: int, y: int) -> ArrayLike:
         """
         Extracts chip pixel values for one asset.
@@ -87,47 +200,160 @@ class Chipper:
 
         Returns:
             ArrayLike: Array of pixel values for the specified asset.
+        """
+        if not self.keep_open:
+            with self.indexer.open_asset(self.asset_path(key)) as src:
+                return self.read_chip(src, x, y)
 
-        Raises:
-            ValueError: If asset dimensions are not multiples of the highest resolution dimensions.
+        if key not in self._datasets:
+            self._datasets[key] = self._exit_stack.enter_context(
+                self.indexer.open_asset(self.asset_path(key))
+            )
+        return self.read_chip(self._datasets[key], x, y)
+
+    def chip(self, x: int, y: int) -> dict:
         """
-        asset = self.indexer.item.assets[key]
+        Retrieves chip pixel array for the specified x and y index numbers.
 
-        srcpath = asset.href
-        if self.mountpath:
-            url = urlparse(srcpath, allow_fragments=False)
-            srcpath = self.mountpath / Path(url.path.lstrip("/"))
+        Args:
+            x (int): The x index of the chip.
+            y (int): The y index of the chip.
 
-        with rasterio.open(srcpath) as src:
-            # Currently assume that different assets may be at different
-            # resolutions, but are aligned and the gsd differs by an integer
-            # multiplier.
-            if self.indexer.shape[0] % src.height:
-                raise ValueError(
-                    f"Asset height {src.height} is not a multiple of highest resolution height {self.indexer.shape[0]}"  # noqa: E501
-                )
+        Returns:
+            dict: A dictionary where keys are asset names and values are arrays of pixel values.
+        """
+        return {key: self.get_pixels_for_asset(key, x, y) for key in self.asset_keys()}
 
-            if self.indexer.shape[1] % src.width:
-                raise ValueError(
-                    f"Asset width {src.width} is not a multiple of highest resolution width {self.indexer.shape[1]}"  # noqa: E501
-                )
 
-            factor = self.indexer.shape[0] / src.height
+class AsyncChipper(Chipper):
+    """
+    Chipper that retrieves chips concurrently on an asyncio event loop.
+
+    Every asset of every requested chip is scheduled as a separate read task.
+    GDAL performs the range requests and the decoding in a single blocking
+    call, so each read occupies a thread of a dedicated pool while it is in
+    flight. The number of concurrent reads is therefore
+    ``min(max_concurrency, max_workers)``, and the pool is sized to
+    ``max_concurrency`` unless ``max_workers`` is set.
+
+    GDAL datasets are not thread safe, so with ``keep_open`` every thread of
+    the pool keeps its own datasets open between reads. They are released
+    with ``close``.
+    """
+
+    def __init__(
+        self,
+        indexer: ChipIndexer,
+        mountpath: Optional[str] = None,
+        assets: Optional[List[str]] = None,
+        asset_blacklist: Optional[List[str]] = None,
+        max_concurrency: int = 64,
+        max_workers: Optional[int] = None,
+        keep_open: bool = True,
+    ) -> None:
+        """
+        Initializes the AsyncChipper class.
+
+        Args:
+            indexer (Type[ChipIndexer]): Input data which has to be of type ChipIndexer.
+            mountpath (Optional[str]): Path to the mount directory for raster indexer.
+                Defaults to None.
+            assets (Optional[List[str]]): List of asset names to include for processing.
+                If not provided, all assets are processed. Defaults to None.
+            asset_blacklist (Optional[List[str]]): List of asset names to exclude from
+                processing. Defaults to None.
+            max_concurrency (int): Maximum number of asset reads in flight at the
+                same time. Defaults to 64.
+            max_workers (Optional[int]): Number of threads reading and decoding
+                pixels. Reads beyond the number of threads wait for a free
+                thread. Defaults to ``max_concurrency``.
+            keep_open (bool): Keep the asset datasets open between reads, one
+                set of datasets per thread. Defaults to True.
+        """
+        super().__init__(
+            indexer,
+            mountpath=mountpath,
+            assets=assets,
+            asset_blacklist=asset_blacklist,
+            keep_open=keep_open,
+        )
+        self.max_concurrency = max_concurrency
+        self.max_workers = max_workers or max_concurrency
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._semaphores: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
 
-            chip_window = Window(
-                math.floor(x * self.indexer.chip_size / factor),
-                math.floor(y * self.indexer.chip_size / factor),
-                math.ceil(self.indexer.chip_size / factor),
-                math.ceil(self.indexer.chip_size / factor),
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        Thread pool used for reading and decoding pixels.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="stacchip"
             )
+        return self._executor
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        """
+        Concurrency limit for the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            # Semaphores keep a reference to their loop once they are awaited,
+            # so the entries of closed loops are also removed explicitly
+            for closed in [key for key in self._semaphores if key.is_closed()]:
+                del self._semaphores[closed]
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    def get_pixels_for_asset(self, key: str, x: int, y: int) -> ArrayLike:
+        """
+        Extracts chip pixel values for one asset using the datasets of the thread.
+
+        Args:
+            key (str): The asset key to extract pixels from.
+            x (int): The x index of the chip.
+            y (int): The y index of the chip.
+
+        Returns:
+            ArrayLike: Array of pixel values for the specified asset.
+        """
+        if not self.keep_open:
+            return super().get_pixels_for_asset(key, x, y)
+
+        if not hasattr(self._local, "datasets"):
+            self._local.datasets = {}
+        datasets = self._local.datasets
+        if key not in datasets:
+            context = self.indexer.open_asset(self.asset_path(key))
+            # The exit stack is shared by all threads and closed with the chipper
+            with self._lock:
+                datasets[key] = self._exit_stack.enter_context(context)
+        return self.read_chip(datasets[key], x, y)
+
+    async def aget_pixels_for_asset(self, key: str, x: int, y: int) -> ArrayLike:
+        """
+        Extracts chip pixel values for one asset without blocking the event loop.
 
-            return src.read(
-                window=chip_window,
-                out_shape=(src.count, self.indexer.chip_size, self.indexer.chip_size),
-                resampling=Resampling.nearest,
+        Args:
+            key (str): The asset key to extract pixels from.
+            x (int): The x index of the chip.
+            y (int): The y index of the chip.
+
+        Returns:
+            ArrayLike: Array of pixel values for the specified asset.
+        """
+        async with self._semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, self.get_pixels_for_asset, key, x, y
             )
 
-    def chip(self, x: int, y: int) -> dict:
+    async def achip(self, x: int, y: int) -> dict:
         """
         Retrieves chip pixel array for the specified x and y index numbers.
 
@@ -138,12 +364,244 @@ class Chipper:
         Returns:
             dict: A dictionary where keys are asset names and values are arrays of pixel values.
         """
-        if self.assets is not None:
-            keys = self.assets
-        else:
-            keys = list(self.indexer.item.assets.keys())
+        keys = self.asset_keys()
+        pixels = await asyncio.gather(
+            *[self.aget_pixels_for_asset(key, x, y) for key in keys]
+        )
+        return dict(zip(keys, pixels))
 
-        if self.asset_blacklist is not None:
-            keys = [key for key in keys if key not in self.asset_blacklist]
+    async def achips(self, indices: Iterable[Tuple[int, int]]) -> List[dict]:
+        """
+        Retrieves multiple chips concurrently.
+
+        Args:
+            indices (Iterable[Tuple[int, int]]): The x and y index of each chip.
+
+        Returns:
+            List[dict]: One dictionary of asset pixel arrays per chip, in the
+                order of the input indices.
+        """
+        return await asyncio.gather(*[self.achip(x, y) for x, y in indices])
+
+    def close(self) -> None:
+        """
+        Shuts down the thread pool and closes the datasets kept open.
+        """
+        # Wait for running reads before closing the datasets they use
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        super().close()
+        self._local = threading.local()
+        self._semaphores.clear()
+
+    async def __aenter__(self) -> "AsyncChipper":
+        """
+        Enters the async context manager.
+        """
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        """
+        Shuts down the thread pool when leaving the async context manager.
+        """
+        self.close()
+
+
+class TimeSeriesChipper:
+    """
+    Chipper for time series of co-registered STAC items.
+
+    All items have to share the same pixel grid, such as the scenes of a
+    single MGRS or MODIS tile. Chips are returned as arrays with the shape
+    ``(time, bands, chip_size, chip_size)``, sorted by item datetime, or by
+    start datetime for items that cover a date range. The asset datasets
+    are kept open across chip locations, and all timestamps are read
+    concurrently.
+    """
+
+    def __init__(
+        self,
+        indexers: List[ChipIndexer],
+        mountpath: Optional[str] = None,
+        assets: Optional[List[str]] = None,
+        asset_blacklist: Optional[List[str]] = None,
+        max_workers: Optional[int] = None,
+    ) -> None:
+        """
+        Initializes the TimeSeriesChipper class.
+
+        Args:
+            indexers (List[ChipIndexer]): One indexer per timestamp. All indexers
+                must have the same shape, transform, crs and chip size.
+            mountpath (Optional[str]): Path to the mount directory for raster indexer.
+                Defaults to None.
+            assets (Optional[List[str]]): List of asset names to include for processing.
+                Defines the band order of the output. If not provided, the assets of
+                the first item are used. Defaults to None.
+            asset_blacklist (Optional[List[str]]): List of asset names to exclude from
+                processing. Defaults to None.
+            max_workers (Optional[int]): Number of threads reading timestamps
+                concurrently. Defaults to the number of indexers.
+
+        Raises:
+            ValueError: If no indexers are provided, the indexers are not on
+                the same pixel grid, or an item is missing one of the assets.
+        """
+        if not indexers:
+            raise ValueError("At least one indexer is required")
+
+        reference = indexers[0]
+        for indexer in indexers[1:]:
+            if (
+                list(indexer.shape) != list(reference.shape)
+                or list(indexer.transform) != list(reference.transform)
+                or indexer.crs != reference.crs
+                or indexer.chip_size != reference.chip_size
+            ):
+                raise ValueError(
+                    f"Item {indexer.item.id} is not on the same grid as item {reference.item.id}"
+                )
+
+        self.indexers = sorted(
+            indexers, key=lambda indexer: self.item_datetime(indexer.item)
+        )
+        self.max_workers = max_workers or len(self.indexers)
+
+        keys = Chipper(
+            self.indexers[0], assets=assets, asset_blacklist=asset_blacklist
+        ).asset_keys()
+        for indexer in self.indexers:
+            missing = [key for key in keys if key not in indexer.item.assets]
+            if missing:
+                raise ValueError(
+                    f"Item {indexer.item.id} is missing assets {', '.join(missing)}"
+                )
+        self.chippers = [
+            Chipper(indexer, mountpath=mountpath, assets=keys, keep_open=True)
+            for indexer in self.indexers
+        ]
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @staticmethod
+    def item_datetime(item: Item) -> datetime:
+        """
+        Returns the datetime of an item, or its start datetime for date ranges.
+
+        Args:
+            item (Item): The STAC item.
+
+        Returns:
+            datetime: The datetime used to sort the item along the time axis.
+
+        Raises:
+            ValueError: If the item has neither a datetime nor a start datetime.
+        """
+        value = item.datetime or item.common_metadata.start_datetime
+        if value is None:
+            raise ValueError(f"Item {item.id} has no datetime or start_datetime")
+        return value
+
+    @property
+    def indexer(self) -> ChipIndexer:
+        """
+        The indexer defining the shared pixel grid.
+        """
+        return self.indexers[0]
+
+    @property
+    def datetimes(self) -> list:
+        """
+        Datetimes of the items along the time axis.
+        """
+        return [self.item_datetime(indexer.item) for indexer in self.indexers]
+
+    def __len__(self) -> int:
+        """
+        Returns the number of chip locations available.
+
+        Returns:
+            int: Number of chip locations in the shared grid.
+        """
+        return self.indexer.size
+
+    def __getitem__(self, index: int) -> tuple:
+        """
+        Gets the chip stack by a single index.
+
+        Args:
+            index (int): Index of the chip location to retrieve.
+
+        Returns:
+            tuple: A tuple containing x index, y index, and the chip stack.
+        """
+        y_index = index // self.indexer.x_size
+        x_index = index % self.indexer.x_size
+        return x_index, y_index, self.chip(x_index, y_index)
+
+    def __iter__(self):
+        """
+        Iterates over chip locations.
+
+        Yields:
+            tuple: The next chip stack in the sequence.
+        """
+        counter = 0
+        while counter < self.indexer.size:
+            yield self[counter]
+            counter += 1
+
+    def __enter__(self) -> "TimeSeriesChipper":
+        """
+        Enters the context manager.
+        """
+        return self
+
+    def __exit__(self, *args) -> None:
+        """
+        Closes open datasets when leaving the context manager.
+        """
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes all open datasets and shuts down the thread pool.
+        """
+        for chipper in self.chippers:
+            chipper.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
 
-        return {key: self.get_pixels_for_asset(key, x, y) for key in keys}
+    def _chip_bands(self, chipper: Chipper, x: int, y: int) -> ArrayLike:
+        """
+        Retrieves the chip of one timestamp with all assets stacked as bands.
+        """
+        chip = chipper.chip(x, y)
+        return np.vstack([chip[key] for key in chipper.asset_keys()])
+
+    def chip(self, x: int, y: int) -> ArrayLike:
+        """
+        Retrieves the chip stack for the specified x and y index numbers.
+
+        The datasets of each timestamp are only used by one thread at a time,
+        so a single TimeSeriesChipper should not be shared between threads.
+
+        Args:
+            x (int): The x index of the chip.
+            y (int): The y index of the chip.
+
+        Returns:
+            ArrayLike: Array with shape ``(time, bands, chip_size, chip_size)``.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="stacchip"
+            )
+        return np.stack(
+            list(
+                self._executor.map(
+                    lambda chipper: self._chip_bands(chipper, x, y), self.chippers
+                )
+            )
+        )
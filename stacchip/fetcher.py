@@ -0,0 +1,198 @@
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import pyarrow as pa
+from pyarrow import dataset as da
+
+from stacchip.chipper import Chipper
+from stacchip.indexer import ChipIndexer
+from stacchip.utils import load_indexer_local, load_indexer_s3
+
+ROW_COLUMNS = ["platform", "item_id", "chip_index_x", "chip_index_y"]
+
+
+class ChipFetcher:
+    """
+    Fetches chips for the rows of a stacchip index that span many items.
+
+    Rows are grouped by STAC item, so that each item is loaded only once.
+    Within an item, chips are read row by row in the grid for locality, in
+    batches that reuse the open asset datasets. Batches are fetched
+    concurrently, and the chips are yielded in the order of the input rows
+    through a bounded reordering buffer.
+    """
+
+    def __init__(
+        self,
+        bucket: Optional[str] = None,
+        mountpath: Optional[str] = None,
+        assets: Optional[List[str]] = None,
+        asset_blacklist: Optional[List[str]] = None,
+        max_workers: int = 4,
+        buffer_size: int = 256,
+        batch_size: int = 32,
+    ) -> None:
+        """
+        Initializes the ChipFetcher class.
+
+        Args:
+            bucket (Optional[str]): Bucket to load the STAC items from.
+            mountpath (Optional[str]): Local path to load the STAC items from. The
+                asset links are patched with the mountpath as well. Either the
+                bucket or the mountpath has to be provided.
+            assets (Optional[List[str]]): List of asset names to include for processing.
+                If not provided, all assets are processed. Defaults to None.
+            asset_blacklist (Optional[List[str]]): List of asset names to exclude from
+                processing. Defaults to None.
+            max_workers (int): Number of batches fetched concurrently. Defaults to 4.
+            buffer_size (int): Maximum number of chips that are scheduled ahead
+                of the row that is yielded next. Defaults to 256.
+            batch_size (int): Maximum number of chips read from an item in one
+                task. Items with more rows are split into batches, so at most
+                ``buffer_size + batch_size`` chips are held in memory.
+                Defaults to 32.
+
+        Raises:
+            ValueError: If neither bucket nor mountpath are provided.
+        """
+        if bucket is None and mountpath is None:
+            raise ValueError("Either bucket or mountpath has to be provided")
+
+        self.bucket = bucket
+        self.mountpath = None if mountpath is None else Path(mountpath)
+        self.assets = assets
+        self.asset_blacklist = asset_blacklist
+        self.max_workers = max_workers
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+
+    def load_indexer(self, platform: str, item_id: str) -> ChipIndexer:
+        """
+        Loads the indexer for a STAC item.
+
+        Args:
+            platform (str): The platform of the item.
+            item_id (str): The id of the item.
+
+        Returns:
+            ChipIndexer: The indexer for the item.
+        """
+        if self.mountpath is not None:
+            return load_indexer_local(self.mountpath, platform, item_id)
+        return load_indexer_s3(str(self.bucket), platform, item_id)
+
+    def fetch_item(
+        self,
+        platform: str,
+        item_id: str,
+        chips: List[Tuple[int, int, int]],
+        indexer: Optional[ChipIndexer] = None,
+    ) -> Dict[int, dict]:
+        """
+        Fetches multiple chips from a single item.
+
+        Args:
+            platform (str): The platform of the item.
+            item_id (str): The id of the item.
+            chips (List[Tuple[int, int, int]]): Row number, x and y index of
+                each chip.
+            indexer (Optional[ChipIndexer]): Indexer of the item, loaded if not
+                provided. Defaults to None.
+
+        Returns:
+            Dict[int, dict]: Chip data by row number.
+        """
+        if indexer is None:
+            indexer = self.load_indexer(platform, item_id)
+        result = {}
+        with Chipper(
+            indexer,
+            mountpath=self.mountpath,
+            assets=self.assets,
+            asset_blacklist=self.asset_blacklist,
+            keep_open=True,
+        ) as chipper:
+            for row, x, y in sorted(chips, key=lambda chip: (chip[2], chip[1])):
+                result[row] = chipper.chip(x, y)
+        return result
+
+    def fetch(self, rows: Union[pa.Table, da.Dataset]) -> Iterator[dict]:
+        """
+        Fetches the chips for the rows of an index table.
+
+        Args:
+            rows (Union[pa.Table, da.Dataset]): Index rows with the platform,
+                item_id, chip_index_x and chip_index_y columns.
+
+        Yields:
+            dict: The chip data of each row in the order of the input rows.
+        """
+        if isinstance(rows, da.Dataset):
+            rows = rows.to_table(columns=ROW_COLUMNS)
+        data = rows.select(ROW_COLUMNS).to_pydict()
+
+        # Group rows by item, dicts keep the order of first appearance.
+        groups: Dict[Tuple[str, str], List[Tuple[int, int, int]]] = {}
+        for row, key in enumerate(zip(data["platform"], data["item_id"])):
+            groups.setdefault(key, []).append(
+                (row, data["chip_index_x"][row], data["chip_index_y"][row])
+            )
+
+        # Split the chips of each item into batches in grid order, and
+        # schedule the batches in the order of their first row.
+        batches: List[Tuple[Tuple[str, str], List[Tuple[int, int, int]]]] = []
+        batch_of_row: Dict[int, int] = {}
+        for key, chips in groups.items():
+            chips = sorted(chips, key=lambda chip: (chip[2], chip[1]))
+            for start in range(0, len(chips), self.batch_size):
+                for chip in chips[start : start + self.batch_size]:
+                    batch_of_row[chip[0]] = len(batches)
+                batches.append((key, chips[start : start + self.batch_size]))
+        order = sorted(
+            range(len(batches)),
+            key=lambda batch: min(row for row, _, _ in batches[batch][1]),
+        )
+
+        pending = iter(order)
+        futures: Dict[int, Future] = {}
+        remaining: Dict[int, int] = {}
+        # Items are loaded once and shared by their batches
+        indexers: Dict[Tuple[str, str], Future] = {}
+        batches_left = Counter(key for key, _ in batches)
+        buffered = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            def fetch_batch(key: Tuple[str, str], chips, indexer: Future):
+                return self.fetch_item(*key, chips, indexer=indexer.result())
+
+            for row in range(len(data["item_id"])):
+                batch = batch_of_row[row]
+                # Schedule batches ahead, but always schedule the batch of
+                # the current row to avoid stalling on a full buffer.
+                while batch not in remaining or buffered < self.buffer_size:
+                    next_batch = next(pending, None)
+                    if next_batch is None:
+                        break
+                    key, chips = batches[next_batch]
+                    if key not in indexers:
+                        indexers[key] = executor.submit(self.load_indexer, *key)
+                    futures[next_batch] = executor.submit(
+                        fetch_batch, key, chips, indexers[key]
+                    )
+                    remaining[next_batch] = len(chips)
+                    buffered += len(chips)
+
+                # Emitted chips are removed from the batch result right away
+                chip = futures[batch].result().pop(row)
+                buffered -= 1
+                remaining[batch] -= 1
+                if not remaining[batch]:
+                    del futures[batch]
+                    key = batches[batch][0]
+                    batches_left[key] -= 1
+                    if not batches_left[key]:
+                        del indexers[key]
+
+                yield chip
@@ -1,7 +1,11 @@
 import warnings
-from functools import cached_property
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from functools import cached_property, lru_cache
 from math import floor
-from typing import Tuple
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import geoarrow.pyarrow as ga
 import numpy as np
@@ -10,9 +14,14 @@ import pyarrow.compute as pc
 import pyproj
 import rasterio
 from numpy.typing import ArrayLike
-from pystac import Item
+from pystac import Asset, Item
+from pystac.extensions.projection import ProjectionExtension
+from rasterio import Affine
 from rasterio.crs import CRS
 from rasterio.enums import Resampling
+from rasterio.io import DatasetReader
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
 from shapely import GeometryType, Polygon
 from shapely.geometry import box
 from shapely.ops import transform
@@ -27,6 +36,258 @@ warnings.filterwarnings(
     ),
 )
 
+TARGET_CRS_PROPERTY = "stacchip:target_crs"
+
+ENCODING_COLUMNS = ["lon_norm", "lat_norm", "week_norm", "hour_norm"]
+
+
+@lru_cache(maxsize=256)
+def warp_grid(
+    src_crs: str,
+    dst_crs: str,
+    shape: Tuple[int, int],
+    transform: Tuple[float, ...],
+) -> Tuple[Tuple[float, ...], Tuple[int, int]]:
+    """
+    Compute the target grid for warping a source grid into another CRS
+
+    Items of the same tile share their source grid, so the result is
+    cached and only computed once per grid.
+    """
+    height, width = shape
+    left = transform[2]
+    top = transform[5]
+    right = left + transform[0] * width
+    bottom = top + transform[4] * height
+    dst_transform, dst_width, dst_height = calculate_default_transform(
+        src_crs, dst_crs, width, height, left, bottom, right, top
+    )
+    return tuple(dst_transform)[:6], (dst_height, dst_width)
+
+
+@lru_cache(maxsize=256)
+def get_crs(value: str) -> CRS:
+    """
+    Process-wide cache of CRS objects by their string representation
+    """
+    return CRS.from_user_input(value)
+
+
+@lru_cache(maxsize=256)
+def get_projector(crs_wkt: str) -> Callable:
+    """
+    Process-wide cache of functions projecting coordinates into WGS84
+
+    Transformers are thread safe, so one transformer is shared for all
+    indexers with the same CRS.
+    """
+    return pyproj.Transformer.from_crs(
+        pyproj.CRS.from_wkt(crs_wkt), pyproj.CRS("EPSG:4326"), always_xy=True
+    ).transform
+
+
+SNAPSHOT_SCHEMA = pa.schema(
+    [
+        ("item_id", pa.string()),
+        ("datetime", pa.timestamp("us", tz="UTC")),
+        ("crs", pa.string()),
+        ("target_crs", pa.string()),
+        ("shape", pa.list_(pa.int64())),
+        ("transform", pa.list_(pa.float64())),
+        (
+            "assets",
+            pa.list_(
+                pa.struct(
+                    [
+                        ("key", pa.string()),
+                        ("href", pa.string()),
+                        ("shape", pa.list_(pa.int64())),
+                        ("transform", pa.list_(pa.float64())),
+                    ]
+                )
+            ),
+        ),
+        ("chip_size", pa.int64()),
+    ]
+)
+
+
+@dataclass(frozen=True)
+class AssetSnapshot:
+    """
+    Href and grid of a single asset
+    """
+
+    key: str
+    href: str
+    shape: Optional[Tuple[int, ...]] = None
+    transform: Optional[Tuple[float, ...]] = None
+
+
+@dataclass(frozen=True)
+class IndexerSnapshot:
+    """
+    Compact, serializable representation of a chip indexer
+
+    Holds only the fields needed to rebuild an indexer, so it is cheap to
+    pickle and to store as a row in an Arrow table.
+    """
+
+    item_id: str
+    datetime: datetime
+    crs: str
+    shape: Tuple[int, ...]
+    transform: Tuple[float, ...]
+    assets: Tuple[AssetSnapshot, ...]
+    target_crs: Optional[str] = None
+    chip_size: int = 256
+
+    def to_item(self) -> Item:
+        """
+        Rebuild a minimal STAC item from the snapshot
+        """
+        properties: dict = {
+            "proj:shape": list(self.shape),
+            "proj:transform": list(self.transform),
+        }
+        if self.crs.startswith("EPSG:"):
+            properties["proj:code"] = self.crs
+        else:
+            properties["proj:wkt2"] = self.crs
+        if self.target_crs:
+            properties[TARGET_CRS_PROPERTY] = self.target_crs
+
+        item = Item(
+            id=self.item_id,
+            geometry=None,
+            bbox=None,
+            datetime=self.datetime,
+            properties=properties,
+            stac_extensions=[ProjectionExtension.get_schema_uri()],
+        )
+        for asset in self.assets:
+            extra_fields: dict = {}
+            if asset.shape is not None:
+                extra_fields["proj:shape"] = list(asset.shape)
+            if asset.transform is not None:
+                extra_fields["proj:transform"] = list(asset.transform)
+            item.add_asset(asset.key, Asset(asset.href, extra_fields=extra_fields))
+        return item
+
+    def to_row(self) -> dict:
+        """
+        Convert the snapshot to a row of the snapshot schema
+        """
+        row = asdict(self)
+        row["assets"] = [asdict(asset) for asset in self.assets]
+        return row
+
+    @classmethod
+    def from_row(cls, row: dict) -> "IndexerSnapshot":
+        """
+        Create a snapshot from a row of the snapshot schema
+        """
+        return cls(
+            item_id=row["item_id"],
+            datetime=row["datetime"],
+            crs=row["crs"],
+            shape=tuple(row["shape"]),
+            transform=tuple(row["transform"]),
+            assets=tuple(
+                AssetSnapshot(
+                    key=asset["key"],
+                    href=asset["href"],
+                    shape=None if asset["shape"] is None else tuple(asset["shape"]),
+                    transform=(
+                        None
+                        if asset["transform"] is None
+                        else tuple(asset["transform"])
+                    ),
+                )
+                for asset in row["assets"]
+            ),
+            target_crs=row.get("target_crs"),
+            chip_size=row.get("chip_size") or 256,
+        )
+
+
+def snapshots_to_table(snapshots: List[IndexerSnapshot]) -> pa.Table:
+    """
+    Store indexer snapshots in an Arrow table
+    """
+    return pa.Table.from_pylist(
+        [snapshot.to_row() for snapshot in snapshots], schema=SNAPSHOT_SCHEMA
+    )
+
+
+def snapshots_from_table(table: pa.Table) -> List[IndexerSnapshot]:
+    """
+    Load indexer snapshots from an Arrow table
+    """
+    return [IndexerSnapshot.from_row(row) for row in table.to_pylist()]
+
+
+def get_space_time_encodings(table: pa.Table) -> Dict[str, np.ndarray]:
+    """
+    Sine and cosine encodings of location and date for each chip
+
+    Computed for all rows at once from the date and geometry columns of an
+    index table. The location is the center of the chip bounding box, and
+    dates without time are assumed to be at noon. Returns float32 arrays
+    with the sine and cosine in two columns.
+    """
+    bounds = ga.box(table.column("geometry").combine_chunks()).storage
+    xmin, ymin, xmax, ymax = (
+        bounds.field(key).to_numpy() for key in ("xmin", "ymin", "xmax", "ymax")
+    )
+    lon = (xmin + (xmax - xmin) / 2) * np.pi / 180
+    lat = (ymin + (ymax - ymin) / 2) * np.pi / 180
+
+    date = table.column("date")
+    week = pc.iso_week(date).to_numpy() * 2 * np.pi / 52
+    if pa.types.is_timestamp(date.type):
+        hour = pc.hour(date).to_numpy() * 2 * np.pi / 24
+    else:
+        hour = np.full(len(table), 12 * 2 * np.pi / 24)
+
+    def sincos(values: np.ndarray) -> np.ndarray:
+        return np.stack([np.sin(values), np.cos(values)], axis=1).astype("float32")
+
+    # The lon_norm holds the latitude and vice versa, matching the existing
+    # prechip cubes.
+    return {
+        "lon_norm": sincos(lat),
+        "lat_norm": sincos(lon),
+        "week_norm": sincos(week),
+        "hour_norm": sincos(hour),
+    }
+
+
+def add_space_time_encodings(table: pa.Table) -> pa.Table:
+    """
+    Add the space and time encodings to an index table
+    """
+    for key, values in get_space_time_encodings(table).items():
+        table = table.append_column(
+            key, pa.FixedSizeListArray.from_arrays(values.reshape(-1), 2)
+        )
+    return table
+
+
+def space_time_encodings_from_table(table: pa.Table) -> Dict[str, np.ndarray]:
+    """
+    Read space and time encodings stored in an index table
+    """
+    return {
+        key: table.column(key)
+        .combine_chunks()
+        .flatten()
+        .to_numpy()
+        .reshape(-1, 2)
+        .astype("float32")
+        for key in ENCODING_COLUMNS
+    }
+
 
 class ChipIndexer:
     """
@@ -39,14 +300,26 @@ class ChipIndexer:
         chip_size: int = 256,
         chip_max_nodata: float = 0.5,
         shape=None,
+        target_crs: Optional[str] = None,
+        local_hrefs: Optional[Dict[str, str]] = None,
     ) -> None:
         """
         Init ChipIndexer
+
+        If a target CRS is specified, the index is defined on a grid in the
+        target CRS, and assets are warped on the fly when reading. The target
+        CRS can also be stored in the item properties using the
+        ``stacchip:target_crs`` key.
+
+        Local hrefs map asset keys to local copies of the assets. The stats
+        are computed from the local copies instead of the asset hrefs.
         """
         self.item = item
         self.chip_size = chip_size
         self.chip_max_nodata = chip_max_nodata
         self._shape = shape
+        self.target_crs = target_crs or item.properties.get(TARGET_CRS_PROPERTY)
+        self.local_hrefs = local_hrefs or {}
 
         assert self.item.ext.has("proj")
 
@@ -59,17 +332,26 @@ class ChipIndexer:
         """
         assert self.crs.linear_units.lower() in ["metre", "meter"]
 
-    @property
+    @cached_property
     def crs(self) -> CRS:
+        """
+        Get coordinate reference system for this index
+        """
+        if self.target_crs:
+            return get_crs(self.target_crs)
+        return self.source_crs
+
+    @cached_property
+    def source_crs(self) -> CRS:
         """
         Get coordinate reference system for the assets in this index
         """
         if self.item.properties.get("proj:epsg", None):
-            return CRS.from_epsg(self.item.properties["proj:epsg"])
+            return get_crs(f"EPSG:{self.item.properties['proj:epsg']}")
         elif "proj:wkt2" in self.item.properties:
-            return CRS.from_string(self.item.properties["proj:wkt2"])
+            return get_crs(self.item.properties["proj:wkt2"])
         elif "proj:code" in self.item.properties:
-            return CRS.from_string(self.item.properties["proj:code"])
+            return get_crs(self.item.properties["proj:code"])
         else:
             raise ValueError("Could not identify CRS of source files")
 
@@ -77,10 +359,46 @@ class ChipIndexer:
         """
         Prepare projection function to project geometries into WGS84
         """
-        wgs84 = pyproj.CRS("EPSG:4326")
-        self._projector = pyproj.Transformer.from_crs(
-            self.crs, wgs84, always_xy=True
-        ).transform
+        self._projector = get_projector(self.crs.to_wkt())
+
+    def snapshot(self) -> IndexerSnapshot:
+        """
+        Compact snapshot of this indexer
+        """
+        return IndexerSnapshot(
+            item_id=self.item.id,
+            datetime=self.item.datetime,
+            crs=self.source_crs.to_string(),
+            shape=tuple(self.source_shape),
+            transform=tuple(self.source_transform),
+            assets=tuple(
+                AssetSnapshot(
+                    key=key,
+                    href=asset.href,
+                    shape=(
+                        tuple(asset.extra_fields["proj:shape"])
+                        if "proj:shape" in asset.extra_fields
+                        else None
+                    ),
+                    transform=(
+                        tuple(asset.extra_fields["proj:transform"])
+                        if "proj:transform" in asset.extra_fields
+                        else None
+                    ),
+                )
+                for key, asset in self.item.assets.items()
+            ),
+            target_crs=self.target_crs,
+            chip_size=self.chip_size,
+        )
+
+    @classmethod
+    def from_snapshot(cls, snapshot: IndexerSnapshot, **kwargs) -> "ChipIndexer":
+        """
+        Rehydrate an indexer from a snapshot
+        """
+        kwargs.setdefault("chip_size", snapshot.chip_size)
+        return cls(snapshot.to_item(), **kwargs)
 
     def reproject(self, geom) -> GeometryType:
         """
@@ -112,6 +430,32 @@ class ChipIndexer:
 
         return data
 
+    @cached_property
+    def source_shape(self) -> list:
+        """
+        Shape of the highest resolution band of the STAC item assets
+        """
+        return self._get_trsf_or_shape("proj:shape")
+
+    @cached_property
+    def source_transform(self) -> list:
+        """
+        The transform property from the STAC item
+        """
+        return self._get_trsf_or_shape("proj:transform")
+
+    @cached_property
+    def target_grid(self) -> Tuple[Tuple[float, ...], Tuple[int, int]]:
+        """
+        Transform and shape of the grid in the target CRS
+        """
+        return warp_grid(
+            self.source_crs.to_wkt(),
+            self.crs.to_wkt(),
+            tuple(self.source_shape[:2]),
+            tuple(self.source_transform[:6]),
+        )
+
     @cached_property
     def shape(self) -> list:
         """
@@ -122,15 +466,60 @@ class ChipIndexer:
         """
         if self._shape is not None:
             return self._shape
+        elif self.target_crs:
+            return list(self.target_grid[1])
         else:
-            return self._get_trsf_or_shape("proj:shape")
+            return self.source_shape
 
     @cached_property
     def transform(self) -> list:
         """
-        The transform property from the STAC item
+        The transform of the index grid
         """
-        return self._get_trsf_or_shape("proj:transform")
+        if self.target_crs:
+            return list(self.target_grid[0])
+        return self.source_transform
+
+    @cached_property
+    def warp_options(self) -> dict:
+        """
+        Options for reading assets through a WarpedVRT on the index grid
+        """
+        return {
+            "crs": self.crs,
+            "transform": Affine(*self.transform[:6]),
+            "width": self.shape[1],
+            "height": self.shape[0],
+            "resampling": Resampling.nearest,
+        }
+
+    def asset_href(self, key: str) -> str:
+        """
+        Href to read an asset from, preferring local copies
+        """
+        return self.local_hrefs.get(key, self.item.assets[key].href)
+
+    @contextmanager
+    def open_asset(
+        self, href: Union[str, Path]
+    ) -> Iterator[Union[DatasetReader, WarpedVRT]]:
+        """
+        Open an asset, warped onto the index grid if a target CRS is set
+        """
+        # Close explicitly instead of using the dataset as context manager,
+        # datasets that are kept open may be closed from another thread.
+        src = rasterio.open(href)
+        try:
+            if not self.target_crs:
+                yield src
+            else:
+                vrt = WarpedVRT(src, **self.warp_options)
+                try:
+                    yield vrt
+                finally:
+                    vrt.close()
+        finally:
+            src.close()
 
     @property
     def x_size(self) -> int:
@@ -188,9 +577,11 @@ class ChipIndexer:
 
         return self.reproject(chip_box)
 
-    def create_index(self) -> pa.Table:
+    def create_index(self, encodings: bool = False) -> pa.Table:
         """
         The index for this STAC item
+
+        Optionally adds the space and time encodings of the chips.
         """
         index = {
             "chipid": np.empty(self.size, dtype="<U256"),
@@ -225,6 +616,8 @@ class ChipIndexer:
         print(
             f"Dropped {chips_count - table.shape[0]}/{chips_count} chips due to nodata above {self.chip_max_nodata}"
         )
+        if encodings:
+            table = add_space_time_encodings(table)
         return table
 
 
@@ -286,10 +679,11 @@ class LandsatIndexer(ChipIndexer):
         The quality band data for the STAC item
         """
         print("Loading qa band")
-        self.item.assets["qa_pixel"].href = self.item.assets["qa_pixel"].extra_fields[
-            "alternate"
-        ]["s3"]["href"]
-        with rasterio.open(self.item.assets["qa_pixel"].href) as src:
+        if "qa_pixel" not in self.local_hrefs:
+            self.item.assets["qa_pixel"].href = self.item.assets[
+                "qa_pixel"
+            ].extra_fields["alternate"]["s3"]["href"]
+        with self.open_asset(self.asset_href("qa_pixel")) as src:
             return src.read(1)
 
     def get_stats(self, x: int, y: int) -> Tuple[float, float]:
@@ -336,7 +730,7 @@ class Sentinel2Indexer(ChipIndexer):
         The Scene Classification (SCL) band data for the STAC item
         """
         print("Loading scl band")
-        with rasterio.open(self.item.assets["scl"].href) as src:
+        with self.open_asset(self.asset_href("scl")) as src:
             return src.read(out_shape=(1, *self.shape), resampling=Resampling.nearest)[
                 0
             ]
@@ -370,7 +764,7 @@ class ModisIndexer(ChipIndexer):
         The Quality band data for the STAC item
         """
         print("Loading quality band")
-        with rasterio.open(self.item.assets["sur_refl_qc_500m"].href) as src:
+        with self.open_asset(self.asset_href("sur_refl_qc_500m")) as src:
             return src.read(out_shape=(1, *self.shape), resampling=Resampling.nearest)[
                 0
             ]
@@ -0,0 +1,126 @@
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+S2_BANDS = (
+    "blue",
+    "green",
+    "red",
+    "rededge1",
+    "rededge2",
+    "rededge3",
+    "nir",
+    "nir08",
+    "swir16",
+    "swir22",
+)
+LS_BANDS = (
+    "red",
+    "green",
+    "blue",
+    "nir08",
+    "swir16",
+    "swir22",
+)
+NAIP_BANDS = ("red", "green", "blue", "nir")
+LINZ_BANDS = ("red", "green", "blue")
+S1_BANDS = ("vv", "vh")
+MODIS_BANDS = (
+    "sur_refl_b01",
+    "sur_refl_b02",
+    "sur_refl_b03",
+    "sur_refl_b04",
+    "sur_refl_b05",
+    "sur_refl_b06",
+    "sur_refl_b07",
+)
+
+
+@dataclass(frozen=True)
+class PlatformBands:
+    """
+    Bands of a platform that are used for chips
+
+    The assets are read in the given order and stacked into the output
+    bands. Single assets may contain multiple bands. The data type is used
+    for the pixels of the prechip cubes. The histogram range and number of
+    bins are used for band statistics, values outside of the range are
+    counted in overflow bins. For integer data, the width of the range should
+    be a multiple of the number of bins, so that all bins hold the same
+    number of integer values.
+    """
+
+    bands: Tuple[str, ...]
+    assets: Tuple[str, ...]
+    nodata: float
+    dtype: str
+    hist_range: Tuple[float, float] = (0, 65536)
+    hist_bins: int = 4096
+
+    def stack(self, chip: dict) -> ArrayLike:
+        """
+        Stack the pixels of the assets of a chip in output band order
+        """
+        return np.vstack([chip[key] for key in self.assets])
+
+
+PLATFORM_BANDS: Dict[str, PlatformBands] = {
+    "naip": PlatformBands(
+        bands=NAIP_BANDS,
+        assets=("image",),
+        nodata=0,
+        dtype="uint8",
+        hist_range=(0, 256),
+        hist_bins=256,
+    ),
+    "linz": PlatformBands(
+        bands=LINZ_BANDS,
+        assets=("asset",),
+        nodata=0,
+        dtype="uint8",
+        hist_range=(0, 256),
+        hist_bins=256,
+    ),
+    "sentinel-2-l2a": PlatformBands(
+        bands=S2_BANDS,
+        assets=S2_BANDS,
+        nodata=0,
+        dtype="uint16",
+        hist_range=(0, 20000),
+        hist_bins=5000,
+    ),
+    "landsat-c2l2-sr": PlatformBands(
+        bands=LS_BANDS, assets=LS_BANDS, nodata=0, dtype="uint16"
+    ),
+    "landsat-c2l1": PlatformBands(
+        bands=LS_BANDS, assets=LS_BANDS, nodata=0, dtype="uint16"
+    ),
+    "sentinel-1-rtc": PlatformBands(
+        bands=S1_BANDS,
+        assets=S1_BANDS,
+        nodata=-32768,
+        dtype="float32",
+        # Backscatter is mostly below 1, bright targets reach well above
+        hist_range=(0, 16),
+        hist_bins=32768,
+    ),
+    "modis": PlatformBands(
+        bands=MODIS_BANDS,
+        assets=MODIS_BANDS,
+        nodata=-28672,
+        dtype="int16",
+        hist_range=(-100, 16000),
+        hist_bins=4025,
+    ),
+}
+
+
+def get_platform_bands(platform: str) -> PlatformBands:
+    """
+    Get the band definition for a platform
+    """
+    if platform not in PLATFORM_BANDS:
+        raise ValueError(f"Platform {platform} not found")
+    return PLATFORM_BANDS[platform]
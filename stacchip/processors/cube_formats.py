@@ -0,0 +1,622 @@
+import json
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Type, Union
+
+import numpy as np
+import pyarrow as pa
+
+MAGIC = b"STCHCUBE"
+
+ARROW_MAGIC = b"ARROW1"
+
+HEADER = struct.Struct("<8sQ")
+
+ALIGNMENT = 4096
+
+Arrays = Dict[str, np.ndarray]
+
+
+def _align(offset: int, alignment: int = ALIGNMENT) -> int:
+    return -(-offset // alignment) * alignment
+
+
+class Codec:
+    """
+    Compresses the chunks of a cube file
+    """
+
+    name = "raw"
+
+    def __init__(self, level: Optional[int] = None) -> None:
+        """
+        Init Codec
+        """
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Compress a chunk
+        """
+        return data
+
+    def decompress(self, data: bytes, size: int) -> bytes:
+        """
+        Decompress a chunk of known uncompressed size
+        """
+        return data
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard codec, requires the zstandard package
+    """
+
+    name = "zstd"
+
+    def __init__(self, level: Optional[int] = None) -> None:
+        """
+        Init ZstdCodec
+        """
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(
+                "The zstd cube format requires zstandard, install stacchip[cubes]"
+            ) from e
+        self.zstandard = zstandard
+        self.level = 3 if level is None else level
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Compress a chunk
+        """
+        # Compressor objects are not thread safe, they are cheap to create
+        return self.zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data: bytes, size: int) -> bytes:
+        """
+        Decompress a chunk of known uncompressed size
+        """
+        return self.zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+
+class Lz4Codec(Codec):
+    """
+    LZ4 frame codec, requires the lz4 package
+    """
+
+    name = "lz4"
+
+    def __init__(self, level: Optional[int] = None) -> None:
+        """
+        Init Lz4Codec
+        """
+        try:
+            import lz4.frame
+        except ImportError as e:
+            raise ImportError(
+                "The lz4 cube format requires lz4, install stacchip[cubes]"
+            ) from e
+        self.frame = lz4.frame
+        self.level = 0 if level is None else level
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Compress a chunk
+        """
+        return self.frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data: bytes, size: int) -> bytes:
+        """
+        Decompress a chunk of known uncompressed size
+        """
+        return self.frame.decompress(data)
+
+
+CODECS: Dict[str, Type[Codec]] = {
+    "raw": Codec,
+    "zstd": ZstdCodec,
+    "lz4": Lz4Codec,
+}
+
+
+class CubeFormat:
+    """
+    Encodes the arrays of a cube to bytes and decodes them again
+    """
+
+    name = "npz"
+    extension = "npz"
+
+    def encode(self, arrays: Arrays) -> bytes:
+        """
+        Encode the arrays of a cube
+        """
+        with BytesIO() as bytes:
+            np.savez_compressed(file=bytes, **arrays)
+            return bytes.getvalue()
+
+    def decode(self, content: bytes) -> Arrays:
+        """
+        Decode the arrays of a cube
+        """
+        with np.load(BytesIO(content)) as data:
+            return {key: data[key] for key in data.files}
+
+    def read(self, path: Union[str, Path]) -> Arrays:
+        """
+        Read the arrays of a cube file
+        """
+        return self.decode(Path(path).read_bytes())
+
+    def iter_chunks(
+        self, path: Union[str, Path], key: str = "pixels"
+    ) -> Iterator[np.ndarray]:
+        """
+        Iterate over an array of a cube file one entry of the first axis at a time
+        """
+        yield from self.read(path)[key]
+
+
+class ChunkedFormat(CubeFormat):
+    """
+    Cube format with separately compressed chunks
+
+    The pixels are split into one chunk per chip, other arrays are stored
+    as a single chunk. Chunks are compressed and decompressed concurrently,
+    and the bytes of each value can be shuffled to improve compression of
+    floating point data.
+
+    The file starts with a magic number and the length of a json header
+    that describes the arrays and their chunks. Chunks follow the header
+    and are aligned to 4096 bytes.
+    """
+
+    extension = "cube"
+
+    def __init__(
+        self,
+        codec: str = "zstd",
+        level: Optional[int] = None,
+        shuffle: bool = True,
+        max_workers: Optional[int] = None,
+        chunked: Tuple[str, ...] = ("pixels",),
+    ) -> None:
+        """
+        Init ChunkedFormat
+        """
+        if codec not in CODECS:
+            raise ValueError(f"Codec {codec} not supported, use one of {list(CODECS)}")
+        self.codec = CODECS[codec](level)
+        self.name = codec
+        self.shuffle = shuffle
+        self.max_workers = max_workers or os.cpu_count()
+        self.chunked = chunked
+
+    def _encode_chunk(self, chunk: np.ndarray) -> bytes:
+        chunk = np.ascontiguousarray(chunk)
+        if self.shuffle and chunk.dtype.itemsize > 1:
+            data = chunk.view(np.uint8).reshape(-1, chunk.dtype.itemsize).T.tobytes()
+        else:
+            data = chunk.tobytes()
+        return self.codec.compress(data)
+
+    def _decode_chunk(self, data: bytes, out: np.ndarray) -> None:
+        raw = np.frombuffer(self.codec.decompress(data, out.nbytes), dtype=np.uint8)
+        itemsize = out.dtype.itemsize
+        if self.shuffle and itemsize > 1:
+            out.view(np.uint8).reshape(-1, itemsize)[:] = raw.reshape(itemsize, -1).T
+        else:
+            out.view(np.uint8).reshape(-1)[:] = raw
+
+    def encode(self, arrays: Arrays) -> bytes:
+        """
+        Encode the arrays of a cube
+        """
+        chunks = []
+        for key, array in arrays.items():
+            if key in self.chunked and array.ndim > 1:
+                chunks.extend((key, chunk) for chunk in array)
+            else:
+                chunks.append((key, array))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            blobs = list(
+                executor.map(lambda chunk: self._encode_chunk(chunk[1]), chunks)
+            )
+
+        header: dict = {
+            "codec": self.codec.name,
+            "shuffle": self.shuffle,
+            "arrays": {
+                key: {"dtype": array.dtype.str, "shape": array.shape, "chunks": []}
+                for key, array in arrays.items()
+            },
+        }
+        # Only uncompressed chunks need to be aligned for memory mapping
+        alignment = ALIGNMENT if self.codec.name == "raw" else 8
+        offsets = []
+        offset = 0
+        for (key, _), blob in zip(chunks, blobs):
+            header["arrays"][key]["chunks"].append([offset, len(blob)])
+            offsets.append(offset)
+            offset = _align(offset + len(blob), alignment)
+
+        header_bytes = json.dumps(header).encode()
+        data_start = _align(HEADER.size + len(header_bytes))
+        content = bytearray(data_start + offset)
+        content[: HEADER.size] = HEADER.pack(MAGIC, len(header_bytes))
+        content[HEADER.size : HEADER.size + len(header_bytes)] = header_bytes
+        for offset, blob in zip(offsets, blobs):
+            start = data_start + offset
+            content[start : start + len(blob)] = blob
+        return bytes(content)
+
+    @staticmethod
+    def read_header(content: bytes) -> Tuple[dict, int]:
+        """
+        Read the header and the start of the data section of a cube file
+        """
+        magic, header_size = HEADER.unpack_from(content)
+        if magic != MAGIC:
+            raise ValueError("Not a stacchip cube file")
+        header = json.loads(bytes(content[HEADER.size : HEADER.size + header_size]))
+        return header, _align(HEADER.size + header_size)
+
+    @classmethod
+    def read_file_header(cls, file: BinaryIO) -> Tuple[dict, int]:
+        """
+        Read the header and the start of the data section from an open file
+        """
+        prefix = file.read(HEADER.size)
+        _, header_size = HEADER.unpack(prefix)
+        return cls.read_header(prefix + file.read(header_size))
+
+    def _for_header(self, header: dict) -> "ChunkedFormat":
+        """
+        Format matching the codec and shuffle settings of a header
+        """
+        if header["codec"] == self.codec.name and header["shuffle"] == self.shuffle:
+            return self
+        return ChunkedFormat(
+            codec=header["codec"],
+            shuffle=header["shuffle"],
+            max_workers=self.max_workers,
+        )
+
+    def decode(self, content: bytes) -> Arrays:
+        """
+        Decode the arrays of a cube
+        """
+        header, data_start = self.read_header(content)
+        cube_format = self._for_header(header)
+        if cube_format is not self:
+            return cube_format.decode(content)
+
+        view = memoryview(content)
+        arrays = {}
+        tasks = []
+        for key, meta in header["arrays"].items():
+            out = np.empty(meta["shape"], dtype=meta["dtype"])
+            arrays[key] = out
+            outs = out if len(meta["chunks"]) > 1 else [out]
+            for (offset, size), chunk_out in zip(meta["chunks"], outs):
+                start = data_start + offset
+                tasks.append((view[start : start + size], chunk_out))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda task: self._decode_chunk(*task), tasks))
+        return arrays
+
+    def iter_chunks(
+        self, path: Union[str, Path], key: str = "pixels"
+    ) -> Iterator[np.ndarray]:
+        """
+        Iterate over an array of a cube file one entry of the first axis at a time
+
+        Chunked arrays are read and decompressed one chunk at a time, so
+        that only a single chip is held in memory.
+        """
+        with open(path, "rb") as file:
+            header, data_start = self.read_file_header(file)
+            cube_format = self._for_header(header)
+            meta = header["arrays"][key]
+            chunked = len(meta["chunks"]) > 1
+            shape = meta["shape"][1:] if chunked else meta["shape"]
+            for offset, size in meta["chunks"]:
+                file.seek(data_start + offset)
+                out = np.empty(shape, dtype=meta["dtype"])
+                cube_format._decode_chunk(file.read(size), out)
+                if chunked:
+                    yield out
+                else:
+                    yield from out
+
+
+class RawFormat(ChunkedFormat):
+    """
+    Uncompressed cube format with aligned arrays
+
+    Arrays are stored as single uncompressed chunks in the chunked file
+    layout, so that they can be memory-mapped without copying.
+    """
+
+    name = "raw"
+
+    def __init__(self) -> None:
+        """
+        Init RawFormat
+        """
+        super().__init__(codec="raw", shuffle=False, max_workers=1, chunked=())
+
+    def decode(self, content: bytes) -> Arrays:
+        """
+        Decode the arrays of a cube as read-only views on the content
+        """
+        header, data_start = self.read_header(content)
+        if header["codec"] != "raw":
+            return super().decode(content)
+        return {
+            key: np.frombuffer(
+                content,
+                dtype=meta["dtype"],
+                count=int(np.prod(meta["shape"])),
+                offset=data_start + meta["chunks"][0][0],
+            ).reshape(meta["shape"])
+            for key, meta in header["arrays"].items()
+        }
+
+    def read(self, path: Union[str, Path]) -> Arrays:
+        """
+        Memory-map the arrays of a cube file
+        """
+        with open(path, "rb") as f:
+            header, data_start = self.read_file_header(f)
+        if header["codec"] != "raw":
+            return super().read(path)
+        return {
+            key: np.memmap(
+                path,
+                dtype=meta["dtype"],
+                mode="r",
+                offset=data_start + meta["chunks"][0][0],
+                shape=tuple(meta["shape"]),
+            )
+            for key, meta in header["arrays"].items()
+        }
+
+    def iter_chunks(
+        self, path: Union[str, Path], key: str = "pixels"
+    ) -> Iterator[np.ndarray]:
+        """
+        Iterate over an array of a cube file one entry of the first axis at a time
+
+        Uncompressed arrays are memory-mapped, compressed cubes are read
+        one chunk at a time.
+        """
+        with open(path, "rb") as f:
+            header, _ = self.read_file_header(f)
+        if header["codec"] != "raw":
+            yield from super().iter_chunks(path, key)
+            return
+        yield from self.read(path)[key]
+
+
+class ArrowFormat(CubeFormat):
+    """
+    Cube format as Arrow IPC file with one row per chip
+
+    Multidimensional arrays are stored as fixed shape tensor columns, other
+    arrays such as the chip ids as plain columns. Uncompressed files can be
+    memory-mapped and sliced without copying the pixels. Compressed files
+    are written with one record batch per chip, so that chips can be
+    decompressed one at a time.
+    """
+
+    name = "arrow"
+    extension = "arrow"
+
+    def __init__(self, compression: Optional[str] = None) -> None:
+        """
+        Init ArrowFormat
+        """
+        self.compression = compression
+
+    @staticmethod
+    def to_table(arrays: Arrays) -> pa.Table:
+        """
+        Convert the arrays of a cube to a table
+        """
+        return pa.table(
+            {
+                key: (
+                    pa.FixedShapeTensorArray.from_numpy_ndarray(
+                        np.ascontiguousarray(array)
+                    )
+                    if array.ndim > 1
+                    else pa.array(array)
+                )
+                for key, array in arrays.items()
+            }
+        )
+
+    @staticmethod
+    def from_table(table: pa.Table) -> Arrays:
+        """
+        Convert a cube table to arrays, without copying if possible
+        """
+        arrays = {}
+        for key in table.column_names:
+            column = table.column(key)
+            column = (
+                column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+            )
+            if isinstance(column.type, pa.FixedShapeTensorType):
+                arrays[key] = column.to_numpy_ndarray()
+            else:
+                arrays[key] = column.to_numpy(zero_copy_only=False)
+        return arrays
+
+    def encode(self, arrays: Arrays) -> bytes:
+        """
+        Encode the arrays of a cube
+        """
+        table = self.to_table(arrays)
+        sink = pa.BufferOutputStream()
+        options = pa.ipc.IpcWriteOptions(compression=self.compression)
+        # Uncompressed files are kept as a single batch to read without copies
+        max_chunksize = 1 if self.compression else None
+        with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table, max_chunksize=max_chunksize)
+        return sink.getvalue().to_pybytes()
+
+    def decode(self, content: bytes) -> Arrays:
+        """
+        Decode the arrays of a cube
+        """
+        return self.from_table(pa.ipc.open_file(pa.py_buffer(content)).read_all())
+
+    def read_table(self, path: Union[str, Path]) -> pa.Table:
+        """
+        Read a cube file as memory-mapped table
+        """
+        return pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+
+    def read(self, path: Union[str, Path]) -> Arrays:
+        """
+        Read the arrays of a memory-mapped cube file
+        """
+        return self.from_table(self.read_table(path))
+
+    def iter_chunks(
+        self, path: Union[str, Path], key: str = "pixels"
+    ) -> Iterator[np.ndarray]:
+        """
+        Iterate over an array of a cube file one entry of the first axis at a time
+
+        Record batches are read and decompressed one at a time.
+        """
+        reader = pa.ipc.open_file(pa.memory_map(str(path)))
+        for index in range(reader.num_record_batches):
+            column = reader.get_batch(index).column(key)
+            if isinstance(column.type, pa.FixedShapeTensorType):
+                yield from column.to_numpy_ndarray()
+            else:
+                yield from column.to_numpy(zero_copy_only=False)
+
+
+CUBE_FORMATS = {
+    "npz": lambda: CubeFormat(),
+    "zstd": lambda: ChunkedFormat(codec="zstd"),
+    "lz4": lambda: ChunkedFormat(codec="lz4"),
+    "raw": lambda: RawFormat(),
+    "arrow": lambda: ArrowFormat(),
+    "arrow-lz4": lambda: ArrowFormat(compression="lz4"),
+}
+
+
+def get_cube_format(name: str) -> CubeFormat:
+    """
+    Get a cube format by name
+    """
+    if name not in CUBE_FORMATS:
+        raise ValueError(
+            f"Cube format {name} not supported, use one of {list(CUBE_FORMATS)}"
+        )
+    return CUBE_FORMATS[name]()
+
+
+def read_cube(path: Union[str, Path]) -> Arrays:
+    """
+    Read a cube file in any of the cube formats
+
+    Uncompressed cubes are memory-mapped.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(MAGIC))
+    if magic.startswith(ARROW_MAGIC):
+        return ArrowFormat().read(path)
+    if magic != MAGIC:
+        return CubeFormat().read(path)
+    return RawFormat().read(path)
+
+
+def iter_cube(path: Union[str, Path], key: str = "pixels") -> Iterator[np.ndarray]:
+    """
+    Iterate over an array of a cube file in any of the cube formats
+
+    Yields one entry of the first axis at a time, compressed cubes are
+    decompressed chunk by chunk where the format allows it.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(MAGIC))
+    if magic.startswith(ARROW_MAGIC):
+        return ArrowFormat().iter_chunks(path, key)
+    if magic != MAGIC:
+        return CubeFormat().iter_chunks(path, key)
+    return RawFormat().iter_chunks(path, key)
+
+
+def benchmark(
+    arrays: Optional[Arrays] = None,
+    formats: Tuple[str, ...] = tuple(CUBE_FORMATS),
+    repeat: int = 3,
+) -> List[dict]:
+    """
+    Compare size and encode and decode throughput of the cube formats
+
+    Uses a synthetic cube of 128 chips if no arrays are passed.
+    """
+    if arrays is None:
+        rng = np.random.default_rng(42)
+        pixels = rng.normal(1000, 200, size=(128, 4, 256, 256)).round()
+        arrays = {
+            "pixels": pixels.astype("float32"),
+            "lon_norm": rng.uniform(-1, 1, size=(128, 2)).astype("float32"),
+            "lat_norm": rng.uniform(-1, 1, size=(128, 2)).astype("float32"),
+        }
+    nbytes = sum(array.nbytes for array in arrays.values())
+
+    result = []
+    for name in formats:
+        cube_format = get_cube_format(name)
+        encode_time = decode_time = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            content = cube_format.encode(arrays)
+            encode_time = min(encode_time, time.perf_counter() - start)
+            start = time.perf_counter()
+            decoded = cube_format.decode(content)
+            # Touch the data, raw cubes are decoded lazily
+            for array in decoded.values():
+                np.asarray(array).sum()
+            decode_time = min(decode_time, time.perf_counter() - start)
+        result.append(
+            {
+                "format": name,
+                "size_mb": len(content) / 1e6,
+                "ratio": nbytes / len(content),
+                "encode_mb_s": nbytes / 1e6 / encode_time,
+                "decode_mb_s": nbytes / 1e6 / decode_time,
+            }
+        )
+    return result
+
+
+if __name__ == "__main__":
+    # Benchmark with a cube file if passed as argument
+    arrays = read_cube(sys.argv[1]) if len(sys.argv) > 1 else None
+    print(
+        f"{'format':>10} {'size MB':>10} {'ratio':>8} {'enc MB/s':>10} {'dec MB/s':>10}"
+    )
+    for row in benchmark(arrays):
+        print(
+            f"{row['format']:>10} {row['size_mb']:>10.1f} {row['ratio']:>8.2f} "
+            f"{row['encode_mb_s']:>10.0f} {row['decode_mb_s']:>10.0f}"
+        )
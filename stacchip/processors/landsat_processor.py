@@ -1,16 +1,14 @@
-import json
 import os
 import random
 from pathlib import Path
-from urllib.parse import urlparse
+from typing import Iterable, List, Tuple
 
-import boto3
 import geopandas as gp
-import pyarrow as pa
 import pystac_client
-from geoarrow.pyarrow import io
 
 from stacchip.indexer import LandsatIndexer
+from stacchip.processors.pipeline import IngestPipeline, Scene
+from stacchip.processors.transfer import Transfer, copy_objects
 
 STAC_API = "https://landsatlook.usgs.gov/stac-server"
 
@@ -46,82 +44,104 @@ quartals = [
 ]
 
 
-def process_landsat_tile(index: int, sample_source: str, bucket: str) -> None:
-    # Prepare resources for the job
-    catalog = pystac_client.Client.open(STAC_API)
-    s3 = boto3.resource("s3")
-    data = gp.read_file(sample_source)
-    row = data.iloc[index]
-
-    print("MGRS", row["name"])
-    for platform_name in [PLATFORM_NAME_L1, PLATFORM_NAME_L2]:
-        random.seed(index)
-        for year in random.sample(range(2018, 2024), 1):
-            print(f"Year {year}")
-            for quartal in quartals:
-                print(f"Quartal {quartal.format(year=year)}")
-                items = catalog.search(
-                    collections=[platform_name],
-                    datetime=quartal.format(year=year),
-                    max_items=1,
-                    intersects=row.geometry.centroid,
-                    sortby="properties.eo:cloud_cover",
-                    query={
-                        "platform": {"in": ["LANDSAT_8", "LANDSAT_9"]},
-                    },
+class LandsatPipeline(IngestPipeline):
+    """
+    Ingest the least cloudy Landsat L1 and L2 scenes per quartal
+    """
+
+    def __init__(self, index: int, sample_source: str, bucket: str, **kwargs) -> None:
+        """
+        Init LandsatPipeline
+        """
+        super().__init__(bucket, job=index, **kwargs)
+        self.catalog = pystac_client.Client.open(STAC_API)
+        self.row = gp.read_file(sample_source).iloc[index]
+        self.seed = index
+
+    def queries(self) -> Iterable[Tuple[str, str]]:
+        """
+        Platform and quartals of a random year for the sample location
+        """
+        print("MGRS", self.row["name"])
+        for platform_name in [PLATFORM_NAME_L1, PLATFORM_NAME_L2]:
+            random.seed(self.seed)
+            for year in random.sample(range(2018, 2024), 1):
+                for quartal in quartals:
+                    yield platform_name, quartal.format(year=year)
+
+    def search(self, query: Tuple[str, str]) -> List[Scene]:
+        """
+        Search the least cloudy scene of a platform in a quartal
+        """
+        platform_name, timerange = query
+        items = self.catalog.search(
+            collections=[platform_name],
+            datetime=timerange,
+            max_items=1,
+            intersects=self.row.geometry.centroid,
+            sortby="properties.eo:cloud_cover",
+            query={
+                "platform": {"in": ["LANDSAT_8", "LANDSAT_9"]},
+            },
+        )
+        items = list(items.item_collection())
+        if not len(items):
+            print(f"No {platform_name} items found for quartal {timerange}")
+            return []
+
+        item = items[0]
+        print(
+            f"Quartal {timerange} cloud cover is {item.properties['eo:cloud_cover']}"
+            f" ({item.properties['platform']})"
+        )
+        if item.properties["eo:cloud_cover"] > ABSOLUTE_CLOUD_COVER_FILTER:
+            return []
+
+        return [Scene(item=item, platform=platform_name)]
+
+    def transfer(self, scene: Scene) -> Scene:
+        """
+        Copy the assets of the scene from the requester pays bucket
+        """
+        item = scene.item
+        transfers = {}
+        for key in list(item.assets.keys()):
+            if (scene.platform == PLATFORM_NAME_L1 and key not in LS_ASSETS_L1) or (
+                key not in LS_ASSETS_L2
+            ):
+                del item.assets[key]
+            else:
+                href = item.assets[key].extra_fields["alternate"]["s3"]["href"]
+                transfers[key] = Transfer(
+                    source=href,
+                    bucket=self.bucket,
+                    key=f"{scene.platform}/{item.id}/{Path(href).name}",
+                    requester_pays=True,
+                    local_path=(
+                        scene.scratch_path(Path(href).name)
+                        if self.single_pass and key == "qa_pixel"
+                        else None
+                    ),
                 )
-                item = items.item_collection()[0]
-
-                if item.properties["eo:cloud_cover"] > ABSOLUTE_CLOUD_COVER_FILTER:
-                    continue
+        copy_objects(transfers.values())
+        for key, transfer in transfers.items():
+            item.assets[key].href = transfer.href
+            if transfer.local_path:
+                scene.local_hrefs[key] = transfer.local_path
 
-                print(
-                    f"Cloud cover is {item.properties['eo:cloud_cover']} ({item.properties['platform']})"
-                )
+        return scene
 
-                for key in list(item.assets.keys()):
-                    if (
-                        platform_name == PLATFORM_NAME_L1 and key not in LS_ASSETS_L1
-                    ) or (key not in LS_ASSETS_L2):
-                        del item.assets[key]
-                    else:
-                        href = item.assets[key].extra_fields["alternate"]["s3"]["href"]
-                        url = urlparse(href)
-                        copy_source = {
-                            "Bucket": url.netloc,
-                            "Key": url.path.lstrip("/"),
-                        }
-                        print(f"Copying {key} band to {copy_source}")
-                        new_key = f"{platform_name}/{item.id}/{Path(href).name}"
-                        s3.meta.client.copy(
-                            copy_source,
-                            bucket,
-                            new_key,
-                            ExtraArgs={"RequestPayer": "requester"},
-                        )
-                        item.assets[key].href = f"s3://{bucket}/{new_key}"
-
-                # Convert Dictionary to JSON String
-                data_string = json.dumps(item.to_dict())
-
-                # Upload JSON String to an S3 Object
-                s3_bucket = s3.Bucket(name=bucket)
-                s3_bucket.put_object(
-                    Key=f"{platform_name}/{item.id}/stac_item.json",
-                    Body=data_string,
-                )
+    def indexer(self, scene: Scene) -> LandsatIndexer:
+        """
+        Index the scene with the quality assessment band
+        """
+        return LandsatIndexer(
+            scene.item, chip_max_nodata=0, local_hrefs=scene.local_hrefs
+        )
 
-                indexer = LandsatIndexer(item, chip_max_nodata=0)
-                chip_index = indexer.create_index()
 
-                writer = pa.BufferOutputStream()
-                io.write_geoparquet_table(chip_index, writer)
-                body = bytes(writer.getvalue())
-                # Centralize the index files to make combining them easier later on
-                s3_bucket.put_object(
-                    Body=body,
-                    Key=f"index/{platform_name}/{item.id}/index_{item.id}.parquet",
-                )
+def process_landsat_tile(index: int, sample_source: str, bucket: str) -> None:
+    LandsatPipeline(index, sample_source, bucket).run()
 
 
 def process() -> None:
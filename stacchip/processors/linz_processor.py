@@ -3,21 +3,28 @@ import os
 import random
 import tempfile
 from pathlib import Path
+from typing import Iterable, List
 
 import boto3
-import pyarrow as pa
+import numpy as np
 import rasterio
 from dateutil import parser
-from geoarrow.pyarrow import io
+from numpy.typing import ArrayLike
 from pystac import Item
 from rasterio.enums import Resampling
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
 from rio_stac import create_stac_item
 
 from stacchip.indexer import NoDataMaskChipIndexer
+from stacchip.processors.pipeline import IngestPipeline, Scene
+from stacchip.processors.transfer import upload_file
+from stacchip.utils import get_s3_client
 
 PLATFORM_NAME = "linz"
 
 TARGET_RESOLUTION = 0.3
+STRIP_SIZE = 512
 
 nz_prefixes = [
     "auckland/auckland_2022_0.075m/",
@@ -82,93 +89,138 @@ def get_linz_tiffs(prefix) -> list:
 
 
 def get_original_item(key: str) -> Item:
-    s3_resource = boto3.resource("s3")
-    content_object = s3_resource.Object(
-        "nz-imagery", key.replace(".tiff", "") + ".json"
+    # Resources are not thread safe, use the shared client
+    content_object = get_s3_client().get_object(
+        Bucket="nz-imagery", Key=key.replace(".tiff", "") + ".json"
     )
-    file_content = content_object.get()["Body"].read().decode("utf-8")
+    file_content = content_object["Body"].read().decode("utf-8")
     json_content = json.loads(file_content)
     return Item.from_dict(json_content)
 
 
-def process_linz_tile(index, bucket):
+def resample_tiff(
+    dataset: DatasetReader,
+    path: str,
+    resolution: float = TARGET_RESOLUTION,
+    strip_size: int = STRIP_SIZE,
+) -> ArrayLike:
+    """
+    Resample the RGB bands of a dataset into a tiled geotiff
+
+    The output is written strip by strip from windowed reads, so only one
+    strip of source and output pixels is held in memory. Returns the
+    nodata mask of the output, accumulated from the strips.
+    """
+    factor = abs(dataset.transform[0]) / resolution
+    height = int(dataset.height * factor)
+    width = int(dataset.width * factor)
+
+    # scale image transform
+    transform = dataset.transform * dataset.transform.scale(
+        (dataset.width / width), (dataset.height / height)
+    )
 
-    tiffs = get_linz_tiffs(nz_prefixes[index])
+    meta = dataset.meta.copy()
+    meta.update(
+        {
+            "driver": "GTiff",
+            "transform": transform,
+            "width": width,
+            "height": height,
+            # Drop alpha band if present
+            "count": 3,
+            "compress": "deflate",
+            "tiled": True,
+            "blockxsize": strip_size,
+            "blockysize": strip_size,
+        }
+    )
 
-    for key in tiffs:
+    nodata_mask = np.empty((height, width), dtype=bool)
+    source_rows_per_row = dataset.height / height
+    with rasterio.open(path, "w", **meta) as dst:
+        for row in range(0, height, strip_size):
+            rows = min(strip_size, height - row)
+            window = Window(
+                0,
+                row * source_rows_per_row,
+                dataset.width,
+                rows * source_rows_per_row,
+            )
+            strip = dataset.read(
+                [1, 2, 3],
+                window=window,
+                out_shape=(3, rows, width),
+                resampling=Resampling.bilinear,
+            )
+            dst.write(strip, window=Window(0, row, width, rows))
+            nodata_mask[row : row + rows] = strip[0] == 0
+
+    return nodata_mask
+
+
+class LinzPipeline(IngestPipeline):
+    """
+    Ingest a sample of the aerial imagery tiffs of a LINZ survey
+    """
+
+    def __init__(self, index: int, bucket: str, **kwargs) -> None:
+        """
+        Init LinzPipeline
+        """
+        super().__init__(bucket, job=index, **kwargs)
+        self.prefix = nz_prefixes[index]
+
+    def queries(self) -> Iterable[str]:
+        """
+        Keys of the sampled tiffs
+        """
+        return get_linz_tiffs(self.prefix)
+
+    def search(self, key: str) -> List[Scene]:
+        """
+        Load the original STAC item of a tiff
+        """
         print(f"Working on {key}")
+        return [Scene(item=get_original_item(key), platform=PLATFORM_NAME, source=key)]
 
-        href = f"s3://nz-imagery/{key}"
+    def transfer(self, scene: Scene) -> Scene:
+        """
+        Resample the tiff to the target resolution and upload it
+        """
+        href = f"s3://nz-imagery/{scene.source}"
+        original_item = scene.item
 
-        original_item = get_original_item(key)
+        new_key = f"{PLATFORM_NAME}/{original_item.id}/{Path(href).name}"
+        new_href = f"s3://{self.bucket}/{new_key}"
 
         # For now, resample so we have a constant gsd for all images
-        with rasterio.open(href) as dataset:
-
-            gsd = abs(dataset.transform[0])
+        with tempfile.NamedTemporaryFile(suffix=".tif") as temp_file:
+            with rasterio.open(href) as dataset:
+                nodata_mask = resample_tiff(dataset, temp_file.name)
 
-            upscale_factor = gsd / TARGET_RESOLUTION
+            upload_file(temp_file.name, self.bucket, new_key)
 
-            data = dataset.read(
-                out_shape=(
-                    dataset.count,
-                    int(dataset.height * upscale_factor),
-                    int(dataset.width * upscale_factor),
-                ),
-                resampling=Resampling.bilinear,
-            )
+            # Read the metadata from the local file instead of the upload
+            item = create_stac_item(temp_file.name, asset_href=new_href, with_proj=True)
 
-            # Drop alpha band if present
-            data = data[:3]
-
-            # scale image transform
-            transform = dataset.transform * dataset.transform.scale(
-                (dataset.width / data.shape[-1]), (dataset.height / data.shape[-2])
-            )
-
-            new_key = f"{PLATFORM_NAME}/{original_item.id}/{Path(href).name}"
-            new_href = f"s3://{bucket}/{new_key}"
-
-            meta = dataset.meta.copy()
-            meta["transform"] = transform
-            meta["width"] = data.shape[2]
-            meta["height"] = data.shape[1]
-            meta["compress"] = "deflate"
-            meta["count"] = 3
+        item.datetime = parser.parse(original_item.properties["start_datetime"])
+        item.id = original_item.id
 
-        with tempfile.NamedTemporaryFile(mode="w") as temp_file:
-            with rasterio.open(temp_file.name, "w", **meta) as dst:
-                dst.write(data)
+        return Scene(item=item, platform=PLATFORM_NAME, nodata_mask=nodata_mask)
 
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(temp_file.name, bucket, new_key)
+    def indexer(self, scene: Scene) -> NoDataMaskChipIndexer:
+        """
+        Index the scene with the nodata mask of the resampled tiff
+        """
+        # The mask is set in the transfer stage and released after indexing
+        if scene.nodata_mask is None:
+            raise ValueError(f"Scene {scene.item.id} has no nodata mask")
+        return NoDataMaskChipIndexer(scene.item, nodata_mask=scene.nodata_mask)
 
-        item = create_stac_item(new_href, with_proj=True)
-        item.datetime = parser.parse(original_item.properties["start_datetime"])
-        item.id = original_item.id
 
-        # Convert Dictionary to JSON String
-        data_string = json.dumps(item.to_dict())
-
-        # Upload JSON String to an S3 Object
-        s3 = boto3.resource("s3")
-        s3_bucket = s3.Bucket(name=bucket)
-        s3_bucket.put_object(
-            Key=f"{PLATFORM_NAME}/{item.id}/stac_item.json",
-            Body=data_string,
-        )
-
-        indexer = NoDataMaskChipIndexer(item, nodata_mask=data[0] == 0)
-        index = indexer.create_index()
-
-        writer = pa.BufferOutputStream()
-        io.write_geoparquet_table(index, writer)
-        body = bytes(writer.getvalue())
-        # Centralize the index files to make combining them easier later on
-        s3_bucket.put_object(
-            Body=body,
-            Key=f"index/{PLATFORM_NAME}/{item.id}/index_{item.id}.parquet",
-        )
+def process_linz_tile(index, bucket):
+    LinzPipeline(index, bucket).run()
 
 
 def process() -> None:
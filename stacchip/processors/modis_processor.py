@@ -1,19 +1,25 @@
 import calendar
-import json
 import os
-import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
 
-import boto3
+import numpy as np
 import planetary_computer as pc
-import pyarrow as pa
 import pystac_client
 import rasterio
-from geoarrow.pyarrow import io
+from affine import Affine
+from rasterio.io import MemoryFile
+from rasterio.transform import array_bounds
 from rasterio.warp import Resampling, calculate_default_transform, reproject
 
-from stacchip.indexer import ModisIndexer
+from stacchip.indexer import TARGET_CRS_PROPERTY, ModisIndexer
+from stacchip.processors.pipeline import IngestPipeline, Scene
+from stacchip.processors.transfer import upload_bytes, upload_tee
+from stacchip.utils import get_env_flag, get_s3_client
 
 STAC_API = "https://planetarycomputer.microsoft.com/api/stac/v1"
 COLLECTION = "modis-09A1-061"
@@ -266,53 +272,193 @@ SIN_GRID_TILES = [
     (14, 22),
 ]
 PLATFORM_NAME = "modis"
+QUALITY_BAND = "sur_refl_qc_500m"
 DST_CRS = "EPSG:3857"
+WARP_THREADS = 4
+COG_PROFILE = {
+    "driver": "COG",
+    "compress": "deflate",
+    "blocksize": 512,
+    # The chipper reads full resolution pixels only
+    "overviews": "NONE",
+}
 
 
-def process_modis_tile(
-    index: int,
-    bucket: str,
-) -> None:
+@lru_cache(maxsize=None)
+def get_target_grid(
+    crs: str, width: int, height: int, bounds: Tuple[float, float, float, float]
+) -> Tuple[Affine, int, int]:
+    """
+    Web mercator grid for a source grid
+
+    All items of a SIN tile are on the same grid, so the target grid is
+    only computed once per tile.
+    """
+    return calculate_default_transform(crs, DST_CRS, width, height, *bounds)
 
-    # Prepare resources for the job
-    catalog = pystac_client.Client.open(STAC_API, modifier=pc.sign_inplace)
 
-    s3 = boto3.resource("s3")
+def read_asset(href: str) -> Tuple[np.ndarray, dict]:
+    """
+    Read the pixels and profile of an asset
+    """
+    with rasterio.open(href) as src:
+        return src.read(), src.profile
 
-    i, j = SIN_GRID_TILES[index]
 
-    items_to_process = []
-    for year in range(2018, 2024):
-        for month in range(1, 13):
-            # Compute date range for this month
-            end = calendar.monthrange(year, month)[1]
-            timerange = (
-                f"{year}-{str(month).zfill(2)}-01/"
-                f"{year}-{str(month).zfill(2)}-{str(end).zfill(2)}"
+def warp_assets(
+    assets: Dict[str, Tuple[np.ndarray, dict]], num_threads: int = WARP_THREADS
+) -> Dict[str, Tuple[np.ndarray, dict]]:
+    """
+    Reproject assets to web mercator
+
+    Assets with the same grid, data type and nodata value are stacked
+    and warped in a single multi-threaded pass.
+    """
+    groups: Dict[tuple, List[str]] = {}
+    for key, (data, profile) in assets.items():
+        group = (
+            profile["crs"].to_wkt(),
+            profile["transform"],
+            profile["width"],
+            profile["height"],
+            data.dtype.str,
+            profile["nodata"],
+        )
+        groups.setdefault(group, []).append(key)
+
+    warped = {}
+    for (crs, src_transform, width, height, dtype, nodata), keys in groups.items():
+        bounds = array_bounds(height, width, src_transform)
+        transform, dst_width, dst_height = get_target_grid(crs, width, height, bounds)
+        source = np.concatenate([assets[key][0] for key in keys])
+        destination = np.full(
+            (len(source), dst_height, dst_width), nodata or 0, dtype=dtype
+        )
+        reproject(
+            source=source,
+            destination=destination,
+            src_transform=src_transform,
+            src_crs=crs,
+            src_nodata=nodata,
+            dst_transform=transform,
+            dst_crs=DST_CRS,
+            dst_nodata=nodata,
+            resampling=Resampling.nearest,
+            num_threads=num_threads,
+        )
+        offset = 0
+        for key in keys:
+            count = len(assets[key][0])
+            profile = assets[key][1].copy()
+            profile.update(
+                {
+                    "crs": DST_CRS,
+                    "transform": transform,
+                    "width": dst_width,
+                    "height": dst_height,
+                }
             )
-            # Query catalog
-            items = catalog.search(
-                collections=[COLLECTION],
-                datetime=timerange,
-                query={
-                    "modis:vertical-tile": {
-                        "eq": i,
-                    },
-                    "modis:horizontal-tile": {
-                        "eq": j,
-                    },
+            warped[key] = destination[offset : offset + count], profile
+            offset += count
+
+    return warped
+
+
+def write_cog(
+    data: np.ndarray, profile: dict, num_threads: int = WARP_THREADS
+) -> bytes:
+    """
+    Write pixels to a tiled cloud optimized geotiff in memory
+    """
+    profile = {
+        key: value
+        for key, value in profile.items()
+        if key not in ("blockxsize", "blockysize", "tiled", "interleave")
+    }
+    profile.update(COG_PROFILE)
+    profile["count"] = len(data)
+    profile["num_threads"] = num_threads
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(data)
+        return memfile.read()
+
+
+class ModisPipeline(IngestPipeline):
+    """
+    Ingest the monthly MODIS composites of a SIN grid tile
+    """
+
+    def __init__(
+        self,
+        index: int,
+        bucket: str,
+        warp_on_read: bool = False,
+        **kwargs,
+    ) -> None:
+        """
+        Init ModisPipeline
+        """
+        super().__init__(bucket, job=index, **kwargs)
+        self.catalog = pystac_client.Client.open(STAC_API, modifier=pc.sign_inplace)
+        self.tile = SIN_GRID_TILES[index]
+        self.warp_on_read = warp_on_read
+        self.warp_threads = int(
+            os.environ.get("STACCHIP_MODIS_WARP_THREADS", WARP_THREADS)
+        )
+
+    @staticmethod
+    def asset_key(item_id: str, href: str) -> str:
+        """
+        Key of an asset in the target bucket
+        """
+        return f"{PLATFORM_NAME}/{item_id}/{Path(href.split('?')[0]).name}"
+
+    def queries(self) -> Iterable[str]:
+        """
+        Monthly date ranges from 2018 to 2023
+        """
+        for year in range(2018, 2024):
+            for month in range(1, 13):
+                # Compute date range for this month
+                end = calendar.monthrange(year, month)[1]
+                yield (
+                    f"{year}-{str(month).zfill(2)}-01/"
+                    f"{year}-{str(month).zfill(2)}-{str(end).zfill(2)}"
+                )
+
+    def search(self, timerange: str) -> List[Scene]:
+        """
+        Search the composite of the tile for a month
+        """
+        i, j = self.tile
+        items = self.catalog.search(
+            collections=[COLLECTION],
+            datetime=timerange,
+            query={
+                "modis:vertical-tile": {
+                    "eq": i,
                 },
-                max_items=1,
-            )
-            items = list(items.item_collection())
+                "modis:horizontal-tile": {
+                    "eq": j,
+                },
+            },
+            max_items=1,
+        )
+        items = list(items.item_collection())
 
-            if not len(items):
-                print(f"No items found for timerange {timerange}")
-                continue
+        if not len(items):
+            print(f"No items found for timerange {timerange}")
+            return []
 
-            items_to_process.append(items[0])
+        return [Scene(item=items[0], platform=PLATFORM_NAME)]
 
-    for item in items_to_process:
+    def transfer(self, scene: Scene) -> Scene:
+        """
+        Reproject the bands to web mercator, or copy them as is if the
+        chipper warps on read
+        """
+        item = scene.item
         for key in list(item.assets.keys()):
             if key not in BANDS:
                 del item.assets[key]
@@ -323,69 +469,64 @@ def process_modis_tile(
             item.properties["end_datetime"], "%Y-%m-%dT%H:%M:%SZ"
         )
 
-        for key, asset in item.assets.items():
-            new_key = f"{PLATFORM_NAME}/{item.id}/{Path(asset.href.split('?')[0]).name}"
-            new_href = f"s3://{bucket}/{new_key}"
+        if self.warp_on_read:
+            for key, asset in item.assets.items():
+                new_key = self.asset_key(item.id, asset.href)
+                # Store the source file as is, the chipper warps it on read
+                print(f"Copying {key} in source projection")
+                with urllib.request.urlopen(asset.href) as response:
+                    if self.single_pass and key == QUALITY_BAND:
+                        local_path = scene.scratch_path(Path(new_key).name)
+                        upload_tee(response, local_path, self.bucket, new_key)
+                        scene.local_hrefs[key] = local_path
+                    else:
+                        get_s3_client().upload_fileobj(response, self.bucket, new_key)
+                item.assets[key].href = f"s3://{self.bucket}/{new_key}"
 
-            with rasterio.open(asset.href) as src:
-                transform, width, height = calculate_default_transform(
-                    src.crs, DST_CRS, src.width, src.height, *src.bounds
-                )
-                kwargs = src.meta.copy()
-                kwargs.update(
-                    {
-                        "crs": DST_CRS,
-                        "transform": transform,
-                        "width": width,
-                        "height": height,
-                        "compress": "deflate",
-                    }
-                )
-                with tempfile.NamedTemporaryFile(mode="w") as temp_file:
-                    with rasterio.open(temp_file.name, "w", **kwargs) as dst:
-                        for i in range(1, src.count + 1):
-                            reproject(
-                                source=rasterio.band(src, i),
-                                destination=rasterio.band(dst, i),
-                                src_transform=src.transform,
-                                src_crs=src.crs,
-                                dst_transform=transform,
-                                dst_crs=DST_CRS,
-                                resampling=Resampling.nearest,
-                            )
-                    s3_client = boto3.client("s3")
-                    s3_client.upload_file(temp_file.name, bucket, new_key)
-
-            item.assets[key].href = new_href
+            # Define the index on the target grid, keep source proj extension
+            item.properties[TARGET_CRS_PROPERTY] = DST_CRS
+            return scene
+
+        # Read all bands concurrently and warp them in one pass
+        keys = list(item.assets.keys())
+        with ThreadPoolExecutor(len(keys)) as executor:
+            assets = executor.map(read_asset, [item.assets[key].href for key in keys])
+            warped = warp_assets(dict(zip(keys, assets)), self.warp_threads)
+
+        for key, (data, profile) in warped.items():
+            new_key = self.asset_key(item.id, item.assets[key].href)
+            body = write_cog(data, profile, self.warp_threads)
+            upload_bytes(body, self.bucket, new_key)
+            item.assets[key].href = f"s3://{self.bucket}/{new_key}"
+            if self.single_pass and key == QUALITY_BAND:
+                local_path = scene.scratch_path(Path(new_key).name)
+                with open(local_path, "wb") as dst:
+                    dst.write(body)
+                scene.local_hrefs[key] = local_path
 
         # Update proj extension to match new data format
-        item.properties["proj:shape"] = (height, width)
+        item.properties["proj:shape"] = (profile["height"], profile["width"])
         item.properties["proj:epsg"] = 3857
         del item.properties["proj:wkt2"]
-        item.properties["proj:transform"] = transform
-
-        # Convert Dictionary to JSON String
-        data_string = json.dumps(item.to_dict())
+        item.properties["proj:transform"] = profile["transform"]
 
-        # Upload JSON String to an S3 Object
-        s3_bucket = s3.Bucket(name=bucket)
-        s3_bucket.put_object(
-            Key=f"{PLATFORM_NAME}/{item.id}/stac_item.json",
-            Body=data_string,
-        )
+        return scene
 
-        indexer = ModisIndexer(item)
-        index = indexer.create_index()
+    def indexer(self, scene: Scene) -> ModisIndexer:
+        """
+        Index the scene on the web mercator grid
+        """
+        indexer = ModisIndexer(scene.item, local_hrefs=scene.local_hrefs)
         print("Indexer info", indexer.x_size, indexer.y_size, indexer.shape)
+        return indexer
 
-        writer = pa.BufferOutputStream()
-        io.write_geoparquet_table(index, writer)
-        body = bytes(writer.getvalue())
-        # Centralize the index files to make combining them easier later on
-        s3_bucket.put_object(
-            Body=body,
-            Key=f"index/{PLATFORM_NAME}/{item.id}/index_{item.id}.parquet",
-        )
+
+def process_modis_tile(
+    index: int,
+    bucket: str,
+    warp_on_read: bool = False,
+) -> None:
+    ModisPipeline(index, bucket, warp_on_read=warp_on_read).run()
 
 
 def process() -> None:
@@ -397,5 +538,6 @@ def process() -> None:
 
     index = int(os.environ["AWS_BATCH_JOB_ARRAY_INDEX"])
     bucket = os.environ["STACCHIP_BUCKET"]
+    warp_on_read = get_env_flag("STACCHIP_MODIS_WARP_ON_READ")
 
-    process_modis_tile(index, bucket)
+    process_modis_tile(index, bucket, warp_on_read)
@@ -1,17 +1,14 @@
-import json
 import os
 import random
 from pathlib import Path
-from urllib.parse import urlparse
+from typing import Iterable, List
 
-import boto3
 import geopandas as gp
-import pyarrow as pa
 import pystac_client
-from botocore.exceptions import ClientError
-from geoarrow.pyarrow import io
 
 from stacchip.indexer import NoStatsChipIndexer
+from stacchip.processors.pipeline import IngestPipeline, Scene
+from stacchip.processors.transfer import Transfer, copy_objects
 
 STAC_API = "https://planetarycomputer.microsoft.com/api/stac/v1"
 
@@ -21,115 +18,109 @@ AWS_S3_URL = (
 PLATFORM_NAME = "naip"
 
 
-def process_naip_tile(
-    index: int, sample_source: str, bucket: str, latest_only: bool = False
-) -> None:
-    # Prepare resources for the job
-    catalog = pystac_client.Client.open(STAC_API)
-    s3 = boto3.resource("s3")
-    data = gp.read_file(sample_source)
-    row = data.iloc[index]
-
-    items = catalog.search(
-        collections=["naip"],
-        intersects=row.geometry.centroid,
-        sortby="properties.naip:year",
-        max_items=10,
-    )
-    items = list(items.item_collection())
-
-    if not len(items):
-        print(f"No items found, skipping index {index}")
-        return
-
-    latest_item = items.pop()
-    items_to_process = [latest_item]
-    if not latest_only:
-        random.seed(index)
-        random_item = random.choice(items)
-        items_to_process.append(random_item)
-
-    for item in items_to_process:
+class NaipPipeline(IngestPipeline):
+    """
+    Ingest the latest and a random NAIP scene for a sample location
+    """
+
+    def __init__(
+        self,
+        index: int,
+        sample_source: str,
+        bucket: str,
+        latest_only: bool = False,
+        **kwargs,
+    ) -> None:
+        """
+        Init NaipPipeline
+        """
+        super().__init__(bucket, job=index, **kwargs)
+        self.catalog = pystac_client.Client.open(STAC_API)
+        self.row = gp.read_file(sample_source).iloc[index]
+        self.seed = index
+        self.latest_only = latest_only
+
+    def queries(self) -> Iterable[int]:
+        """
+        All NAIP scenes of a location are found with a single search
+        """
+        return [self.seed]
+
+    def search(self, index: int) -> List[Scene]:
+        """
+        Search the latest scene and a random older one
+        """
+        items = self.catalog.search(
+            collections=["naip"],
+            intersects=self.row.geometry.centroid,
+            sortby="properties.naip:year",
+            max_items=10,
+        )
+        items = list(items.item_collection())
+
+        if not len(items):
+            print(f"No items found, skipping index {index}")
+            return []
+
+        latest_item = items.pop()
+        items_to_process = [latest_item]
+        if not self.latest_only and len(items):
+            random.seed(index)
+            random_item = random.choice(items)
+            items_to_process.append(random_item)
+
+        return [Scene(item=item, platform=PLATFORM_NAME) for item in items_to_process]
+
+    def transfer(self, scene: Scene) -> Scene:
+        """
+        Copy the image asset from the requester pays bucket
+        """
+        item = scene.item
         print(f"Processing item {item.id}")
+        transfers = {}
         for key in list(item.assets.keys()):
             if key != "image":
                 del item.assets[key]
                 continue
 
-            new_key = f"{PLATFORM_NAME}/{item.id}/{Path(item.assets[key].href).name}"
-            try:
-                href = AWS_S3_URL.format(
-                    year=item.properties["naip:year"],
-                    state=item.properties["naip:state"],
-                    resolution=f"{int(item.properties['gsd'] * 100)}cm",
-                    block=item.id.split("_")[2][:5],
-                    subblock=f"/{item.id.split('_')[2][5:]}",
-                    name=item.assets["image"].href.split("/")[-1],
-                )
-                url = urlparse(href)
-                copy_source = {
-                    "Bucket": "naip-analytic",
-                    "Key": url.path.lstrip("/"),
-                }
-                print(f"Copying {copy_source}")
-                s3.Object("naip-analytic", url.path.lstrip("/")).load(
-                    RequestPayer="requester"
-                )
-                s3.meta.client.copy(
-                    copy_source,
-                    bucket,
-                    new_key,
-                    ExtraArgs={"RequestPayer": "requester"},
-                )
-            except ClientError:
-                href = AWS_S3_URL.format(
+            # Some tiles are stored in a subblock folder, others are not
+            hrefs = [
+                AWS_S3_URL.format(
                     year=item.properties["naip:year"],
                     state=item.properties["naip:state"],
                     resolution=f"{int(item.properties['gsd'] * 100)}cm",
                     block=item.id.split("_")[2][:5],
-                    subblock="",
+                    subblock=subblock,
                     name=item.assets["image"].href.split("/")[-1],
                 )
-                url = urlparse(href)
-                copy_source = {
-                    "Bucket": "naip-analytic",
-                    "Key": url.path.lstrip("/"),
-                }
-                print(f"Failed, now copying {copy_source}")
-                s3.Object("naip-analytic", url.path.lstrip("/")).load(
-                    RequestPayer="requester"
-                )
-                s3.meta.client.copy(
-                    copy_source,
-                    bucket,
-                    new_key,
-                    ExtraArgs={"RequestPayer": "requester"},
-                )
-
-            item.assets[key].href = f"s3://{bucket}/{new_key}"
-
-        # Convert Dictionary to JSON String
-        data_string = json.dumps(item.to_dict())
-
-        # Upload JSON String to an S3 Object
-        s3_bucket = s3.Bucket(name=bucket)
-        s3_bucket.put_object(
-            Key=f"{PLATFORM_NAME}/{item.id}/stac_item.json",
-            Body=data_string,
-        )
-
-        indexer = NoStatsChipIndexer(item)
-        index = indexer.create_index()
+                for subblock in [f"/{item.id.split('_')[2][5:]}", ""]
+            ]
+            transfers[key] = Transfer(
+                source=hrefs[0],
+                bucket=self.bucket,
+                key=f"{PLATFORM_NAME}/{item.id}/{Path(item.assets[key].href).name}",
+                requester_pays=True,
+                fallbacks=tuple(hrefs[1:]),
+            )
+        copy_objects(transfers.values())
+        for key, transfer in transfers.items():
+            item.assets[key].href = transfer.href
+
+        return scene
+
+    def indexer(self, scene: Scene) -> NoStatsChipIndexer:
+        """
+        Index the scene without nodata statistics
+        """
+        indexer = NoStatsChipIndexer(scene.item)
         print("Indexer info", indexer.x_size, indexer.y_size, indexer.shape)
+        return indexer
 
-        writer = pa.BufferOutputStream()
-        io.write_geoparquet_table(index, writer)
-        body = bytes(writer.getvalue())
-        # Centralize the index files to make combining them easier later on
-        s3_bucket.put_object(
-            Body=body,
-            Key=f"index/{PLATFORM_NAME}/{item.id}/index_{item.id}.parquet",
-        )
+
+def process_naip_tile(
+    index: int, sample_source: str, bucket: str, latest_only: bool = False
+) -> None:
+    NaipPipeline(index, sample_source, bucket, latest_only=latest_only).run()
 
 
 def process() -> None:
@@ -0,0 +1,303 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from itertools import islice
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, Iterable, List, Optional
+from uuid import uuid4
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from geoarrow.pyarrow import io
+from numpy.typing import ArrayLike
+from pystac import Item
+
+from stacchip.indexer import ChipIndexer
+from stacchip.utils import catalog_table, get_env_flag, get_s3_client
+
+SEARCH_WORKERS = 4
+TRANSFER_WORKERS = 2
+INDEX_WORKERS = 2
+STAGES = ("search", "transfer", "index")
+
+
+@dataclass
+class Scene:
+    """
+    STAC item that moves through the stages of an ingest pipeline
+
+    The source and nodata mask can be set by the processors to pass
+    information from the transfer to the index stage. Local copies of
+    assets that are written to the scratch folder of the scene are
+    used by the indexer, and removed once the scene is indexed.
+    """
+
+    item: Item
+    platform: str
+    source: Any = None
+    nodata_mask: Optional[ArrayLike] = None
+    local_hrefs: Dict[str, str] = field(default_factory=dict)
+    scratch: Optional[TemporaryDirectory] = None
+
+    def scratch_path(self, name: str) -> str:
+        """
+        Path in the scratch folder of the scene
+        """
+        if self.scratch is None:
+            self.scratch = TemporaryDirectory(prefix="stacchip-")
+        return os.path.join(self.scratch.name, name)
+
+    def cleanup(self) -> None:
+        """
+        Release the nodata mask and remove the local copies
+        """
+        self.nodata_mask = None
+        self.local_hrefs = {}
+        if self.scratch is not None:
+            self.scratch.cleanup()
+            self.scratch = None
+
+
+@dataclass
+class StageTimer:
+    """
+    Number of calls and cumulative time spent in each pipeline stage
+    """
+
+    calls: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(STAGES, 0))
+    seconds: Dict[str, float] = field(
+        default_factory=lambda: dict.fromkeys(STAGES, 0.0)
+    )
+
+    def __str__(self) -> str:
+        """
+        Summary of the stage timings for logging
+        """
+        return ", ".join(
+            f"{stage} {self.calls[stage]}x {self.seconds[stage]:.1f}s"
+            for stage in STAGES
+        )
+
+
+class IngestPipeline:
+    """
+    Search, transfer and index STAC items with overlapping stages
+
+    Processors subclass the pipeline and implement the hooks for their
+    platform. The queries are searched, the resulting scenes are
+    transferred and finally the item and index files are written to the
+    bucket. Each stage runs in its own thread pool, so that the stages of
+    different scenes overlap. The catalog rows of all indexed scenes are
+    written as one file per job and platform at the end of the run.
+
+    The number of scenes in flight is bounded by the total number of
+    workers, so that large jobs do not hold all transferred scenes in
+    memory at once.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        search_workers: Optional[int] = None,
+        transfer_workers: Optional[int] = None,
+        index_workers: Optional[int] = None,
+        single_pass: Optional[bool] = None,
+        client=None,
+        job: Optional[int] = None,
+    ) -> None:
+        """
+        Init IngestPipeline
+
+        In single pass mode, assets that are needed by the indexer are
+        streamed through the local machine once. They are uploaded and
+        written to local scratch at the same time, and the indexer reads
+        the local copies. It defaults to the STACCHIP_SINGLE_PASS env var.
+
+        The job number names the catalog file of the run, so that reruns
+        of a job replace their catalog file.
+        """
+        self.bucket = bucket
+        self.job = uuid4().hex if job is None else job
+        if single_pass is None:
+            single_pass = get_env_flag("STACCHIP_SINGLE_PASS")
+        self.single_pass = single_pass
+        self.search_workers = search_workers or int(
+            os.environ.get("STACCHIP_INGEST_SEARCH_WORKERS", SEARCH_WORKERS)
+        )
+        self.transfer_workers = transfer_workers or int(
+            os.environ.get("STACCHIP_INGEST_TRANSFER_WORKERS", TRANSFER_WORKERS)
+        )
+        self.index_workers = index_workers or int(
+            os.environ.get("STACCHIP_INGEST_INDEX_WORKERS", INDEX_WORKERS)
+        )
+        self._client = client
+        self.timer = StageTimer()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        S3 client used to write the output files
+        """
+        if self._client is None:
+            self._client = get_s3_client()
+        return self._client
+
+    def queries(self) -> Iterable[Any]:
+        """
+        Queries to search for scenes, for instance dates or source keys
+        """
+        raise NotImplementedError
+
+    def search(self, query: Any) -> List[Scene]:
+        """
+        Search the scenes for a query, returns an empty list to skip it
+        """
+        raise NotImplementedError
+
+    def transfer(self, scene: Scene) -> Optional[Scene]:
+        """
+        Transfer the assets of a scene into the bucket
+
+        Returns the scene with updated asset hrefs, or None to skip it.
+        """
+        raise NotImplementedError
+
+    def indexer(self, scene: Scene) -> ChipIndexer:
+        """
+        Create the chip indexer for a transferred scene
+        """
+        raise NotImplementedError
+
+    def put_table(self, table: pa.Table, key: str, geoparquet: bool = False):
+        """
+        Write a table as parquet file to the bucket
+        """
+        writer = pa.BufferOutputStream()
+        if geoparquet:
+            io.write_geoparquet_table(table, writer)
+        else:
+            pq.write_table(table, writer)
+        self.client.put_object(
+            Bucket=self.bucket, Key=key, Body=bytes(writer.getvalue())
+        )
+
+    def index(self, scene: Scene) -> Scene:
+        """
+        Write the STAC item and chip index of a scene
+        """
+        try:
+            self.write(scene)
+        finally:
+            # The scene is kept until the pipeline finished
+            scene.cleanup()
+        return scene
+
+    def write(self, scene: Scene) -> None:
+        """
+        Write the output files of a scene to the bucket
+        """
+        item = scene.item
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=f"{scene.platform}/{item.id}/stac_item.json",
+            Body=json.dumps(item.to_dict()),
+        )
+        # Centralize the index files to make combining them easier later on
+        self.put_table(
+            self.indexer(scene).create_index(),
+            f"index/{scene.platform}/{item.id}/index_{item.id}.parquet",
+            geoparquet=True,
+        )
+        print(f"Indexed {scene.platform} item {item.id}")
+
+    def write_catalog(self, scenes: List[Scene]) -> None:
+        """
+        Write the catalog rows of the indexed scenes, one file per platform
+
+        Writing one file per job instead of one per item keeps the number
+        of files to read for the consolidated catalog small.
+        """
+        platforms: Dict[str, List[Item]] = {}
+        for scene in scenes:
+            platforms.setdefault(scene.platform, []).append(scene.item)
+        for platform, items in platforms.items():
+            self.put_table(
+                catalog_table(items, platform),
+                f"catalog/{platform}/catalog_job_{self.job}.parquet",
+            )
+
+    def _timed(self, stage: str, func, arg):
+        start = time.perf_counter()
+        try:
+            return func(arg)
+        finally:
+            with self._lock:
+                self.timer.calls[stage] += 1
+                self.timer.seconds[stage] += time.perf_counter() - start
+
+    def run(self) -> List[Scene]:
+        """
+        Run the pipeline and return the indexed scenes
+        """
+        pools = {
+            "search": ThreadPoolExecutor(self.search_workers),
+            "transfer": ThreadPoolExecutor(self.transfer_workers),
+            "index": ThreadPoolExecutor(self.index_workers),
+        }
+        hooks = {
+            "search": self.search,
+            "transfer": self.transfer,
+            "index": self.index,
+        }
+        max_pending = self.search_workers + self.transfer_workers + self.index_workers
+
+        def submit(stage: str, arg: Any) -> None:
+            future = pools[stage].submit(self._timed, stage, hooks[stage], arg)
+            pending[future] = stage
+
+        queries = iter(self.queries())
+        pending: Dict[Any, str] = {}
+        indexed = []
+        start = time.perf_counter()
+        failed = True
+        try:
+            while True:
+                # Only start new searches if there is capacity downstream
+                for query in islice(queries, max(max_pending - len(pending), 0)):
+                    submit("search", query)
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = pending.pop(future)
+                    result = future.result()
+                    if stage == "search":
+                        for scene in result:
+                            submit("transfer", scene)
+                    elif stage == "transfer" and result is not None:
+                        submit("index", result)
+                    elif stage == "index":
+                        indexed.append(result)
+            failed = False
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True, cancel_futures=True)
+            if not failed:
+                self.write_catalog(indexed)
+            else:
+                # Scenes indexed before a failure are added to the catalog too,
+                # without replacing the error of the failed stage
+                try:
+                    self.write_catalog(indexed)
+                except Exception as e:
+                    print(f"Writing the catalog after a failed run failed: {e!r}")
+
+        print(
+            f"Indexed {len(indexed)} scenes in {time.perf_counter() - start:.1f}s"
+            f" ({self.timer})"
+        )
+        return indexed
@@ -1,97 +1,451 @@
-import datetime
-import math
+import hashlib
 import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
 from io import BytesIO
 from multiprocessing import Pool
-from typing import Union
+from multiprocessing.pool import Pool as PoolType
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Iterator, List, Optional, Tuple
 
-import boto3
 import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
 from pyarrow import dataset as da
 
 from stacchip.chipper import Chipper
-from stacchip.utils import load_indexer_s3
+from stacchip.indexer import (
+    ENCODING_COLUMNS,
+    get_space_time_encodings,
+    space_time_encodings_from_table,
+)
+from stacchip.processors.bands import get_platform_bands
+from stacchip.processors.cube_formats import CubeFormat, get_cube_format
+from stacchip.utils import get_env_flag, get_s3_client, load_indexer_s3
 
 VERSION = "mode_v1_chipper_v2"
 
 CUBESIZE = 128
 
-S2_BANDS = [
-    "blue",
-    "green",
-    "red",
-    "rededge1",
-    "rededge2",
-    "rededge3",
-    "nir",
-    "nir08",
-    "swir16",
-    "swir22",
+CHIPSIZE = 256
+
+ITEM_BATCH_SIZE = 16
+
+
+MANIFEST_SCHEMA = pa.schema(
+    [
+        pa.field("cube_id", pa.int64()),
+        pa.field("key", pa.string()),
+        pa.field("chipids", pa.list_(pa.string())),
+        pa.field("item_ids", pa.list_(pa.string())),
+        pa.field("size", pa.int64()),
+        pa.field("checksum", pa.string()),
+        pa.field("verified", pa.bool_()),
+    ]
+)
+
+INDEX_COLUMNS = [
+    "chipid",
+    "platform",
+    "item_id",
+    "date",
+    "chip_index_x",
+    "chip_index_y",
 ]
-LS_BANDS = [
-    "red",
-    "green",
-    "blue",
-    "nir08",
-    "swir16",
-    "swir22",
-]
-NAIP_BANDS = ["red", "green", "blue", "nir"]
-LINZ_BANDS = ["red", "green", "blue"]
-S1_BANDS = ["vv", "vh"]
-MODIS_BANDS = [
-    "sur_refl_b01",
-    "sur_refl_b02",
-    "sur_refl_b03",
-    "sur_refl_b04",
-    "sur_refl_b05",
-    "sur_refl_b06",
-    "sur_refl_b07",
-]
-
-
-def normalize_timestamp(date):
 
-    week = date.isocalendar().week * 2 * np.pi / 52
-    hour = date.hour * 2 * np.pi / 24
 
-    return (math.sin(week), math.cos(week)), (math.sin(hour), math.cos(hour))
+def get_job_rows(
+    row_count: int, start: int, count: int, seed: int = 42, chunk_size: int = 2**20
+) -> np.ndarray:
+    """
+    Rows of the deterministic random sample for one job
+
+    Draws the same sample as generating ``row_count`` random rows at once,
+    but skips the rows of previous jobs in chunks to keep memory bounded.
+    """
+    if start >= row_count:
+        return np.empty(0, dtype="int64")
+
+    random_state = np.random.RandomState(seed)
+    skipped = 0
+    while skipped < start:
+        step = min(chunk_size, start - skipped)
+        random_state.randint(0, row_count, step)
+        skipped += step
+    return random_state.randint(0, row_count, min(count, row_count - start))
+
+
+@dataclass(frozen=True)
+class CubeBuffer:
+    """
+    Cube-shaped pixel array in shared memory, addressed by chip slot
+
+    Workers write chip pixels directly into the buffer and only return
+    small metadata, avoiding pickling pixels back to the parent process.
+    """
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str = "float32"
+
+    @classmethod
+    def create(
+        cls, shape: Tuple[int, ...], dtype: str = "float32"
+    ) -> Tuple["CubeBuffer", SharedMemory]:
+        """
+        Allocate a new buffer, the caller owns and has to unlink the memory
+        """
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        shm = SharedMemory(create=True, size=size)
+        return cls(name=shm.name, shape=tuple(shape), dtype=dtype), shm
+
+    def array(self, shm: SharedMemory) -> np.ndarray:
+        """
+        Array view on the shared memory of this buffer
+        """
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+
+    def write(self, slot: int, pixels: np.ndarray) -> None:
+        """
+        Write the pixels of one chip into its slot
+        """
+        shm = SharedMemory(name=self.name)
+        try:
+            cube = self.array(shm)
+            cube[slot] = pixels
+            # Release the view before closing the memory
+            del cube
+        finally:
+            shm.close()
+
+
+def compress_cube(
+    pixels: np.ndarray,
+    encodings: Dict[str, np.ndarray],
+    cube_format: Optional[CubeFormat] = None,
+    chipids: Optional[List[str]] = None,
+    item_ids: Optional[List[str]] = None,
+) -> bytes:
+    """
+    Compress the pixels and space/time encodings of a cube
+
+    Uses the npz format by default. Chip and item ids are added to the
+    cube if provided.
+    """
+    arrays = {"pixels": pixels, **encodings}
+    if chipids is not None:
+        arrays["chipid"] = np.array(chipids, dtype=str)
+    if item_ids is not None:
+        arrays["item_id"] = np.array(item_ids, dtype=str)
+
+    if cube_format is None:
+        cube_format = CubeFormat()
+    return cube_format.encode(arrays)
+
+
+def get_cube_key(cube_id: int, platform: str, extension: str = "npz") -> str:
+    """
+    Key of a cube in the chip bucket
+    """
+    return f"{VERSION}/{platform}/cube_{cube_id}.{extension}"
+
+
+def upload_cube(
+    content: bytes,
+    cube_id: int,
+    chip_bucket: str,
+    platform: str,
+    extension: str = "npz",
+):
+    """
+    Upload a compressed cube
+    """
+    key = get_cube_key(cube_id, platform, extension)
 
+    client = get_s3_client()
+    with BytesIO(content) as bytes:
+        client.upload_fileobj(Fileobj=bytes, Bucket=chip_bucket, Key=key)
 
-def normalize_latlon(bounds):
-    lon = bounds[0] + (bounds[2] - bounds[0]) / 2
-    lat = bounds[1] + (bounds[3] - bounds[1]) / 2
 
-    lat = lat * np.pi / 180
-    lon = lon * np.pi / 180
+class CubeManifest:
+    """
+    Parquet manifest of the cubes written by a prechip job
+
+    Records the chip and item ids, the size and the sha256 checksum of
+    every cube. The manifest is rewritten after each cube, so that a
+    rerun of the job can skip the cubes that are already complete. Cubes
+    that were found in the bucket but not written by the job are recorded
+    as unverified, without chip and item ids.
+    """
+
+    def __init__(self, bucket: str, key: str, client=None) -> None:
+        """
+        Init CubeManifest
+        """
+        self.bucket = bucket
+        self.key = key
+        self.client = get_s3_client() if client is None else client
+        self.rows: Dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """
+        Load the rows of an existing manifest
+        """
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return
+            raise
+        table = pq.read_table(pa.BufferReader(response["Body"].read()))
+        with self._lock:
+            for row in table.to_pylist():
+                self.rows[row["cube_id"]] = row
+
+    def __contains__(self, cube_id: int) -> bool:
+        """
+        Check if a cube is complete
+        """
+        with self._lock:
+            return cube_id in self.rows
+
+    def add(
+        self,
+        cube_id: int,
+        key: str,
+        chipids: List[str],
+        item_ids: List[str],
+        size: int,
+        checksum: Optional[str] = None,
+        verified: bool = True,
+    ) -> None:
+        """
+        Add a complete cube and write the manifest
+        """
+        with self._lock:
+            self.rows[cube_id] = {
+                "cube_id": cube_id,
+                "key": key,
+                "chipids": chipids,
+                "item_ids": item_ids,
+                "size": size,
+                "checksum": checksum,
+                "verified": verified,
+            }
+            table = pa.Table.from_pylist(
+                [self.rows[cube_id] for cube_id in sorted(self.rows)],
+                schema=MANIFEST_SCHEMA,
+            )
+            sink = pa.BufferOutputStream()
+            pq.write_table(table, sink)
+            self.client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=sink.getvalue().to_pybytes()
+            )
 
-    return (math.sin(lat), math.cos(lat)), (math.sin(lon), math.cos(lon))
 
+def cube_size(client, bucket: str, key: str) -> Optional[int]:
+    """
+    Size of an existing cube, None if the cube does not exist
+    """
+    try:
+        return client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+
+
+class CubePipeline:
+    """
+    Compresses and uploads cubes in a background thread
+
+    Cubes are filled into a rotating set of shared memory buffers, so that
+    fetching the chips of the next cube overlaps with writing the previous
+    ones. The depth bounds the number of cubes queued for writing, and
+    the fetch stage blocks when no buffer is free. The time spent in
+    each stage is accumulated in the timings.
+    """
+
+    def __init__(
+        self,
+        shape: Tuple[int, ...],
+        chip_bucket: str,
+        platform: str,
+        depth: int = 1,
+        cube_format: Optional[CubeFormat] = None,
+        manifest: Optional[CubeManifest] = None,
+        dtype: str = "float32",
+    ) -> None:
+        """
+        Init CubePipeline
+        """
+        self.manifest = manifest
+        self.chip_bucket = chip_bucket
+        self.platform = platform
+        self.cube_format = CubeFormat() if cube_format is None else cube_format
+        self.timings: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+        self._error: Optional[BaseException] = None
+        # One buffer is filled while up to depth buffers are being written
+        self._buffers = [CubeBuffer.create(shape, dtype) for _ in range(depth + 1)]
+        self._free: queue.Queue = queue.Queue()
+        for buffer in self._buffers:
+            self._free.put(buffer)
+        self._queue: queue.Queue = queue.Queue(maxsize=depth)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Start the writer thread
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """
+        Add the time spent in the context to a stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.timings[stage] += time.perf_counter() - start
+
+    def acquire(self) -> Tuple[CubeBuffer, SharedMemory]:
+        """
+        Get a free buffer to fill, waiting for the writer if necessary
+        """
+        self._raise()
+        with self.timer("wait"):
+            return self._free.get()
+
+    def release(self, buffer: Tuple[CubeBuffer, SharedMemory]) -> None:
+        """
+        Return a buffer without writing it
+        """
+        self._free.put(buffer)
+
+    def submit(
+        self,
+        encodings: Dict[str, np.ndarray],
+        cube_id: int,
+        buffer: Tuple[CubeBuffer, SharedMemory],
+        chipids: Optional[List[str]] = None,
+        item_ids: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Queue a filled buffer for compression and upload
+        """
+        self._raise()
+        with self.timer("wait"):
+            self._queue.put((encodings, cube_id, buffer, chipids, item_ids))
+
+    def close(self) -> None:
+        """
+        Wait for all queued cubes to be written and free the buffers
+        """
+        try:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+        finally:
+            for _, shm in self._buffers:
+                shm.close()
+                shm.unlink()
+        self._raise()
+
+    def _raise(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("Writing cube failed") from self._error
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            encodings, cube_id, buffer, chipids, item_ids = job
+            try:
+                if self._error is None:
+                    self._write(encodings, cube_id, buffer, chipids, item_ids)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._free.put(buffer)
+
+    def _write(
+        self,
+        encodings: Dict[str, np.ndarray],
+        cube_id: int,
+        buffer: Tuple[CubeBuffer, SharedMemory],
+        chipids: Optional[List[str]],
+        item_ids: Optional[List[str]],
+    ) -> None:
+        print(f"Writing cube {cube_id}")
+        cube_buffer, shm = buffer
+        pixels = cube_buffer.array(shm)
+        try:
+            with self.timer("compress"):
+                content = compress_cube(
+                    pixels, encodings, self.cube_format, chipids, item_ids
+                )
+        finally:
+            del pixels
+        with self.timer("upload"):
+            upload_cube(
+                content,
+                cube_id,
+                self.chip_bucket,
+                self.platform,
+                self.cube_format.extension,
+            )
+        if self.manifest is not None:
+            with self.timer("manifest"):
+                self.manifest.add(
+                    cube_id,
+                    get_cube_key(cube_id, self.platform, self.cube_format.extension),
+                    chipids or [],
+                    item_ids or [],
+                    len(content),
+                    hashlib.sha256(content).hexdigest(),
+                )
 
-def stack_chips(chips: list, cube_id: int, chip_bucket: str, platform: str):
-    print(f"Writing cube {cube_id}")
 
-    pixels = np.stack([chip["pixels"] for chip in chips], dtype="float32")
-    lon_norm = np.vstack([chip["lon_norm"] for chip in chips], dtype="float32")
-    lat_norm = np.vstack([chip["lat_norm"] for chip in chips], dtype="float32")
-    week_norm = np.vstack([chip["week_norm"] for chip in chips], dtype="float32")
-    hour_norm = np.vstack([chip["hour_norm"] for chip in chips], dtype="float32")
+def get_chip_data(
+    chipper: Chipper,
+    platform: str,
+    item_id: str,
+    chip_index_x: int,
+    chip_index_y: int,
+    buffer: Optional[CubeBuffer] = None,
+    slot: Optional[int] = None,
+) -> Optional[dict]:
+    spec = get_platform_bands(platform)
+    if any(key not in chipper.indexer.item.assets for key in spec.assets):
+        return None
 
-    key = f"{VERSION}/{platform}/cube_{cube_id}.npz"
+    chip = chipper.chip(chip_index_x, chip_index_y)
+    pixels = spec.stack(chip)
 
-    client = boto3.client("s3")
-    with BytesIO() as bytes:
-        np.savez_compressed(
-            file=bytes,
-            pixels=pixels,
-            lon_norm=lon_norm,
-            lat_norm=lat_norm,
-            week_norm=week_norm,
-            hour_norm=hour_norm,
+    if len(pixels) != len(spec.bands):
+        raise ValueError(
+            f"Pixels shape {pixels.shape} is not equal to nr of bands {spec.bands} for item {item_id}"
         )
-        bytes.seek(0)
-        client.upload_fileobj(Fileobj=bytes, Bucket=chip_bucket, Key=key)
+
+    data: dict = {}
+    if buffer is None:
+        data["pixels"] = pixels
+    else:
+        buffer.write(slot, pixels)
+    return data
 
 
 def get_chip(
@@ -99,9 +453,10 @@ def get_chip(
     row: int,
     platform: str,
     item_id: str,
-    date: Union[datetime.date, datetime.datetime],
     chip_index_x: int,
     chip_index_y: int,
+    buffer: Optional[CubeBuffer] = None,
+    slot: Optional[int] = None,
 ):
     print(
         "Getting chip",
@@ -109,7 +464,6 @@ def get_chip(
         row,
         platform,
         item_id,
-        date,
         chip_index_x,
         chip_index_y,
     )
@@ -119,51 +473,93 @@ def get_chip(
         platform=platform,
         item_id=item_id,
     )
-    chipper = Chipper(indexer)
+    chipper = Chipper(indexer, assets=list(get_platform_bands(platform).assets))
 
-    chip = chipper.chip(chip_index_x, chip_index_y)
+    return get_chip_data(
+        chipper, platform, item_id, chip_index_x, chip_index_y, buffer, slot
+    )
 
-    if platform == "naip":
-        pixels = chip["image"]
-        bands = NAIP_BANDS
-    elif platform == "linz":
-        pixels = chip["asset"]
-        bands = LINZ_BANDS
-    elif platform == "sentinel-2-l2a":
-        pixels = np.vstack([chip[band] for band in S2_BANDS])
-        bands = S2_BANDS
-    elif platform in ["landsat-c2l2-sr", "landsat-c2l1"]:
-        pixels = np.vstack([chip[band] for band in LS_BANDS])
-        bands = LS_BANDS
-    elif platform == "sentinel-1-rtc":
-        if any(band not in chip for band in S1_BANDS):
-            return
-        pixels = np.vstack([chip[band] for band in S1_BANDS])
-        bands = S1_BANDS
-    elif platform == "modis":
-        pixels = np.vstack([chip[band] for band in MODIS_BANDS])
-        bands = MODIS_BANDS
-
-    if len(pixels) != len(bands):
-        raise ValueError(
-            f"Pixels shape {pixels.shape} is not equal to nr of bands {bands} for item {item_id}"
-        )
 
-    if isinstance(date, datetime.date):
-        # Assume noon for dates without timestamp
-        date = datetime.datetime(date.year, date.month, date.day, 12)
-    week_norm, hour_norm = normalize_timestamp(date)
+def get_item_chips(
+    data_bucket: str,
+    platform: str,
+    item_id: str,
+    chips: List[Tuple[int, int, int]],
+    buffer: Optional[CubeBuffer] = None,
+) -> List[Tuple[int, Optional[dict]]]:
+    """
+    Get all chips of a cube that come from the same item
+
+    The chips are given as tuples of cube slot and chip indices. The
+    item is loaded once and its assets are kept open for all chips. If a
+    buffer is passed, pixels are written into it instead of returned.
+    """
+    print(f"Getting {len(chips)} chips from item {item_id}")
+
+    indexer = load_indexer_s3(
+        bucket=data_bucket,
+        platform=platform,
+        item_id=item_id,
+    )
+    result = []
+    with Chipper(
+        indexer, assets=list(get_platform_bands(platform).assets), keep_open=True
+    ) as chipper:
+        # Read chips row by row for locality within the assets
+        for slot, chip_index_x, chip_index_y in sorted(
+            chips, key=lambda chip: (chip[2], chip[1])
+        ):
+            result.append(
+                (
+                    slot,
+                    get_chip_data(
+                        chipper,
+                        platform,
+                        item_id,
+                        chip_index_x,
+                        chip_index_y,
+                        buffer,
+                        slot,
+                    ),
+                )
+            )
+    return result
+
+
+def get_cube_chips(
+    all_chips: list,
+    pool: PoolType,
+    buffer: Optional[CubeBuffer] = None,
+    batch_size: int = ITEM_BATCH_SIZE,
+) -> list:
+    """
+    Get the chips of a cube grouped by item, in the order of the input chips
+
+    Items with more than batch size chips are split into batches in grid
+    order, so that the chips of large items are read by multiple workers.
+    """
+    groups: Dict[Tuple[str, str, str], list] = {}
+    for slot, (data_bucket, _, platform, item_id, x, y) in enumerate(all_chips):
+        groups.setdefault((data_bucket, platform, item_id), []).append((slot, x, y))
+
+    batches = []
+    for key, chips in groups.items():
+        chips = sorted(chips, key=lambda chip: (chip[2], chip[1]))
+        for start in range(0, len(chips), batch_size):
+            batches.append((*key, chips[start : start + batch_size], buffer))
+    print(
+        f"Getting {len(all_chips)} chips from {len(groups)} items"
+        f" in {len(batches)} batches"
+    )
 
-    bounds = chipper.indexer.get_chip_bbox(chip_index_x, chip_index_y).bounds
-    lon_norm, lat_norm = normalize_latlon(bounds)
+    results = pool.starmap(get_item_chips, batches, chunksize=1)
 
-    return {
-        "pixels": pixels,
-        "lon_norm": lon_norm,
-        "lat_norm": lat_norm,
-        "week_norm": week_norm,
-        "hour_norm": hour_norm,
-    }
+    # Restore the shuffled order of the chips
+    data: list = [None] * len(all_chips)
+    for item_chips in results:
+        for slot, chip in item_chips:
+            data[slot] = chip
+    return data
 
 
 def process() -> None:
@@ -188,61 +584,140 @@ def process() -> None:
     cubes_per_job = int(os.environ.get("STACCHIP_CUBES_PER_JOB", 10))
     pool_size = int(os.environ.get("STACCHIP_POOL_SIZE", 10))
     chip_max_nodata = float(os.environ.get("STACCHIP_MAX_NODATA", 0.05))
-
-    # Open table
-    table = da.dataset(indexpath, format="parquet").to_table(
-        columns=[
-            "chipid",
-            "platform",
-            "item_id",
-            "date",
-            "chip_index_x",
-            "chip_index_y",
-            "nodata_percentage",
-        ]
-    )
+    group_by_item = get_env_flag("STACCHIP_GROUP_BY_ITEM", True)
+    pipeline_depth = int(os.environ.get("STACCHIP_PIPELINE_DEPTH", 1))
+    item_batch_size = int(os.environ.get("STACCHIP_ITEM_BATCH_SIZE", ITEM_BATCH_SIZE))
+    cube_format = get_cube_format(os.environ.get("STACCHIP_CUBE_FORMAT", "npz"))
+    skip_existing = get_env_flag("STACCHIP_SKIP_EXISTING", True)
+
+    # Count rows without loading the index, only the filter columns are read
+    dataset = da.dataset(indexpath, format="parquet")
+    row_filter = None
     if platform:
-        table = table.filter(pa.compute.field("platform") == platform)
-
-    initial_count = len(table)
+        row_filter = pc.field("platform") == platform
+    initial_count = dataset.count_rows(filter=row_filter)
     if chip_max_nodata:
-        table = table.filter(pa.compute.field("nodata_percentage") <= chip_max_nodata)
+        nodata_filter = pc.field("nodata_percentage") <= chip_max_nodata
+        row_filter = nodata_filter if row_filter is None else row_filter & nodata_filter
+    row_count = dataset.count_rows(filter=row_filter)
     print(
-        f"Dropped {initial_count - len(table)} chips due to nodata filter, keeping {len(table)}"
+        f"Dropped {initial_count - row_count} chips due to nodata filter, keeping {row_count}"
     )
+    if not row_count:
+        print("No chips left after filtering")
+        return
 
-    np.random.seed(42)
-    random_rows = np.random.randint(0, len(table), len(table))
-
-    for cube_id in range(index * cubes_per_job, (index + 1) * cubes_per_job):
-        random_rows_cube = random_rows[cube_id * CUBESIZE : (cube_id + 1) * CUBESIZE]
-        if len(random_rows_cube) != CUBESIZE:
-            print("Finishing because of incomplete cubes")
-            return
-
-        # Extract chips data for this job
-        all_chips = []
-        for row in random_rows_cube:
-            all_chips.append(
-                (
-                    data_bucket,
-                    row,
-                    table.column("platform")[row].as_py(),
-                    table.column("item_id")[row].as_py(),
-                    table.column("date")[row].as_py(),
-                    table.column("chip_index_x")[row].as_py(),
-                    table.column("chip_index_y")[row].as_py(),
-                )
-            )
-
+    # Read only the rows sampled for the cubes of this job
+    random_rows = get_job_rows(
+        row_count, index * cubes_per_job * CUBESIZE, cubes_per_job * CUBESIZE
+    )
+    # Use the space/time encodings of the index if present, otherwise they
+    # are computed from the geometry for all rows of the job at once.
+    stored_encodings = set(ENCODING_COLUMNS).issubset(dataset.schema.names)
+    columns = INDEX_COLUMNS + (ENCODING_COLUMNS if stored_encodings else ["geometry"])
+    unique_rows, inverse = np.unique(random_rows, return_inverse=True)
+    job_table = dataset.take(unique_rows, columns=columns, filter=row_filter).take(
+        inverse
+    )
+    if stored_encodings:
+        job_encodings = space_time_encodings_from_table(job_table)
+    else:
+        job_encodings = get_space_time_encodings(job_table)
+
+    # Cubes recorded in the manifest of a previous run of the job are skipped
+    manifest = CubeManifest(
+        chip_bucket, f"{VERSION}/{platform}/manifests/manifest_{index}.parquet"
+    )
+    manifest.load()
+
+    # The shared memory buffers are created before the worker pool, and the
+    # writer thread is started after forking the workers.
+    # Pixels are stored in the data type of the platform
+    spec = get_platform_bands(platform or job_table["platform"][0].as_py())
+    pipeline = CubePipeline(
+        (CUBESIZE, len(spec.bands), CHIPSIZE, CHIPSIZE),
+        chip_bucket=chip_bucket,
+        platform=platform,
+        depth=pipeline_depth,
+        cube_format=cube_format,
+        manifest=manifest,
+        dtype=spec.dtype,
+    )
+    written = 0
+    start = time.perf_counter()
+    try:
         with Pool(pool_size) as pl:
-            data = pl.starmap(
-                get_chip,
-                all_chips,
-            )
-
-        if None in data:
-            print(f"Not all cubes are complete, skipping stacking for cube {cube_id}")
-            continue
-
-        stack_chips(data, cube_id=cube_id, chip_bucket=chip_bucket, platform=platform)
+            pipeline.start()
+            for counter, cube_id in enumerate(
+                range(index * cubes_per_job, (index + 1) * cubes_per_job)
+            ):
+                cube_slice = slice(counter * CUBESIZE, (counter + 1) * CUBESIZE)
+                random_rows_cube = random_rows[cube_slice]
+                if len(random_rows_cube) != CUBESIZE:
+                    print("Finishing because of incomplete cubes")
+                    break
+
+                # Extract chips data for this cube
+                cube_rows = job_table.select(INDEX_COLUMNS)[cube_slice].to_pylist()
+                chipids = [chip["chipid"] for chip in cube_rows]
+                item_ids = [chip["item_id"] for chip in cube_rows]
+
+                if cube_id in manifest:
+                    print(f"Skipping cube {cube_id}, found in manifest")
+                    continue
+                if skip_existing:
+                    # Cubes uploaded before the manifest was written
+                    key = get_cube_key(cube_id, platform, cube_format.extension)
+                    size = cube_size(manifest.client, chip_bucket, key)
+                    if size is not None:
+                        print(f"Skipping cube {cube_id}, found {key}")
+                        # The content of the cube is unknown to this run
+                        manifest.add(cube_id, key, [], [], size, verified=False)
+                        continue
+
+                all_chips = [
+                    (
+                        data_bucket,
+                        row,
+                        chip["platform"],
+                        chip["item_id"],
+                        chip["chip_index_x"],
+                        chip["chip_index_y"],
+                    )
+                    for row, chip in zip(random_rows_cube, cube_rows)
+                ]
+
+                # Chips are written into a shared cube buffer by the workers
+                buffer = pipeline.acquire()
+                with pipeline.timer("fetch"):
+                    if group_by_item:
+                        data = get_cube_chips(all_chips, pl, buffer[0], item_batch_size)
+                    else:
+                        data = pl.starmap(
+                            get_chip,
+                            [
+                                (*chip, buffer[0], slot)
+                                for slot, chip in enumerate(all_chips)
+                            ],
+                        )
+
+                if None in data:
+                    print(
+                        f"Not all cubes are complete, skipping stacking for cube {cube_id}"
+                    )
+                    pipeline.release(buffer)
+                    continue
+
+                encodings = {
+                    key: values[cube_slice] for key, values in job_encodings.items()
+                }
+                pipeline.submit(encodings, cube_id, buffer, chipids, item_ids)
+                written += 1
+    finally:
+        pipeline.close()
+
+    elapsed = time.perf_counter() - start
+    timings = ", ".join(
+        f"{stage} {seconds:.1f}s" for stage, seconds in pipeline.timings.items()
+    )
+    print(f"Wrote {written} cubes in {elapsed:.1f}s ({timings})")
@@ -1,19 +1,22 @@
-import json
 import os
 import random
+import tempfile
 from pathlib import Path
+from typing import Iterable, List, Optional
 from urllib.parse import urlparse
 
-import boto3
 import geopandas as gp
+import numpy as np
 import planetary_computer as pc
-import pyarrow as pa
 import pystac_client
 import rasterio
-from geoarrow.pyarrow import io
-from rasterio.io import MemoryFile
+from numpy.typing import ArrayLike
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
 
 from stacchip.indexer import NoDataMaskChipIndexer
+from stacchip.processors.pipeline import IngestPipeline, Scene
+from stacchip.processors.transfer import upload_file
 
 STAC_API = "https://planetarycomputer.microsoft.com/api/stac/v1"
 S1_ASSETS = [
@@ -21,6 +24,7 @@ S1_ASSETS = [
     "vh",
 ]
 PLATFORM_NAME = "sentinel-1-rtc"
+BLOCK_SIZE = 512
 quartals = [
     "{year}-01-01/{year}-03-31",
     "{year}-04-01/{year}-06-30",
@@ -29,97 +33,152 @@ quartals = [
 ]
 
 
-def process_mgrs_tile(index: int, mgrs_source: str, bucket: str) -> None:
-    # Prepare resources for the job
-    s3 = boto3.resource("s3")
-    data = gp.read_file(mgrs_source)
-    row = data.iloc[index]
-    catalog = pystac_client.Client.open(STAC_API, modifier=pc.sign_inplace)
-    print("MGRS", row["name"])
-    random.seed(index)
-    for year in random.sample(range(2018, 2024), 1):
-        print(f"Year {year}")
-        for quartal in random.sample(quartals, 1):
-            print(f"Quartal {quartal.format(year=year)}")
-            items = catalog.search(
-                max_items=1,
-                filter_lang="cql2-json",
-                filter={
-                    "op": "and",
-                    "args": [
-                        # {
-                        #     "op": "s_intersects",
-                        #     "args": [
-                        #         {"property": "geometry"},
-                        #         row.geometry.__geo_interface__,
-                        #     ],
-                        # },
-                        {
-                            "op": "anyinteracts",
-                            "args": [
-                                {"property": "datetime"},
-                                quartal.format(year=year),
-                            ],
-                        },
-                        {
-                            "op": "=",
-                            "args": [{"property": "collection"}, "sentinel-1-rtc"],
-                        },
-                    ],
-                },
-            )
-            item = items.item_collection()[0]
-
-            nodata_mask = None
-            for key in list(item.assets.keys()):
-                if key not in S1_ASSETS:
-                    del item.assets[key]
-                else:
-                    url = item.assets[key].href
+def copy_raster(
+    dataset: DatasetReader,
+    path: str,
+    with_mask: bool = True,
+    block_size: int = BLOCK_SIZE,
+) -> Optional[ArrayLike]:
+    """
+    Copy a raster into a tiled and compressed geotiff
+
+    The pixels are copied in strips of one block row, so only one strip
+    is held in memory. If requested, the nodata mask of the first band
+    is accumulated from the strips and returned.
+    """
+    meta = dataset.meta.copy()
+    meta.update(
+        {
+            "driver": "GTiff",
+            "compress": "deflate",
+            "tiled": True,
+            "blockxsize": block_size,
+            "blockysize": block_size,
+        }
+    )
+    nodata_mask = None
+    if with_mask:
+        nodata_mask = np.empty((dataset.height, dataset.width), dtype=bool)
+    nodata_is_nan = dataset.nodata is not None and np.isnan(dataset.nodata)
+
+    with rasterio.open(path, "w", **meta) as dst:
+        for row in range(0, dataset.height, block_size):
+            height = min(block_size, dataset.height - row)
+            window = Window(0, row, dataset.width, height)
+            data = dataset.read(window=window)
+            dst.write(data, window=window)
+            if nodata_mask is None:
+                continue
+            if nodata_is_nan:
+                nodata_mask[row : row + height] = np.isnan(data[0])
+            else:
+                nodata_mask[row : row + height] = data[0] == dataset.nodata
+
+    return nodata_mask
+
+
+class Sentinel1Pipeline(IngestPipeline):
+    """
+    Ingest a Sentinel-1 RTC scene from a random quartal
+    """
+
+    def __init__(self, index: int, mgrs_source: str, bucket: str, **kwargs) -> None:
+        """
+        Init Sentinel1Pipeline
+        """
+        super().__init__(bucket, job=index, **kwargs)
+        self.catalog = pystac_client.Client.open(STAC_API, modifier=pc.sign_inplace)
+        self.row = gp.read_file(mgrs_source).iloc[index]
+        self.seed = index
+
+    def queries(self) -> Iterable[str]:
+        """
+        A random quartal of a random year
+        """
+        print("MGRS", self.row["name"])
+        random.seed(self.seed)
+        for year in random.sample(range(2018, 2024), 1):
+            for quartal in random.sample(quartals, 1):
+                yield quartal.format(year=year)
+
+    def search(self, timerange: str) -> List[Scene]:
+        """
+        Search a scene in the quartal
+        """
+        print(f"Quartal {timerange}")
+        items = self.catalog.search(
+            max_items=1,
+            filter_lang="cql2-json",
+            filter={
+                "op": "and",
+                "args": [
+                    # {
+                    #     "op": "s_intersects",
+                    #     "args": [
+                    #         {"property": "geometry"},
+                    #         row.geometry.__geo_interface__,
+                    #     ],
+                    # },
+                    {
+                        "op": "anyinteracts",
+                        "args": [
+                            {"property": "datetime"},
+                            timerange,
+                        ],
+                    },
+                    {
+                        "op": "=",
+                        "args": [{"property": "collection"}, "sentinel-1-rtc"],
+                    },
+                ],
+            },
+        )
+        items = list(items.item_collection())
+        if not len(items):
+            print(f"No items found for quartal {timerange}")
+            return []
+
+        return [Scene(item=items[0], platform=PLATFORM_NAME)]
+
+    def transfer(self, scene: Scene) -> Scene:
+        """
+        Copy the polarization assets into tiled and compressed files
+        """
+        item = scene.item
+        for key in list(item.assets.keys()):
+            if key not in S1_ASSETS:
+                del item.assets[key]
+            else:
+                url = item.assets[key].href
+                new_key = f"{PLATFORM_NAME}/{item.id}/{Path(urlparse(url).path).name}"
+                print(f"Copying {urlparse(url).path}")
+                with tempfile.NamedTemporaryFile(suffix=".tif") as temp_file:
+                    # The nodata mask is taken from the first asset only
                     with rasterio.open(url) as rst:
-                        data = rst.read()
-                        meta = rst.meta.copy()
-                        if nodata_mask is None:
-                            nodata_mask = data[0] == rst.nodata
+                        nodata_mask = copy_raster(
+                            rst, temp_file.name, with_mask=scene.nodata_mask is None
+                        )
+                    upload_file(temp_file.name, self.bucket, new_key)
 
-                    with MemoryFile() as memfile:
-                        with memfile.open(**meta, compress="deflate") as dst:
-                            dst.write(data)
+                if nodata_mask is not None:
+                    scene.nodata_mask = nodata_mask
 
-                        memfile.seek(0)
+                item.assets[key].href = f"s3://{self.bucket}/{new_key}"
 
-                        s3_bucket = s3.Bucket(name=bucket)
-                        new_key = (
-                            f"{PLATFORM_NAME}/{item.id}/{Path(urlparse(url).path).name}"
-                        )
-                        print(f"Copying {urlparse(url).path}")
-                        s3_bucket.put_object(
-                            Key=new_key,
-                            Body=memfile.read(),
-                        )
+        return scene
 
-                    item.assets[key].href = f"s3://{bucket}/{new_key}"
-
-            # Convert Dictionary to JSON String
-            data_string = json.dumps(item.to_dict())
-
-            # Upload JSON String to an S3 Object
-            s3_bucket = s3.Bucket(name=bucket)
-            s3_bucket.put_object(
-                Key=f"{PLATFORM_NAME}/{item.id}/stac_item.json",
-                Body=data_string,
-            )
-            indexer = NoDataMaskChipIndexer(item, nodata_mask=nodata_mask)
-            index = indexer.create_index()
-
-            writer = pa.BufferOutputStream()
-            io.write_geoparquet_table(index, writer)
-            body = bytes(writer.getvalue())
-            # Centralize the index files to make combining them easier later on
-            s3_bucket.put_object(
-                Body=body,
-                Key=f"index/{PLATFORM_NAME}/{item.id}/index_{item.id}.parquet",
-            )
+    def indexer(self, scene: Scene) -> NoDataMaskChipIndexer:
+        """
+        Index the scene with the nodata mask of the first polarization
+        """
+        # The mask is set in the transfer stage and released after indexing
+        if scene.nodata_mask is None:
+            raise ValueError(f"Scene {scene.item.id} has no nodata mask")
+        return NoDataMaskChipIndexer(scene.item, nodata_mask=scene.nodata_mask)
+
+
+def process_mgrs_tile(index: int, mgrs_source: str, bucket: str) -> None:
+    Sentinel1Pipeline(index, mgrs_source, bucket).run()
 
 
 def process() -> None:
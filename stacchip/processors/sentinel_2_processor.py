@@ -1,16 +1,15 @@
-import json
 import os
 import random
 from pathlib import Path
+from typing import Iterable, List
 from urllib.parse import urlparse
 
-import boto3
 import geopandas as gp
-import pyarrow as pa
 import pystac_client
-from geoarrow.pyarrow import io
 
 from stacchip.indexer import Sentinel2Indexer
+from stacchip.processors.pipeline import IngestPipeline, Scene
+from stacchip.processors.transfer import Transfer, copy_objects
 
 STAC_API = "https://earth-search.aws.element84.com/v1"
 S2_ASSETS = [
@@ -37,76 +36,97 @@ quartals = [
 ]
 
 
-def process_mgrs_tile(index: int, mgrs_source: str, bucket: str) -> None:
-    # Prepare resources for the job
-    catalog = pystac_client.Client.open(STAC_API)
-    s3 = boto3.resource("s3")
-    data = gp.read_file(mgrs_source)
-    row = data.iloc[index]
-
-    print("MGRS", row["name"])
-    random.seed(index)
-    for year in random.sample(range(2018, 2024), 2):
-        print(f"Year {year}")
-        for quartal in quartals:
-            print(f"Quartal {quartal.format(year=year)}")
-            items = catalog.search(
-                collections=["sentinel-2-l2a"],
-                datetime=quartal.format(year=year),
-                max_items=1,
-                intersects=row.geometry,
-                sortby="properties.eo:cloud_cover",
-                query={
-                    "grid:code": {
-                        "eq": f"MGRS-{row['name']}",
-                    },
-                    "s2:nodata_pixel_percentage": {"lte": SCENE_NODATA_LIMIT},
+class Sentinel2Pipeline(IngestPipeline):
+    """
+    Ingest the least cloudy Sentinel-2 scene per quartal for an MGRS tile
+    """
+
+    def __init__(self, index: int, mgrs_source: str, bucket: str, **kwargs) -> None:
+        """
+        Init Sentinel2Pipeline
+        """
+        super().__init__(bucket, job=index, **kwargs)
+        self.catalog = pystac_client.Client.open(STAC_API)
+        self.row = gp.read_file(mgrs_source).iloc[index]
+        self.seed = index
+
+    def queries(self) -> Iterable[str]:
+        """
+        Quartals of two random years for the MGRS tile
+        """
+        print("MGRS", self.row["name"])
+        random.seed(self.seed)
+        for year in random.sample(range(2018, 2024), 2):
+            for quartal in quartals:
+                yield quartal.format(year=year)
+
+    def search(self, timerange: str) -> List[Scene]:
+        """
+        Search the least cloudy scene in a quartal
+        """
+        items = self.catalog.search(
+            collections=["sentinel-2-l2a"],
+            datetime=timerange,
+            max_items=1,
+            intersects=self.row.geometry,
+            sortby="properties.eo:cloud_cover",
+            query={
+                "grid:code": {
+                    "eq": f"MGRS-{self.row['name']}",
                 },
-            )
-            item = items.item_collection()[0]
-
-            if item.properties["eo:cloud_cover"] > ABSOLUTE_CLOUD_COVER_FILTER:
-                continue
-
-            print(f"Cloud cover is {item.properties['eo:cloud_cover']}")
-
-            for key in list(item.assets.keys()):
-                if key not in S2_ASSETS:
-                    del item.assets[key]
-                else:
-                    url = urlparse(item.assets[key].href)
-                    copy_source = {
-                        "Bucket": "sentinel-cogs",
-                        "Key": url.path.lstrip("/"),
-                    }
-                    print(f"Copying {copy_source}")
-                    new_key = (
-                        f"{PLATFORM_NAME}/{item.id}/{Path(item.assets[key].href).name}"
-                    )
-                    s3.meta.client.copy(copy_source, bucket, new_key)
-                    item.assets[key].href = f"s3://{bucket}/{new_key}"
-
-            # Convert Dictionary to JSON String
-            data_string = json.dumps(item.to_dict())
-
-            # Upload JSON String to an S3 Object
-            s3_bucket = s3.Bucket(name=bucket)
-            s3_bucket.put_object(
-                Key=f"{PLATFORM_NAME}/{item.id}/stac_item.json",
-                Body=data_string,
-            )
-
-            indexer = Sentinel2Indexer(item)
-            index = indexer.create_index()
-
-            writer = pa.BufferOutputStream()
-            io.write_geoparquet_table(index, writer)
-            body = bytes(writer.getvalue())
-            # Centralize the index files to make combining them easier later on
-            s3_bucket.put_object(
-                Body=body,
-                Key=f"index/{PLATFORM_NAME}/{item.id}/index_{item.id}.parquet",
-            )
+                "s2:nodata_pixel_percentage": {"lte": SCENE_NODATA_LIMIT},
+            },
+        )
+        items = list(items.item_collection())
+        if not len(items):
+            print(f"No items found for quartal {timerange}")
+            return []
+
+        item = items[0]
+        print(f"Quartal {timerange} cloud cover is {item.properties['eo:cloud_cover']}")
+        if item.properties["eo:cloud_cover"] > ABSOLUTE_CLOUD_COVER_FILTER:
+            return []
+
+        return [Scene(item=item, platform=PLATFORM_NAME)]
+
+    def transfer(self, scene: Scene) -> Scene:
+        """
+        Copy the assets of the scene
+        """
+        item = scene.item
+        transfers = {}
+        for key in list(item.assets.keys()):
+            if key not in S2_ASSETS:
+                del item.assets[key]
+            else:
+                url = urlparse(item.assets[key].href)
+                transfers[key] = Transfer(
+                    source=f"s3://sentinel-cogs/{url.path.lstrip('/')}",
+                    bucket=self.bucket,
+                    key=f"{PLATFORM_NAME}/{item.id}/{Path(url.path).name}",
+                    local_path=(
+                        scene.scratch_path(Path(url.path).name)
+                        if self.single_pass and key == "scl"
+                        else None
+                    ),
+                )
+        copy_objects(transfers.values())
+        for key, transfer in transfers.items():
+            item.assets[key].href = transfer.href
+            if transfer.local_path:
+                scene.local_hrefs[key] = transfer.local_path
+
+        return scene
+
+    def indexer(self, scene: Scene) -> Sentinel2Indexer:
+        """
+        Index the scene with the scene classification layer
+        """
+        return Sentinel2Indexer(scene.item, local_hrefs=scene.local_hrefs)
+
+
+def process_mgrs_tile(index: int, mgrs_source: str, bucket: str) -> None:
+    Sentinel2Pipeline(index, mgrs_source, bucket).run()
 
 
 def process() -> None:
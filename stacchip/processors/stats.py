@@ -1,108 +1,489 @@
 import io
 import os
-from multiprocessing import Pool
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
 
-import boto3
 import numpy as np
+from numpy.typing import ArrayLike
 
-from stacchip.processors.prechip import (
-    LINZ_BANDS,
-    LS_BANDS,
-    MODIS_BANDS,
-    NAIP_BANDS,
-    S1_BANDS,
-    S2_BANDS,
-)
+from stacchip.processors.bands import PlatformBands, get_platform_bands
+from stacchip.processors.cube_formats import CUBE_FORMATS, iter_cube
+from stacchip.utils import get_env_flag, get_s3_client
 
+BUCKET = "clay-v1-data-cubes"
 
-def get_stats_keys(key):
+PREFIX = "mode_v1_chipper_v2"
+
+QUANTILES = (0.01, 0.5, 0.99)
+
+CUBE_EXTENSIONS = {f".{factory().extension}" for factory in CUBE_FORMATS.values()}
+
+
+@dataclass
+class BandStats:
+    """
+    Mergeable per-band pixel count, mean and sum of squared differences
+
+    Chunks are added with Welford style updates, and partial results are
+    combined with the parallel algorithm of Chan et al., which is
+    numerically stable, unlike naive sums of squares.
+    """
+
+    count: np.ndarray
+    mean: np.ndarray
+    m2: np.ndarray = field(repr=False)
+
+    @classmethod
+    def empty(cls, band_count: int) -> "BandStats":
+        """
+        Stats without any pixels
+        """
+        return cls(
+            count=np.zeros(band_count, dtype="int64"),
+            mean=np.zeros(band_count, dtype="float64"),
+            m2=np.zeros(band_count, dtype="float64"),
+        )
+
+    def merge(self, other: "BandStats") -> "BandStats":
+        """
+        Add the pixels of other stats
+        """
+        count = self.count + other.count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = other.mean - self.mean
+            weight = np.where(count > 0, other.count / count, 0)
+        self.mean = self.mean + delta * weight
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * weight
+        self.count = count
+        return self
+
+    def update(self, chunk: np.ndarray, nodata: float) -> "BandStats":
+        """
+        Add a chunk of pixels with shape (bands, pixels), skipping nodata
+        """
+        count = np.zeros_like(self.count)
+        mean = np.zeros_like(self.mean)
+        m2 = np.zeros_like(self.m2)
+        for band, values in enumerate(chunk):
+            values = values[values != nodata]
+            if not values.size:
+                continue
+            count[band] = values.size
+            mean[band] = values.mean(dtype="float64")
+            m2[band] = np.square(np.subtract(values, mean[band], dtype="float64")).sum()
+        return self.merge(BandStats(count=count, mean=mean, m2=m2))
+
+    @property
+    def variance(self) -> np.ndarray:
+        """
+        Population variance by band
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.m2 / self.count
+
+    @property
+    def std(self) -> np.ndarray:
+        """
+        Population standard deviation by band
+        """
+        return np.sqrt(self.variance)
+
+
+@dataclass
+class BandHistogram:
+    """
+    Mergeable per-band histogram with fixed bins
+
+    The first and last bin count the values below and above the range.
+    Quantiles are interpolated linearly within bins.
+    """
+
+    hist_range: Tuple[float, float]
+    counts: np.ndarray
+
+    @classmethod
+    def empty(
+        cls, band_count: int, hist_range: Tuple[float, float], bins: int
+    ) -> "BandHistogram":
+        """
+        Histogram without any pixels
+        """
+        return cls(
+            hist_range=(float(hist_range[0]), float(hist_range[1])),
+            counts=np.zeros((band_count, bins + 2), dtype="int64"),
+        )
+
+    @property
+    def bins(self) -> int:
+        """
+        Number of bins within the range
+        """
+        return self.counts.shape[1] - 2
+
+    def merge(self, other: "BandHistogram") -> "BandHistogram":
+        """
+        Add the counts of another histogram with the same bins
+        """
+        if self.hist_range != other.hist_range or self.bins != other.bins:
+            raise ValueError("Histograms with different bins can not be merged")
+        self.counts = self.counts + other.counts
+        return self
+
+    def update(self, chunk: np.ndarray, nodata: float) -> "BandHistogram":
+        """
+        Add a chunk of pixels with shape (bands, pixels), skipping nodata
+        """
+        low, high = self.hist_range
+        scale = self.bins / (high - low)
+        for band, values in enumerate(chunk):
+            values = values[values != nodata]
+            index = np.floor((values - low) * scale)
+            index = np.clip(index, -1, self.bins).astype("int64") + 1
+            self.counts[band] += np.bincount(index, minlength=self.bins + 2)
+        return self
+
+    def quantiles(self, q: ArrayLike) -> np.ndarray:
+        """
+        Quantiles by band, with shape (bands, quantiles)
+        """
+        low, high = self.hist_range
+        edges = np.linspace(low, high, self.bins + 1)
+        # Values outside of the range are placed on the range limits
+        lower = np.concatenate([[low], edges])
+        upper = np.concatenate([edges, [high]])
+        result = np.full((len(self.counts), len(np.atleast_1d(q))), np.nan)
+        for band, counts in enumerate(self.counts):
+            total = counts.sum()
+            if not total:
+                continue
+            cumulative = np.cumsum(counts)
+            for i, target in enumerate(np.atleast_1d(q) * total):
+                index = min(np.searchsorted(cumulative, target), len(counts) - 1)
+                before = cumulative[index] - counts[index]
+                fraction = (target - before) / counts[index] if counts[index] else 0
+                result[band, i] = lower[index] + fraction * (
+                    upper[index] - lower[index]
+                )
+        return result
+
+    def clipped(self, q: ArrayLike) -> np.ndarray:
+        """
+        Flags of the quantiles that fall into the overflow bins by band
+
+        The values of these quantiles are only known to be outside of the
+        range, they are reported on the range limits.
+        """
+        result = np.zeros((len(self.counts), len(np.atleast_1d(q))), dtype=bool)
+        for band, counts in enumerate(self.counts):
+            total = counts.sum()
+            if not total:
+                continue
+            cumulative = np.cumsum(counts)
+            index = np.searchsorted(cumulative, np.atleast_1d(q) * total)
+            index = np.minimum(index, len(counts) - 1)
+            result[band] = ((index == 0) | (index == len(counts) - 1)) & (
+                counts[index] > 0
+            )
+        return result
+
+
+@dataclass
+class StatsState:
+    """
+    Serializable state of the band statistics
+
+    States can be written to files by separate jobs and merged later on.
+    """
+
+    stats: BandStats
+    histogram: BandHistogram
+
+    @classmethod
+    def empty(cls, spec: PlatformBands) -> "StatsState":
+        """
+        State without any pixels for the bands of a platform
+        """
+        return cls(
+            stats=BandStats.empty(len(spec.bands)),
+            histogram=BandHistogram.empty(
+                len(spec.bands), spec.hist_range, spec.hist_bins
+            ),
+        )
+
+    def merge(self, other: "StatsState") -> "StatsState":
+        """
+        Add the pixels of another state
+        """
+        self.stats.merge(other.stats)
+        self.histogram.merge(other.histogram)
+        return self
+
+    def update(self, chunk: np.ndarray, nodata: float) -> "StatsState":
+        """
+        Add a chunk of pixels with shape (bands, pixels), skipping nodata
+        """
+        self.stats.update(chunk, nodata)
+        self.histogram.update(chunk, nodata)
+        return self
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the state to npz
+        """
+        with io.BytesIO() as bytes:
+            np.savez(
+                bytes,
+                count=self.stats.count,
+                mean=self.stats.mean,
+                m2=self.stats.m2,
+                hist_range=np.array(self.histogram.hist_range),
+                hist_counts=self.histogram.counts,
+            )
+            return bytes.getvalue()
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> "StatsState":
+        """
+        Load a state serialized to npz
+        """
+        with np.load(io.BytesIO(content)) as data:
+            return cls(
+                stats=BandStats(count=data["count"], mean=data["mean"], m2=data["m2"]),
+                histogram=BandHistogram(
+                    hist_range=tuple(data["hist_range"].tolist()),
+                    counts=data["hist_counts"],
+                ),
+            )
+
+    def report(self, bands: Tuple[str, ...]) -> None:
+        """
+        Print the statistics by band
+        """
+        print("-- Mean by band")
+        for band, val in zip(bands, self.stats.mean):
+            print(f"{band}: {val}")
+
+        print("-- Std by band")
+        for band, val in zip(bands, self.stats.std):
+            print(f"{band}: {val}")
+
+        print("-- Percentiles p1, p50, p99 by band")
+        quantiles = self.histogram.quantiles(QUANTILES)
+        clipped = self.histogram.clipped(QUANTILES)
+        for band, val, flags in zip(bands, quantiles, clipped):
+            text = [
+                f"{dat} (outside histogram range)" if flag else str(dat)
+                for dat, flag in zip(val, flags)
+            ]
+            print(f"{band}: {', '.join(text)}")
+
+
+def iter_npz_chunks(file: BinaryIO, key: str = "pixels") -> Iterator[np.ndarray]:
+    """
+    Iterate over an array in a npz file one entry of the first axis at a time
+
+    The array is decompressed while reading from the zip member, so that
+    only one chunk is held in memory.
+    """
+    with zipfile.ZipFile(file) as archive:
+        with archive.open(f"{key}.npy") as member:
+            if np.lib.format.read_magic(member) == (1, 0):
+                header = np.lib.format.read_array_header_1_0(member)
+            else:
+                header = np.lib.format.read_array_header_2_0(member)
+            shape, fortran_order, dtype = header
+            if fortran_order:
+                raise ValueError("Fortran ordered arrays are not supported")
+            chunk_shape = shape[1:]
+            chunk_size = int(np.prod(chunk_shape)) * dtype.itemsize
+            for _ in range(shape[0]):
+                data = member.read(chunk_size)
+                yield np.frombuffer(data, dtype=dtype).reshape(chunk_shape)
+
+
+def iter_cube_chunks(
+    path: Union[str, Path], key: str = "pixels"
+) -> Iterator[np.ndarray]:
+    """
+    Iterate over an array in a cube file of any format one chip at a time
+
+    Arrays in npz files are streamed from the zip member. The other formats
+    are read with iter_cube, which decompresses one chunk at a time and
+    memory-maps uncompressed cubes.
+    """
+    if zipfile.is_zipfile(path):
+        with open(path, "rb") as file:
+            yield from iter_npz_chunks(file, key)
+        return
+    yield from iter_cube(path, key)
+
+
+def get_stats_keys(key: str, spec: PlatformBands) -> StatsState:
     print(f"Processing {key}")
-    if "sentinel-1-rtc" in key:
-        nodata = -32768
-    if "modis" in key:
-        nodata = -28672
-    else:
-        nodata = 0
 
-    s3_session = boto3.resource("s3")
-    obj = s3_session.Object("clay-v1-data-cubes", key)
-    body = obj.get()["Body"].read()
-    with io.BytesIO(body) as f:
-        f.seek(0)
-        data = np.load(f)["pixels"]
+    client = get_s3_client()
+    state = StatsState.empty(spec)
+    # Spool the compressed cube to disk, the pixels are streamed from there
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(key)[1]) as file:
+        client.download_fileobj(BUCKET, key, file)
+        file.flush()
+        for chip in iter_cube_chunks(file.name):
+            state.update(chip.reshape(len(spec.bands), -1), spec.nodata)
+    return state
 
-    data = data.astype("float64").swapaxes(0, 1)
 
-    data = np.ma.array(data, mask=data == nodata)
+def merge_states(client, platform: str, spec: PlatformBands) -> StatsState:
+    """
+    Merge the state files written by the stats jobs of a platform
+    """
+    state = StatsState.empty(spec)
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET, Prefix=f"{PREFIX}/{platform}/stats/"):
+        for dat in page.get("Contents", []):
+            print(f"Merging {dat['Key']}")
+            body = client.get_object(Bucket=BUCKET, Key=dat["Key"])["Body"].read()
+            state.merge(StatsState.from_bytes(body))
+    return state
+
 
-    pixel_count = np.ma.count(data, axis=(1, 2, 3))
-    pixel_sum = np.ma.sum(data, axis=(1, 2, 3))
-    pixel_sqr = np.ma.sum(np.ma.power(data, 2), axis=(1, 2, 3))
+def list_cube_keys(client, platform: str, max_cubes: Optional[int] = None) -> list:
+    """
+    Keys of the cubes of a platform in listing order, in any cube format
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    page_iterator = paginator.paginate(Bucket=BUCKET, Prefix=f"{PREFIX}/{platform}/")
 
-    return pixel_count, pixel_sum, pixel_sqr
+    all_keys: list = []
+    for page in page_iterator:
+        # Only cubes are used, skipping manifests and stats states
+        all_keys.extend(
+            dat["Key"]
+            for dat in page.get("Contents", [])
+            if os.path.basename(dat["Key"]).startswith("cube_")
+            and os.path.splitext(dat["Key"])[1] in CUBE_EXTENSIONS
+        )
+        if max_cubes is not None and len(all_keys) >= max_cubes:
+            return all_keys[:max_cubes]
+    return all_keys
+
+
+def sample_stats(
+    keys: list,
+    spec: PlatformBands,
+    pool_size: int,
+    target_se: float,
+    min_cubes: int,
+) -> StatsState:
+    """
+    Compute statistics over cubes until the standard errors are small enough
+
+    The keys should be in random order. Cubes are processed in that order,
+    and processing stops once the standard error of the mean of each band,
+    estimated from the means of the cubes, is below the target relative to
+    the mean.
+    """
+    if len(keys) <= min_cubes:
+        print(
+            f"Only {len(keys)} cubes for at least {min_cubes} cubes,"
+            " all cubes are processed without early stopping"
+        )
+    state = StatsState.empty(spec)
+    cube_means = []
+    pending: deque = deque()
+    with ThreadPoolExecutor(max_workers=pool_size) as executor:
+        keys_iter = iter(keys)
+        for key in islice(keys_iter, pool_size):
+            pending.append(executor.submit(get_stats_keys, key, spec))
+        while pending:
+            result = pending.popleft().result()
+            state.merge(result)
+            cube_means.append(result.stats.mean)
+
+            if len(cube_means) >= max(min_cubes, 2):
+                se = standard_error(np.array(cube_means))
+                relative = np.abs(se / state.stats.mean)
+                print(
+                    f"Relative standard error after {len(cube_means)} cubes: {relative.max()}"
+                )
+                if np.all(relative < target_se):
+                    for future in pending:
+                        future.cancel()
+                    break
+
+            key = next(keys_iter, None)
+            if key is not None:
+                pending.append(executor.submit(get_stats_keys, key, spec))
+
+    se = standard_error(np.array(cube_means))
+    print(f"-- Mean and 95% confidence interval by band from {len(cube_means)} cubes")
+    for band, mean, val in zip(spec.bands, state.stats.mean, se):
+        print(f"{band}: {mean} +/- {1.96 * val}")
+
+    return state
+
+
+def standard_error(cube_means: np.ndarray) -> np.ndarray:
+    """
+    Standard error of the mean by band from the means of single cubes
+    """
+    if len(cube_means) < 2:
+        return np.full(cube_means.shape[1:], np.inf)
+    return np.std(cube_means, axis=0, ddof=1) / np.sqrt(len(cube_means))
 
 
 def process():
     if "STACCHIP_PLATFORM" not in os.environ:
         raise ValueError("STACCHIP_PLATFORM env var not set")
     pool_size = int(os.environ.get("STACCHIP_POOL_SIZE", 4))
-    max_cubes = int(os.environ.get("STACCHIP_MAX_CUBES", 4))
+    max_cubes_env = os.environ.get("STACCHIP_MAX_CUBES")
+    jobs = int(os.environ.get("STACCHIP_STATS_JOBS", 1))
+    index = int(os.environ.get("AWS_BATCH_JOB_ARRAY_INDEX", 0))
+    sample = get_env_flag("STACCHIP_STATS_SAMPLE")
+    target_se = float(os.environ.get("STACCHIP_STATS_TARGET_SE", 0.005))
+    min_cubes = int(os.environ.get("STACCHIP_STATS_MIN_CUBES", 10))
+    seed = int(os.environ.get("STACCHIP_STATS_SEED", 42))
 
     platform = os.environ.get("STACCHIP_PLATFORM")
-    if platform == "naip":
-        bands = NAIP_BANDS
-    elif platform == "linz":
-        bands = LINZ_BANDS
-    elif platform == "sentinel-2-l2a":
-        bands = S2_BANDS
-    elif platform in ["landsat-c2l2-sr", "landsat-c2l1"]:
-        bands = LS_BANDS
-    elif platform == "sentinel-1-rtc":
-        bands = S1_BANDS
-    elif platform == "modis":
-        bands = MODIS_BANDS
-    else:
-        raise ValueError(f"Platform {platform} not found")
+    spec = get_platform_bands(platform)
 
-    client = boto3.client("s3")
-    paginator = client.get_paginator("list_objects_v2")
-    page_iterator = paginator.paginate(
-        Bucket="clay-v1-data-cubes", Prefix=f"mode_v1_chipper_v2/{platform}"
-    )
+    client = get_s3_client()
 
-    band_count = len(bands)
-    pixel_count = np.zeros(band_count)
-    pixel_sum = np.zeros(band_count)
-    pixel_sqr = np.zeros(band_count)
+    # Merge the states of previous jobs instead of processing cubes
+    if get_env_flag("STACCHIP_STATS_MERGE"):
+        merge_states(client, platform, spec).report(spec.bands)
+        return
 
-    counter = 0
-    all_keys = []
-    for page in page_iterator:
-        keys = [dat["Key"] for dat in page["Contents"]]
-        for key in keys:
-            counter += 1
-            all_keys.append(key)
-            if counter == max_cubes:
-                break
-        if counter == max_cubes:
-            break
-
-    with Pool(pool_size) as pl:
-        result = pl.map(get_stats_keys, all_keys)
-
-    for dat in result:
-        pixel_count = np.add(pixel_count, dat[0])
-        pixel_sum = np.add(pixel_sum, dat[1])
-        pixel_sqr = np.add(pixel_sqr, dat[2])
-
-    # https://stackoverflow.com/questions/1174984/how-to-efficiently-calculate-a-running-standard-deviation
-    mean = pixel_sum / pixel_count
-    stdev = np.sqrt((pixel_sqr / pixel_count) - (mean * mean))
-
-    print("-- Mean by band")
-    for band, val in zip(bands, mean):
-        print(f"{band}: {val}")
-
-    print("-- Std by band")
-    for band, val in zip(bands, stdev):
-        print(f"{band}: {val}")
+    if sample:
+        # Uniform random sample of all cubes, processed until the target
+        # standard error is reached. The sample is not limited by default,
+        # so that the stopping rule decides how many cubes are processed.
+        max_cubes = int(max_cubes_env) if max_cubes_env else None
+        all_keys = list_cube_keys(client, platform)
+        order = np.random.default_rng(seed).permutation(len(all_keys))
+        all_keys = [all_keys[i] for i in order[:max_cubes]]
+        state = sample_stats(
+            all_keys[index::jobs], spec, pool_size, target_se, min_cubes
+        )
+    else:
+        max_cubes = int(max_cubes_env or 4)
+        all_keys = list_cube_keys(client, platform, max_cubes)
+        # Download and decompression dominate and release the GIL
+        state = StatsState.empty(spec)
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            for result in executor.map(
+                lambda key: get_stats_keys(key, spec), all_keys[index::jobs]
+            ):
+                state.merge(result)
+
+    if jobs > 1:
+        key = f"{PREFIX}/{platform}/stats/state_{index}.npz"
+        print(f"Writing state to {key}")
+        client.put_object(Bucket=BUCKET, Key=key, Body=state.to_bytes())
+
+    state.report(spec.bands)
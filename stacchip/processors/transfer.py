@@ -0,0 +1,344 @@
+import io
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from stacchip.utils import get_s3_client
+
+MB = 1024**2
+TRANSFER_WORKERS = 8
+TRANSFER_RETRIES = 5
+TRANSFER_BACKOFF = 0.5
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * MB,
+    multipart_chunksize=64 * MB,
+    max_concurrency=8,
+)
+THROTTLING_ERRORS = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "ServiceUnavailable",
+    "503",
+}
+
+
+@dataclass(frozen=True)
+class Transfer:
+    """
+    Copy of one asset into the target bucket
+
+    The fallback sources are tried in order if the source does not
+    exist or can not be read. If a local path is given, the asset is
+    streamed through the local machine and also written to that path.
+    """
+
+    source: str
+    bucket: str
+    key: str
+    requester_pays: bool = False
+    fallbacks: Tuple[str, ...] = ()
+    local_path: Optional[str] = None
+
+    @property
+    def href(self) -> str:
+        """
+        Href of the copied asset
+        """
+        return f"s3://{self.bucket}/{self.key}"
+
+
+@dataclass
+class TransferReport:
+    """
+    Number of objects and bytes copied in a batch of transfers
+    """
+
+    objects: int
+    nbytes: int
+    seconds: float
+
+    @property
+    def rate(self) -> float:
+        """
+        Transfer rate in bytes per second
+        """
+        return self.nbytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        """
+        Summary of the transfer for logging
+        """
+        return (
+            f"Copied {self.objects} objects, {self.nbytes / MB:.1f} MB "
+            f"in {self.seconds:.1f}s ({self.rate / MB:.1f} MB/s)"
+        )
+
+
+def is_throttled(error: Exception) -> bool:
+    """
+    Check if a request failed because it was throttled
+
+    Uploads of files wrap the client error of the failed request in an
+    S3UploadFailedError, the wrapped error is checked instead.
+    """
+    if isinstance(error, S3UploadFailedError):
+        error = error.__cause__ or error.__context__
+    if not isinstance(error, ClientError):
+        return False
+    code = str(error.response.get("Error", {}).get("Code", ""))
+    status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code in THROTTLING_ERRORS or status == 503
+
+
+def with_retry(
+    func,
+    retries: int = TRANSFER_RETRIES,
+    backoff: float = TRANSFER_BACKOFF,
+    sleep=time.sleep,
+):
+    """
+    Call a function and retry throttled requests with exponential backoff
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except (ClientError, S3UploadFailedError) as e:
+            if not is_throttled(e) or attempt == retries:
+                raise
+            delay = random.uniform(0, backoff * 2**attempt)
+            print(f"Request throttled, retrying in {delay:.2f}s")
+            sleep(delay)
+
+
+def copy_object(
+    client,
+    source: str,
+    bucket: str,
+    key: str,
+    requester_pays: bool = False,
+    config: TransferConfig = TRANSFER_CONFIG,
+    retries: int = TRANSFER_RETRIES,
+    backoff: float = TRANSFER_BACKOFF,
+) -> int:
+    """
+    Copy an object from an s3 url into a bucket, returns the number of bytes
+    """
+    url = urlparse(source)
+    copy_source = {"Bucket": url.netloc, "Key": url.path.lstrip("/")}
+    extra_args = {"RequestPayer": "requester"} if requester_pays else {}
+
+    head = with_retry(
+        lambda: client.head_object(**copy_source, **extra_args),
+        retries=retries,
+        backoff=backoff,
+    )
+    with_retry(
+        lambda: client.copy(
+            copy_source, bucket, key, ExtraArgs=extra_args or None, Config=config
+        ),
+        retries=retries,
+        backoff=backoff,
+    )
+    return head["ContentLength"]
+
+
+class TeeReader:
+    """
+    File-like stream that writes all data read from it to a local file
+    """
+
+    def __init__(self, stream: BinaryIO, local: BinaryIO) -> None:
+        """
+        Init TeeReader
+        """
+        self.stream = stream
+        self.local = local
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read from the stream and write the data to the local file
+        """
+        data = self.stream.read(size)
+        self.local.write(data)
+        return data
+
+
+def upload_tee(
+    stream: BinaryIO,
+    local_path: str,
+    bucket: str,
+    key: str,
+    client=None,
+    config: TransferConfig = TRANSFER_CONFIG,
+) -> int:
+    """
+    Upload a stream and write it to a local file in the same pass
+
+    Returns the number of bytes. Streams can only be read once, so the
+    upload is not retried.
+    """
+    if client is None:
+        client = get_s3_client()
+    with open(local_path, "wb") as local:
+        client.upload_fileobj(TeeReader(stream, local), bucket, key, Config=config)
+        return local.tell()
+
+
+def tee_object(
+    client,
+    source: str,
+    bucket: str,
+    key: str,
+    local_path: str,
+    requester_pays: bool = False,
+    config: TransferConfig = TRANSFER_CONFIG,
+    retries: int = TRANSFER_RETRIES,
+    backoff: float = TRANSFER_BACKOFF,
+) -> int:
+    """
+    Copy an object through the local machine, keeping a local copy
+
+    The object is downloaded once, the bytes are uploaded to the bucket
+    and written to the local path while streaming. Returns the number of
+    bytes.
+    """
+    url = urlparse(source)
+    extra_args = {"RequestPayer": "requester"} if requester_pays else {}
+
+    def tee() -> int:
+        response = client.get_object(
+            Bucket=url.netloc, Key=url.path.lstrip("/"), **extra_args
+        )
+        return upload_tee(
+            response["Body"], local_path, bucket, key, client=client, config=config
+        )
+
+    return with_retry(tee, retries=retries, backoff=backoff)
+
+
+def upload_file(
+    path: str,
+    bucket: str,
+    key: str,
+    client=None,
+    config: TransferConfig = TRANSFER_CONFIG,
+    retries: int = TRANSFER_RETRIES,
+    backoff: float = TRANSFER_BACKOFF,
+) -> int:
+    """
+    Upload a local file with multipart, returns the number of bytes
+    """
+    if client is None:
+        client = get_s3_client()
+    with_retry(
+        lambda: client.upload_file(path, bucket, key, Config=config),
+        retries=retries,
+        backoff=backoff,
+    )
+    return os.path.getsize(path)
+
+
+def upload_bytes(
+    body: bytes,
+    bucket: str,
+    key: str,
+    client=None,
+    config: TransferConfig = TRANSFER_CONFIG,
+    retries: int = TRANSFER_RETRIES,
+    backoff: float = TRANSFER_BACKOFF,
+) -> int:
+    """
+    Upload an in-memory file with multipart, returns the number of bytes
+    """
+    if client is None:
+        client = get_s3_client()
+    with_retry(
+        lambda: client.upload_fileobj(io.BytesIO(body), bucket, key, Config=config),
+        retries=retries,
+        backoff=backoff,
+    )
+    return len(body)
+
+
+def run_transfer(client, transfer: Transfer, **kwargs) -> int:
+    """
+    Copy an asset, falling back to the alternative sources on errors
+    """
+    sources = (transfer.source,) + transfer.fallbacks
+    for index, source in enumerate(sources):
+        print(f"Copying {source} to {transfer.href}")
+        try:
+            if transfer.local_path:
+                return tee_object(
+                    client,
+                    source,
+                    transfer.bucket,
+                    transfer.key,
+                    transfer.local_path,
+                    requester_pays=transfer.requester_pays,
+                    **kwargs,
+                )
+            return copy_object(
+                client,
+                source,
+                transfer.bucket,
+                transfer.key,
+                requester_pays=transfer.requester_pays,
+                **kwargs,
+            )
+        except ClientError as e:
+            if is_throttled(e) or index == len(sources) - 1:
+                raise
+            print(f"Failed to copy {source}: {e}")
+
+
+def copy_objects(
+    transfers: Iterable[Transfer],
+    client=None,
+    max_workers: Optional[int] = None,
+    config: TransferConfig = TRANSFER_CONFIG,
+    retries: int = TRANSFER_RETRIES,
+    backoff: float = TRANSFER_BACKOFF,
+) -> TransferReport:
+    """
+    Copy a batch of assets concurrently
+
+    The number of concurrent copies defaults to the
+    STACCHIP_TRANSFER_WORKERS env var. Each copy uses multipart
+    transfers for large objects, so the total number of connections
+    is bounded by the workers times the max concurrency of the config.
+    """
+    batch: List[Transfer] = list(transfers)
+    if client is None:
+        client = get_s3_client()
+    if max_workers is None:
+        max_workers = int(os.environ.get("STACCHIP_TRANSFER_WORKERS", TRANSFER_WORKERS))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        sizes = list(
+            executor.map(
+                lambda transfer: run_transfer(
+                    client, transfer, config=config, retries=retries, backoff=backoff
+                ),
+                batch,
+            )
+        )
+    report = TransferReport(
+        objects=len(batch),
+        nbytes=sum(sizes),
+        seconds=time.perf_counter() - start,
+    )
+    print(report)
+    return report
@@ -1,24 +1,250 @@
 import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Dict, Iterable, List, Optional, Tuple, Type, Union
 
 import boto3
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from botocore.config import Config
 from pystac import Item
 
-from stacchip.indexer import ChipIndexer
+from stacchip.indexer import (
+    SNAPSHOT_SCHEMA,
+    ChipIndexer,
+    IndexerSnapshot,
+    snapshots_from_table,
+    snapshots_to_table,
+)
+
+S3_MAX_POOL_CONNECTIONS = 64
+
+CATALOG_SCHEMA = SNAPSHOT_SCHEMA.insert(1, pa.field("platform", pa.string()))
+
+
+@lru_cache(maxsize=None)
+def _get_s3_client(pid: int):
+    """
+    S3 client for one process
+    """
+    return boto3.client(
+        "s3", config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+    )
+
+
+def get_s3_client():
+    """
+    Process-wide S3 client with a pooled connection
+
+    Clients are thread safe, but should not be shared across forked
+    processes, so one client is created per process id.
+    """
+    return _get_s3_client(os.getpid())
+
+
+def get_env_flag(name: str, default: bool = False) -> bool:
+    """
+    Boolean flag from an env var
+
+    Empty values, 0, false, no and off disable the flag, in any case.
+    Returns the default if the env var is not set.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ("", "0", "false", "no", "off")
+
+
+class ItemStore:
+    """
+    Loads and caches the STAC items written by the stacchip processors
+
+    Items are read from a bucket or a local mountpath. Parsed items are kept
+    in an in-memory LRU cache, and the item json files can additionally be
+    cached in a local directory.
+    """
+
+    def __init__(
+        self,
+        bucket: Optional[str] = None,
+        mountpath: Optional[Path] = None,
+        cache_size: int = 1024,
+        cache_dir: Optional[Path] = None,
+        max_workers: int = 16,
+        client=None,
+    ) -> None:
+        """
+        Init ItemStore
+        """
+        if bucket is None and mountpath is None:
+            raise ValueError("Either bucket or mountpath has to be provided")
+        self.bucket = bucket
+        self.mountpath = None if mountpath is None else Path(mountpath)
+        self.cache_size = cache_size
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.max_workers = max_workers
+        self._client = client
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        S3 client used for fetching items
+        """
+        if self._client is None:
+            return get_s3_client()
+        return self._client
+
+    @staticmethod
+    def item_key(platform: str, item_id: str) -> str:
+        """
+        Relative path of the STAC item json file
+        """
+        return f"{platform}/{item_id}/stac_item.json"
+
+    def fetch(self, platform: str, item_id: str) -> bytes:
+        """
+        Fetch the raw json of a STAC item, using the disk cache if set
+        """
+        key = self.item_key(platform, item_id)
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = self.cache_dir / key
+            if cache_path.exists():
+                return cache_path.read_bytes()
+
+        if self.mountpath is not None:
+            content = (self.mountpath / key).read_bytes()
+        else:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+            content = response["Body"].read()
+
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a unique temporary file first, so that concurrent
+            # readers never see partial files and concurrent writers in
+            # other threads or processes do not share a temporary file.
+            with NamedTemporaryFile(
+                dir=cache_path.parent, suffix=".tmp", delete=False
+            ) as tmp:
+                tmp.write(content)
+            Path(tmp.name).replace(cache_path)
+
+        return content
+
+    def _load(self, platform: str, item_id: str) -> Item:
+        """
+        Parse a STAC item and add it to the in-memory cache
+        """
+        href = None
+        if self.mountpath is not None:
+            href = str(self.mountpath / self.item_key(platform, item_id))
+        item = Item.from_dict(json.loads(self.fetch(platform, item_id)), href=href)
+        with self._lock:
+            self._cache[(platform, item_id)] = item
+            self._cache.move_to_end((platform, item_id))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return item
+
+    def _cached(self, platform: str, item_id: str) -> Optional[Item]:
+        """
+        Get an item from the in-memory cache
+        """
+        with self._lock:
+            item = self._cache.get((platform, item_id))
+            if item is not None:
+                self._cache.move_to_end((platform, item_id))
+        return item
+
+    def get_item(self, platform: str, item_id: str) -> Item:
+        """
+        Load a STAC item
+
+        Returns a copy of the cached item, so that callers can modify it.
+        """
+        item = self._cached(platform, item_id)
+        if item is None:
+            item = self._load(platform, item_id)
+        return item.clone()
+
+    def get_items(self, keys: Iterable[Tuple[str, str]]) -> List[Item]:
+        """
+        Load multiple STAC items, fetching uncached items concurrently
+
+        The keys are tuples of platform and item id.
+        """
+        keys = list(keys)
+        missing = list({key: None for key in keys if self._cached(*key) is None}.keys())
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                loaded = dict(
+                    zip(missing, executor.map(lambda key: self._load(*key), missing))
+                )
+        else:
+            loaded = {}
+        return [
+            (loaded.get(key) or self._cached(*key) or self._load(*key)).clone()
+            for key in keys
+        ]
+
+    def load_indexer(
+        self,
+        platform: str,
+        item_id: str,
+        indexer_class: Type[ChipIndexer] = ChipIndexer,
+    ) -> ChipIndexer:
+        """
+        Load the indexer for a STAC item
+        """
+        return indexer_class(self.get_item(platform, item_id))
+
+    def load_indexers(
+        self,
+        keys: Iterable[Tuple[str, str]],
+        indexer_class: Type[ChipIndexer] = ChipIndexer,
+    ) -> List[ChipIndexer]:
+        """
+        Load the indexers for multiple STAC items
+        """
+        return [indexer_class(item) for item in self.get_items(keys)]
+
+
+@lru_cache(maxsize=None)
+def get_item_store(bucket: str) -> ItemStore:
+    """
+    Process-wide item store for a bucket
+
+    The STACCHIP_ITEM_CACHE_DIR env var can be used to enable the disk cache.
+    """
+    return ItemStore(
+        bucket=bucket,
+        cache_dir=os.environ.get("STACCHIP_ITEM_CACHE_DIR", None),
+    )
 
 
 def load_indexer_s3(bucket: str, platform: str, item_id: str) -> ChipIndexer:
     """
     Load stacchip index table from a remote location
     """
-    s3 = boto3.resource("s3")
-    s3_bucket = s3.Bucket(name=bucket)
-    content_object = s3_bucket.Object(f"{platform}/{item_id}/stac_item.json")
-    file_content = content_object.get()["Body"].read().decode("utf-8")
-    json_content = json.loads(file_content)
-    item = Item.from_dict(json_content)
+    return get_item_store(bucket).load_indexer(platform, item_id)
 
-    return ChipIndexer(item)
+
+def load_indexers(bucket: str, keys: Iterable[Tuple[str, str]]) -> List[ChipIndexer]:
+    """
+    Load stacchip indexers for multiple items from a remote location
+
+    The keys are tuples of platform and item id. Items are fetched
+    concurrently and cached in the process-wide item store.
+    """
+    return get_item_store(bucket).load_indexers(keys)
 
 
 def load_indexer_local(mountpath: Path, platform: str, item_id: str) -> ChipIndexer:
@@ -27,3 +253,72 @@ def load_indexer_local(mountpath: Path, platform: str, item_id: str) -> ChipInde
     """
     item = Item.from_file(mountpath / Path(f"{platform}/{item_id}/stac_item.json"))
     return ChipIndexer(item)
+
+
+def catalog_table(items: List[Item], platform: str) -> pa.Table:
+    """
+    Create catalog table rows for STAC items
+
+    The catalog holds the indexer snapshots of the items and their platform.
+    Tables for single items can be written next to each other and read as
+    one consolidated catalog, similar to the index files.
+    """
+    table = snapshots_to_table([ChipIndexer(item).snapshot() for item in items])
+    return table.add_column(
+        1, CATALOG_SCHEMA.field("platform"), pa.array([platform] * len(items))
+    )
+
+
+def load_snapshots_catalog(
+    path: Union[str, Path],
+    platform: Optional[str] = None,
+    item_ids: Optional[List[str]] = None,
+) -> Dict[str, IndexerSnapshot]:
+    """
+    Load indexer snapshots from a consolidated catalog
+
+    Reads the catalog columns in one columnar read, memory-mapping local
+    files. Returns snapshots by item id.
+    """
+    filters = None
+    if platform is not None:
+        filters = pc.field("platform") == platform
+    if item_ids is not None:
+        id_filter = pc.field("item_id").isin(item_ids)
+        filters = id_filter if filters is None else filters & id_filter
+
+    table = pq.read_table(
+        path,
+        columns=SNAPSHOT_SCHEMA.names,
+        filters=filters,
+        memory_map="://" not in str(path),
+    )
+    return {snapshot.item_id: snapshot for snapshot in snapshots_from_table(table)}
+
+
+def load_catalog(
+    path: Union[str, Path],
+    platform: Optional[str] = None,
+    item_ids: Optional[List[str]] = None,
+) -> Dict[str, Item]:
+    """
+    Load minimal STAC items from a consolidated catalog by item id
+    """
+    snapshots = load_snapshots_catalog(path, platform=platform, item_ids=item_ids)
+    return {item_id: snapshot.to_item() for item_id, snapshot in snapshots.items()}
+
+
+def load_indexers_catalog(
+    path: Union[str, Path],
+    platform: Optional[str] = None,
+    item_ids: Optional[List[str]] = None,
+    indexer_class: Type[ChipIndexer] = ChipIndexer,
+) -> Dict[str, ChipIndexer]:
+    """
+    Load stacchip indexers from a consolidated catalog
+    """
+    snapshots = load_snapshots_catalog(path, platform=platform, item_ids=item_ids)
+    return {
+        item_id: indexer_class.from_snapshot(snapshot)
+        for item_id, snapshot in snapshots.items()
+    }
@@ -1,43 +1,65 @@
+import asyncio
+import datetime
 import json
+import threading
+import time
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
+import mock
 import numpy as np
+import pyarrow as pa
+import pytest
 import rasterio
 from numpy.testing import assert_array_equal
 from pystac import Item
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
 
-from stacchip.chipper import Chipper
-from stacchip.indexer import NoStatsChipIndexer
+from stacchip.chipper import (
+    AsyncChipper,
+    Chipper,
+    TimeSeriesChipper,
+)
+from stacchip.fetcher import ChipFetcher
+from stacchip.indexer import TARGET_CRS_PROPERTY, NoStatsChipIndexer
+
+
+def write_test_item(mountpath: Path, item_id: str = "item1") -> tuple:
+    target_dir = mountpath / f"naip/{item_id}"
+    target_dir.mkdir(parents=True, exist_ok=True)
+    item = Item.from_file("tests/data/stacchip_test_item.json")
+    item.id = item_id
+    shape = item.properties["proj:shape"]
+    size = shape[0] * shape[1]
+    trsf = item.properties["proj:transform"]
+    bands = 2
+    with rasterio.open(
+        target_dir / "asset.tif",
+        "w",
+        width=shape[1],
+        height=shape[0],
+        count=bands,
+        dtype="uint8",
+        crs="EPSG:26919",
+        transform=[trsf[2], trsf[0], trsf[1], trsf[5], trsf[4], trsf[3]],
+    ) as rst:
+        raster_data = np.random.randint(0, 255, bands * size, dtype="uint8").reshape(
+            (bands, *shape)
+        )
+        rst.write(raster_data)
+
+    item.assets["asset"].href = f"s3://example-bucket/naip/{item_id}/asset.tif"
+    with open(target_dir / "stac_item.json", "w") as dst:
+        dst.write(json.dumps(item.to_dict()))
+
+    return item, raster_data
 
 
 def test_no_stats_indexer():
     with TemporaryDirectory() as dirname:
         mountpath = Path(dirname)
-        target_dir = mountpath / "naip/item1"
-        target_dir.mkdir(parents=True, exist_ok=True)
-        item = Item.from_file("tests/data/stacchip_test_item.json")
-        shape = item.properties["proj:shape"]
-        size = shape[0] * shape[1]
-        trsf = item.properties["proj:transform"]
-        bands = 2
-        with rasterio.open(
-            mountpath / "naip/item1/asset.tif",
-            "w",
-            width=shape[1],
-            height=shape[0],
-            count=bands,
-            dtype="uint8",
-            transform=[trsf[2], trsf[0], trsf[1], trsf[5], trsf[4], trsf[3]],
-        ) as rst:
-            raster_data = np.random.randint(
-                0, 255, bands * size, dtype="uint8"
-            ).reshape((bands, *shape))
-            rst.write(raster_data)
-
-        item.assets["asset"].href = "s3://example-bucket/naip/item1/asset.tif"
-        with open(mountpath / "naip/item1/stac_item.json", "w") as dst:
-            dst.write(json.dumps(item.to_dict()))
+        item, raster_data = write_test_item(mountpath)
         indexer = NoStatsChipIndexer(item)
         index = indexer.create_index()
         chipper = Chipper(indexer, mountpath=mountpath)
@@ -63,3 +85,211 @@ def test_no_stats_indexer():
         for _chip in chipper:
             counter += 1
         assert counter == len(chipper)
+
+
+def test_async_chipper():
+    with TemporaryDirectory() as dirname:
+        mountpath = Path(dirname)
+        item, raster_data = write_test_item(mountpath)
+        indexer = NoStatsChipIndexer(item)
+        chipper = Chipper(indexer, mountpath=mountpath)
+        indices = [(0, 0), (1, 2), (2, 1)]
+
+        async def fetch():
+            async with AsyncChipper(
+                indexer, mountpath=mountpath, max_concurrency=2
+            ) as async_chipper:
+                single = await async_chipper.achip(*indices[0])
+                multiple = await async_chipper.achips(indices)
+            return single, multiple
+
+        single, multiple = asyncio.run(fetch())
+        assert_array_equal(single["asset"], chipper.chip(*indices[0])["asset"])
+        assert len(multiple) == len(indices)
+        for (x, y), chip in zip(indices, multiple):
+            assert_array_equal(chip["asset"], chipper.chip(x, y)["asset"])
+
+        # The chipper can be reused across event loops without keeping them
+        async_chipper = AsyncChipper(indexer, mountpath=mountpath, max_concurrency=2)
+        assert async_chipper.max_workers == 2
+        with mock.patch.object(
+            indexer, "open_asset", wraps=indexer.open_asset
+        ) as open_asset:
+            for _ in range(3):
+                chips = asyncio.run(async_chipper.achips(indices))
+                assert len(chips) == len(indices)
+        assert len(async_chipper._semaphores) == 1
+        # Datasets are opened at most once per thread and kept open
+        assert 1 <= open_asset.call_count <= async_chipper.max_workers
+        datasets = list(async_chipper._exit_stack._exit_callbacks)
+        assert len(datasets) == open_asset.call_count
+        async_chipper.close()
+        assert len(async_chipper._semaphores) == 0
+        assert not async_chipper._exit_stack._exit_callbacks
+
+
+def test_async_chipper_concurrency():
+    with TemporaryDirectory() as dirname:
+        mountpath = Path(dirname)
+        item, raster_data = write_test_item(mountpath)
+        indexer = NoStatsChipIndexer(item)
+        indices = [(x, y) for x in range(3) for y in range(3)]
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def read_chip(self, src, x, y):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+            return Chipper.read_chip(self, src, x, y)
+
+        async def fetch(**kwargs):
+            async with AsyncChipper(indexer, mountpath=mountpath, **kwargs) as chipper:
+                return await chipper.achips(indices)
+
+        with mock.patch.object(AsyncChipper, "read_chip", read_chip):
+            # All reads up to max_concurrency are in flight at the same time
+            asyncio.run(fetch(max_concurrency=4))
+            assert max(peak) == 4
+            # A smaller pool limits the reads in flight
+            peak.clear()
+            asyncio.run(fetch(max_concurrency=4, max_workers=2))
+            assert max(peak) == 2
+
+
+def test_time_series_chipper():
+    with TemporaryDirectory() as dirname:
+        mountpath = Path(dirname)
+        item1, data1 = write_test_item(mountpath, "item1")
+        item2, data2 = write_test_item(mountpath, "item2")
+        item1.datetime = datetime.datetime(2024, 2, 1)
+        item2.datetime = datetime.datetime(2024, 1, 1)
+        indexers = [NoStatsChipIndexer(item1), NoStatsChipIndexer(item2)]
+
+        with TimeSeriesChipper(indexers, mountpath=mountpath) as chipper:
+            assert chipper.datetimes == [item2.datetime, item1.datetime]
+            assert len(chipper) == indexers[0].size
+            stack = chipper.chip(1, 2)
+            x_index, y_index, stack_1 = chipper[1]
+
+        size = indexers[0].chip_size
+        assert stack.shape == (2, 2, size, size)
+        assert_array_equal(stack[0], data2[:, 2 * size : 3 * size, 1 * size : 2 * size])
+        assert_array_equal(stack[1], data1[:, 2 * size : 3 * size, 1 * size : 2 * size])
+        assert (x_index, y_index) == (1, 0)
+        assert_array_equal(stack_1[0], data2[:, :size, size : 2 * size])
+
+        with pytest.raises(ValueError):
+            TimeSeriesChipper(
+                [NoStatsChipIndexer(item1), NoStatsChipIndexer(item2, shape=[10, 10])]
+            )
+
+
+def test_time_series_chipper_validation():
+    with TemporaryDirectory() as dirname:
+        mountpath = Path(dirname)
+        utc = datetime.timezone.utc
+        item1, _ = write_test_item(mountpath, "item1")
+        item2, _ = write_test_item(mountpath, "item2")
+        # Items covering a date range are sorted by their start datetime
+        item1.datetime = None
+        item1.common_metadata.start_datetime = datetime.datetime(2024, 3, 1, tzinfo=utc)
+        item1.common_metadata.end_datetime = datetime.datetime(2024, 3, 31, tzinfo=utc)
+        item2.datetime = datetime.datetime(2024, 2, 1, tzinfo=utc)
+        indexers = [NoStatsChipIndexer(item1), NoStatsChipIndexer(item2)]
+
+        with TimeSeriesChipper(indexers, mountpath=mountpath) as chipper:
+            assert chipper.datetimes == [
+                datetime.datetime(2024, 2, 1, tzinfo=utc),
+                datetime.datetime(2024, 3, 1, tzinfo=utc),
+            ]
+            assert chipper.chip(0, 0).shape[0] == 2
+
+        item2.assets["extra"] = item2.assets["asset"].clone()
+        with pytest.raises(ValueError, match="item1 is missing assets extra"):
+            TimeSeriesChipper(indexers, mountpath=mountpath, assets=["asset", "extra"])
+
+
+def test_warped_chipper():
+    with TemporaryDirectory() as dirname:
+        mountpath = Path(dirname)
+        item, raster_data = write_test_item(mountpath)
+        item.properties[TARGET_CRS_PROPERTY] = "EPSG:3857"
+        indexer = NoStatsChipIndexer(item)
+        assert indexer.target_crs == "EPSG:3857"
+        assert indexer.crs.to_epsg() == 3857
+        assert indexer.source_crs.to_epsg() == 26919
+        assert indexer.transform != indexer.source_transform
+        assert indexer.size > 0
+
+        with Chipper(indexer, mountpath=mountpath, keep_open=True) as chipper:
+            chip = chipper.chip(1, 0)
+            assert chip["asset"].shape == (2, indexer.chip_size, indexer.chip_size)
+
+        with rasterio.open(mountpath / "naip/item1/asset.tif") as src:
+            with WarpedVRT(src, **indexer.warp_options) as vrt:
+                expected = vrt.read(
+                    window=Window(
+                        indexer.chip_size, 0, indexer.chip_size, indexer.chip_size
+                    )
+                )
+        assert_array_equal(chip["asset"], expected)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 32])
+def test_chip_fetcher(batch_size):
+    with TemporaryDirectory() as dirname:
+        mountpath = Path(dirname)
+        data = {
+            "item1": write_test_item(mountpath, "item1")[1],
+            "item2": write_test_item(mountpath, "item2")[1],
+        }
+        rows = pa.table(
+            {
+                "platform": ["naip"] * 5,
+                "item_id": ["item2", "item1", "item2", "item1", "item2"],
+                "chip_index_x": [2, 0, 0, 1, 1],
+                "chip_index_y": [1, 0, 2, 1, 0],
+            }
+        )
+        size = 256
+        fetcher = ChipFetcher(
+            mountpath=mountpath, max_workers=2, buffer_size=1, batch_size=batch_size
+        )
+        fetched = []
+        fetch_item = fetcher.fetch_item
+
+        def counting_fetch_item(*args, **kwargs):
+            result = fetch_item(*args, **kwargs)
+            fetched.extend(result)
+            return result
+
+        chips = []
+        with (
+            mock.patch.object(
+                fetcher, "load_indexer", wraps=fetcher.load_indexer
+            ) as load_indexer,
+            mock.patch.object(fetcher, "fetch_item", counting_fetch_item),
+        ):
+            for chip in fetcher.fetch(rows):
+                chips.append(chip)
+                # Chips held in memory are bounded by buffer and batch size
+                assert len(fetched) - len(chips) <= 1 + batch_size
+        # Items are loaded once, also when their rows are split in batches
+        assert load_indexer.call_count == 2
+
+        assert len(chips) == len(rows)
+        for row, chip in enumerate(chips):
+            x = rows.column("chip_index_x")[row].as_py()
+            y = rows.column("chip_index_y")[row].as_py()
+            expected = data[rows.column("item_id")[row].as_py()][
+                :, y * size : (y + 1) * size, x * size : (x + 1) * size
+            ]
+            assert_array_equal(chip["asset"], expected)
+
+        with pytest.raises(ValueError):
+            ChipFetcher()
@@ -0,0 +1,36 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pytest
+
+from stacchip.processors.cube_formats import CUBE_FORMATS, get_cube_format, read_cube
+
+
+@pytest.mark.parametrize("name", list(CUBE_FORMATS))
+def test_cube_format_roundtrip(name):
+    rng = np.random.default_rng(42)
+    arrays = {
+        "pixels": rng.normal(size=(4, 3, 32, 32)).astype("float32"),
+        "lon_norm": rng.normal(size=(4, 2)).astype("float32"),
+        "chipid": np.array(["a", "b", "c", "dd"]),
+    }
+    cube_format = get_cube_format(name)
+    content = cube_format.encode(arrays)
+    for key, value in cube_format.decode(content).items():
+        np.testing.assert_array_equal(value, arrays[key])
+
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / f"cube.{cube_format.extension}"
+        path.write_bytes(content)
+        cube = read_cube(path)
+        for key, value in arrays.items():
+            np.testing.assert_array_equal(cube[key], value)
+        if name == "raw":
+            assert isinstance(cube["pixels"], np.memmap)
+        del cube
+
+
+def test_cube_format_unknown():
+    with pytest.raises(ValueError):
+        get_cube_format("tif")
@@ -1,4 +1,6 @@
 import datetime
+import math
+import pickle
 
 import mock
 import numpy as np
@@ -14,6 +16,9 @@ from stacchip.indexer import (
     LandsatIndexer,
     NoStatsChipIndexer,
     Sentinel2Indexer,
+    snapshots_from_table,
+    snapshots_to_table,
+    space_time_encodings_from_table,
 )
 
 
@@ -147,6 +152,22 @@ def test_landsat_indexer_nodata():
     assert index.shape == (1024, 7)
 
 
+def test_landsat_indexer_local_hrefs():
+    item = Item.from_file(
+        "tests/data/landsat-c2l2-sr-LC09_L2SR_086107_20240311_20240312_02_T2_SR.json"
+    )
+    href = item.assets["qa_pixel"].href
+    indexer = LandsatIndexer(item, local_hrefs={"qa_pixel": "/scratch/qa.tif"})
+    with mock.patch(
+        "stacchip.indexer.rasterio.open", side_effect=rasterio_open_ls_mock
+    ) as rasterio_open:
+        index = indexer.create_index()
+    rasterio_open.assert_called_once_with("/scratch/qa.tif")
+    assert index.shape == (1024, 7)
+    # The asset href is not replaced by the requester pays href
+    assert item.assets["qa_pixel"].href == href
+
+
 def test_indexer_manual_shape():
     item = Item.from_file(
         "tests/data/landsat-c2l2-sr-LC09_L2SR_086107_20240311_20240312_02_T2_SR.json"
@@ -155,3 +176,51 @@ def test_indexer_manual_shape():
     assert indexer.shape == [230, 420]
     assert indexer.y_size == 2
     assert indexer.x_size == 4
+
+
+def test_indexer_snapshot():
+    item = Item.from_file(
+        "tests/data/sentinel-2-l2a-S2A_T20HNJ_20240311T140636_L2A.json"
+    )
+    indexer = NoStatsChipIndexer(item, chip_size=128)
+    snapshot = indexer.snapshot()
+    assert snapshot.chip_size == 128
+    assert snapshot.assets[0].key == list(item.assets.keys())[0]
+
+    restored = pickle.loads(pickle.dumps(snapshot))
+    assert restored == snapshot
+    assert snapshots_from_table(snapshots_to_table([snapshot])) == [snapshot]
+
+    rebuilt = NoStatsChipIndexer.from_snapshot(snapshot)
+    assert isinstance(rebuilt, NoStatsChipIndexer)
+    assert rebuilt.chip_size == 128
+    assert rebuilt.shape == indexer.shape
+    assert rebuilt.transform == indexer.transform
+    assert rebuilt.crs == indexer.crs
+    assert rebuilt.get_chip_bbox(3, 4).equals(indexer.get_chip_bbox(3, 4))
+    # Transformers are shared between indexers with the same crs
+    assert rebuilt._projector is indexer._projector
+
+
+def test_space_time_encodings():
+    item = Item.from_file("tests/data/naip_m_4207009_ne_19_060_20211024.json")
+    indexer = NoStatsChipIndexer(item, chip_size=2048)
+    index = indexer.create_index(encodings=True)
+    encodings = space_time_encodings_from_table(index)
+    assert encodings["week_norm"].shape == (len(index), 2)
+
+    bounds = indexer.get_chip_bbox(1, 2).bounds
+    row = index.column("chipid").to_pylist().index(f"{item.id}-1-2")
+    lat = math.radians(bounds[1] + (bounds[3] - bounds[1]) / 2)
+    lon = math.radians(bounds[0] + (bounds[2] - bounds[0]) / 2)
+    week = datetime.date(2021, 10, 24).isocalendar().week * 2 * math.pi / 52
+    np.testing.assert_allclose(
+        encodings["lon_norm"][row], [math.sin(lat), math.cos(lat)], rtol=1e-6
+    )
+    np.testing.assert_allclose(
+        encodings["lat_norm"][row], [math.sin(lon), math.cos(lon)], rtol=1e-6
+    )
+    np.testing.assert_allclose(
+        encodings["week_norm"][row], [math.sin(week), math.cos(week)], rtol=1e-6
+    )
+    np.testing.assert_allclose(encodings["hour_norm"][row], [0, -1], atol=1e-6)
@@ -0,0 +1,56 @@
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+
+from stacchip.processors.linz_processor import resample_tiff
+
+
+def test_resample_tiff():
+    height, width = 1500, 1000
+    rows, cols = np.mgrid[0:height, 0:width]
+    data = np.stack(
+        [
+            (cols * 7 + rows * 3) % 256,
+            (cols // 3 + rows) % 256,
+            (rows // 5) % 256,
+            np.full((height, width), 255),
+        ]
+    ).astype("uint8")
+    data[:, :300, :200] = 0
+
+    with TemporaryDirectory() as dirname:
+        source = f"{dirname}/source.tif"
+        with rasterio.open(
+            source,
+            "w",
+            driver="GTiff",
+            width=width,
+            height=height,
+            count=4,
+            dtype="uint8",
+            crs="EPSG:2193",
+            transform=from_origin(1e6, 5e6, 0.05, 0.05),
+        ) as dst:
+            dst.write(data)
+
+        target = f"{dirname}/target.tif"
+        with rasterio.open(source) as dataset:
+            nodata_mask = resample_tiff(dataset, target, strip_size=32)
+            # Reading and resampling the full image gives the same result
+            expected = dataset.read(
+                out_shape=(4, 250, 166), resampling=Resampling.bilinear
+            )[:3]
+
+        with rasterio.open(target) as result:
+            assert result.count == 3
+            assert result.block_shapes[0] == (32, 32)
+            assert result.res == pytest.approx((0.05 * 1000 / 166, 0.3))
+            np.testing.assert_array_equal(result.read(), expected)
+
+        np.testing.assert_array_equal(nodata_mask, expected[0] == 0)
+        assert nodata_mask[:49, :32].all()
+        assert not nodata_mask[51:].any()
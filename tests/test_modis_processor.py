@@ -0,0 +1,72 @@
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import array_bounds, from_origin
+from rasterio.warp import Resampling, calculate_default_transform, reproject
+
+from stacchip.processors.modis_processor import (
+    DST_CRS,
+    get_target_grid,
+    warp_assets,
+    write_cog,
+)
+
+SIN_CRS = rasterio.CRS.from_proj4(
+    "+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +R=6371007.181 +units=m +no_defs"
+)
+
+
+def get_asset(dtype: str, nodata, size: int = 240):
+    transform = from_origin(-6671703.118, 6671703.118, 4633.127165, 4633.127165)
+    data = np.random.randint(0, 10000, (1, size, size)).astype(dtype)
+    profile = {
+        "driver": "GTiff",
+        "dtype": dtype,
+        "nodata": nodata,
+        "width": size,
+        "height": size,
+        "count": 1,
+        "crs": SIN_CRS,
+        "transform": transform,
+    }
+    return data, profile
+
+
+def test_warp_assets():
+    assets = {
+        "sur_refl_b01": get_asset("int16", -28672),
+        "sur_refl_b02": get_asset("int16", -28672),
+        "sur_refl_qc_500m": get_asset("uint32", None),
+    }
+    get_target_grid.cache_clear()
+    warped = warp_assets(assets, num_threads=2)
+    assert get_target_grid.cache_info().misses == 1
+
+    for key, (data, profile) in assets.items():
+        # Compare to warping the band on its own
+        bounds = array_bounds(profile["height"], profile["width"], profile["transform"])
+        transform, width, height = calculate_default_transform(
+            SIN_CRS, DST_CRS, profile["width"], profile["height"], *bounds
+        )
+        expected = np.full((1, height, width), profile["nodata"] or 0, data.dtype)
+        reproject(
+            source=data,
+            destination=expected,
+            src_transform=profile["transform"],
+            src_crs=SIN_CRS,
+            src_nodata=profile["nodata"],
+            dst_transform=transform,
+            dst_crs=DST_CRS,
+            dst_nodata=profile["nodata"],
+            resampling=Resampling.nearest,
+        )
+        result, result_profile = warped[key]
+        assert result_profile["transform"] == transform
+        np.testing.assert_array_equal(result, expected)
+
+        with MemoryFile(write_cog(result, result_profile)) as memfile:
+            with memfile.open() as src:
+                assert src.block_shapes[0] == (512, 512)
+                assert src.nodata == profile["nodata"]
+                assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+                np.testing.assert_array_equal(src.read(), expected)
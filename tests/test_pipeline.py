@@ -0,0 +1,145 @@
+import threading
+import time
+
+import mock
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from pystac import Item
+
+from stacchip.indexer import NoStatsChipIndexer
+from stacchip.processors.pipeline import IngestPipeline, Scene
+
+ITEM_PATH = "tests/data/naip_m_4207009_ne_19_060_20211024.json"
+
+
+class DummyPipeline(IngestPipeline):
+    """
+    Pipeline that ingests copies of the test item
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Init DummyPipeline
+        """
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def queries(self):
+        """
+        Numbered queries
+        """
+        return range(12)
+
+    def search(self, query):
+        """
+        Skip every third query
+        """
+        if query % 3 == 0:
+            return []
+        item = Item.from_file(ITEM_PATH)
+        item.id = f"item-{query}"
+        return [Scene(item=item, platform="naip", source=query)]
+
+    def transfer(self, scene):
+        """
+        Track the number of concurrent transfers
+        """
+        if scene.source == 4:
+            raise ValueError("Transfer failed")
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        local_path = scene.scratch_path("asset.tif")
+        with open(local_path, "w") as dst:
+            dst.write("local")
+        scene.local_hrefs["asset"] = local_path
+        return None if scene.source == 5 else scene
+
+    def indexer(self, scene):
+        """
+        Index without nodata statistics
+        """
+        with open(scene.local_hrefs["asset"]) as src:
+            assert src.read() == "local"
+        return NoStatsChipIndexer(scene.item)
+
+
+class SucceedingPipeline(DummyPipeline):
+    """
+    Dummy pipeline without failing transfers
+    """
+
+    def queries(self):
+        """
+        Numbered queries, skipping the failing one
+        """
+        return [query for query in range(12) if query != 4]
+
+
+def test_ingest_pipeline():
+    client = mock.MagicMock()
+    pipeline = SucceedingPipeline(
+        "bucket",
+        search_workers=2,
+        transfer_workers=3,
+        index_workers=1,
+        client=client,
+        job=7,
+    )
+    scenes = pipeline.run()
+
+    # Queries 0, 3, 6 and 9 are skipped in search, 5 in transfer
+    assert sorted(scene.source for scene in scenes) == [1, 2, 7, 8, 10, 11]
+    # Local copies are removed once the scenes are indexed
+    assert all(scene.scratch is None for scene in scenes)
+    assert all(not scene.local_hrefs for scene in scenes)
+    assert pipeline.max_active <= 3
+    assert pipeline.timer.calls == {"search": 11, "transfer": 7, "index": 6}
+
+    keys = {call.kwargs["Key"] for call in client.put_object.call_args_list}
+    assert len(keys) == 13
+    assert "naip/item-1/stac_item.json" in keys
+    assert "index/naip/item-1/index_item-1.parquet" in keys
+    # The catalog rows of all scenes are written in one file per job
+    catalog_key = "catalog/naip/catalog_job_7.parquet"
+    assert catalog_key in keys
+    body = next(
+        call.kwargs["Body"]
+        for call in client.put_object.call_args_list
+        if call.kwargs["Key"] == catalog_key
+    )
+    catalog = pq.read_table(pa.BufferReader(body))
+    assert sorted(catalog.column("item_id").to_pylist()) == [
+        f"item-{query}" for query in [1, 10, 11, 2, 7, 8]
+    ]
+
+
+def test_ingest_pipeline_error():
+    pipeline = DummyPipeline("bucket", client=mock.MagicMock())
+    with pytest.raises(ValueError, match="Transfer failed"):
+        pipeline.run()
+
+    # Errors writing the catalog do not replace the error of the stage
+    pipeline = DummyPipeline("bucket", client=mock.MagicMock())
+    with (
+        mock.patch.object(
+            pipeline, "write_catalog", side_effect=OSError("Put failed")
+        ) as write_catalog,
+        pytest.raises(ValueError, match="Transfer failed"),
+    ):
+        pipeline.run()
+    assert write_catalog.call_count == 1
+
+
+def test_ingest_pipeline_single_pass_env():
+    for value, expected in [("1", True), ("0", False), ("false", False)]:
+        with mock.patch.dict("os.environ", {"STACCHIP_SINGLE_PASS": value}):
+            assert IngestPipeline("bucket").single_pass is expected
+    with mock.patch.dict("os.environ", {"STACCHIP_SINGLE_PASS": "0"}):
+        assert IngestPipeline("bucket", single_pass=True).single_pass is True
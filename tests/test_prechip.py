@@ -0,0 +1,331 @@
+from multiprocessing.pool import ThreadPool
+from multiprocessing.shared_memory import SharedMemory
+
+import mock
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from stacchip.processors.bands import PLATFORM_BANDS
+from stacchip.processors.cube_formats import CubeFormat
+from stacchip.processors.prechip import (
+    CHIPSIZE,
+    CubeBuffer,
+    CubeManifest,
+    CubePipeline,
+    get_cube_chips,
+    upload_cube,
+)
+
+NAIP_BAND_COUNT = len(PLATFORM_BANDS["naip"].bands)
+
+
+def chip_value(item_id: str, x: int, y: int) -> int:
+    return {"a": 0, "b": 100}[item_id] + 10 * y + x
+
+
+class FakeChipper:
+    """
+    Chipper stand-in that fills chips with a value derived from the location
+    """
+
+    def __init__(self, indexer, assets=None, keep_open=False):
+        """
+        Init FakeChipper
+        """
+        self.indexer = indexer
+
+    def __enter__(self):
+        """
+        Enter the context manager
+        """
+        return self
+
+    def __exit__(self, *args):
+        """
+        Exit the context manager
+        """
+
+    def chip(self, x, y):
+        """
+        Chip of the naip image asset
+        """
+        value = chip_value(self.indexer.item.id, x, y)
+        if value < 0:
+            raise ValueError("Reading chip failed")
+        return {"image": np.full((NAIP_BAND_COUNT, CHIPSIZE, CHIPSIZE), value)}
+
+
+def load_indexer_mock(bucket, platform, item_id):
+    indexer = mock.MagicMock()
+    indexer.item.id = item_id
+    indexer.item.assets = {"image": None}
+    return indexer
+
+
+def attach_recorder(attached):
+    def attach(*args, **kwargs):
+        shm = SharedMemory(*args, **kwargs)
+        attached.append(shm)
+        return shm
+
+    return attach
+
+
+def is_unlinked(name: str) -> bool:
+    try:
+        SharedMemory(name=name).close()
+    except FileNotFoundError:
+        return True
+    return False
+
+
+class RecordingPool:
+    """
+    Pool stand-in that returns the chip indices of each batch
+    """
+
+    def __init__(self):
+        """
+        Init RecordingPool
+        """
+        self.batches = []
+
+    def starmap(self, func, iterable, chunksize=None):
+        """
+        Record the batches and return their chips by slot
+        """
+        results = []
+        for _, _, item_id, chips, _ in iterable:
+            self.batches.append((item_id, chips))
+            results.append([(slot, (item_id, x, y)) for slot, x, y in chips])
+        return results
+
+
+def test_get_cube_chips():
+    # Item a has five chips in shuffled order, item b two
+    indices = [
+        ("a", 3, 1),
+        ("b", 0, 0),
+        ("a", 0, 2),
+        ("a", 1, 0),
+        ("b", 1, 0),
+        ("a", 2, 1),
+        ("a", 0, 0),
+    ]
+    all_chips = [
+        ("bucket", row, "naip", item_id, x, y)
+        for row, (item_id, x, y) in enumerate(indices)
+    ]
+    pool = RecordingPool()
+    data = get_cube_chips(all_chips, pool, batch_size=2)
+
+    # Chips are returned in the order of the input
+    assert data == indices
+
+    # Large items are split into batches, read in grid order
+    assert [item_id for item_id, _ in pool.batches] == ["a", "a", "a", "b"]
+    assert all(len(chips) <= 2 for _, chips in pool.batches)
+    a_chips = [
+        chip for item_id, chips in pool.batches if item_id == "a" for chip in chips
+    ]
+    assert [(x, y) for _, x, y in a_chips] == [(0, 0), (1, 0), (2, 1), (3, 1), (0, 2)]
+
+    pool = RecordingPool()
+    assert get_cube_chips(all_chips, pool) == indices
+    assert len(pool.batches) == 2
+
+
+def test_cube_buffer_dtype():
+    for spec in PLATFORM_BANDS.values():
+        shape = (2, len(spec.bands), 8, 8)
+        buffer, shm = CubeBuffer.create(shape, spec.dtype)
+        try:
+            assert buffer.dtype == spec.dtype
+            assert shm.size >= int(np.prod(shape)) * np.dtype(spec.dtype).itemsize
+            cube = buffer.array(shm)
+            assert cube.dtype == np.dtype(spec.dtype)
+            del cube
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+@mock.patch("stacchip.processors.prechip.Chipper", FakeChipper)
+@mock.patch("stacchip.processors.prechip.load_indexer_s3", load_indexer_mock)
+def test_get_cube_chips_buffer():
+    indices = [("b", 1, 0), ("a", 2, 1), ("a", 0, 0), ("b", 0, 2), ("a", 1, 0)]
+    all_chips = [
+        ("bucket", row, "naip", item_id, x, y)
+        for row, (item_id, x, y) in enumerate(indices)
+    ]
+    shape = (len(indices), NAIP_BAND_COUNT, CHIPSIZE, CHIPSIZE)
+    buffer, shm = CubeBuffer.create(shape, "uint8")
+    attached: list = []
+    try:
+        with (
+            mock.patch(
+                "stacchip.processors.prechip.SharedMemory",
+                side_effect=attach_recorder(attached),
+            ),
+            ThreadPool(2) as pool,
+        ):
+            data = get_cube_chips(all_chips, pool, buffer, batch_size=2)
+
+        # Pixels are written into the buffer instead of being returned
+        assert data == [{}] * len(indices)
+        cube = buffer.array(shm)
+        for slot, (item_id, x, y) in enumerate(indices):
+            assert (cube[slot] == chip_value(item_id, x, y)).all()
+        del cube
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # Every chip attached to the buffer once and closed it again
+    assert len(attached) == len(indices)
+    assert all(attachment.buf is None for attachment in attached)
+    assert is_unlinked(buffer.name)
+
+
+def test_cube_buffer_write_error():
+    buffer, shm = CubeBuffer.create((2, NAIP_BAND_COUNT, 4, 4), "uint8")
+    attached: list = []
+    try:
+        with (
+            mock.patch(
+                "stacchip.processors.prechip.SharedMemory",
+                side_effect=attach_recorder(attached),
+            ),
+            pytest.raises(ValueError),
+        ):
+            buffer.write(1, np.zeros((NAIP_BAND_COUNT + 1, 4, 4)))
+    finally:
+        shm.close()
+        shm.unlink()
+    # The attachment is closed when writing fails
+    assert len(attached) == 1
+    assert attached[0].buf is None
+
+
+@mock.patch("stacchip.processors.prechip.upload_cube")
+@mock.patch("stacchip.processors.prechip.Chipper", FakeChipper)
+@mock.patch("stacchip.processors.prechip.load_indexer_s3", load_indexer_mock)
+def test_cube_pipeline_buffers_released(upload_cube):
+    indices = [("a", 0, 0), ("b", 1, 1)]
+    all_chips = [
+        ("bucket", row, "naip", item_id, x, y)
+        for row, (item_id, x, y) in enumerate(indices)
+    ]
+    shape = (len(indices), NAIP_BAND_COUNT, CHIPSIZE, CHIPSIZE)
+
+    # Success path, the cube is written and the buffers are freed
+    pipeline = CubePipeline(shape, "chip-bucket", "naip", dtype="uint8")
+    names = [buffer.name for buffer, _ in pipeline._buffers]
+    with ThreadPool(2) as pool:
+        pipeline.start()
+        try:
+            buffer = pipeline.acquire()
+            get_cube_chips(all_chips, pool, buffer[0])
+            pipeline.submit({}, 0, buffer)
+        finally:
+            pipeline.close()
+    assert upload_cube.call_count == 1
+    assert all(shm.buf is None for _, shm in pipeline._buffers)
+    assert all(is_unlinked(name) for name in names)
+
+    # Error path, fetching the chips fails while a buffer is in use
+    pipeline = CubePipeline(shape, "chip-bucket", "naip", dtype="uint8")
+    names = [buffer.name for buffer, _ in pipeline._buffers]
+    failing = all_chips + [("bucket", 2, "naip", "a", -1, 0)]
+    with ThreadPool(2) as pool, pytest.raises(ValueError, match="Reading chip"):
+        pipeline.start()
+        try:
+            buffer = pipeline.acquire()
+            get_cube_chips(failing, pool, buffer[0])
+        finally:
+            pipeline.close()
+    assert upload_cube.call_count == 1
+    assert all(shm.buf is None for _, shm in pipeline._buffers)
+    assert all(is_unlinked(name) for name in names)
+
+
+@mock.patch("stacchip.processors.prechip.upload_cube")
+def test_cube_pipeline_order(upload_cube_mock):
+    shape = (2, 3, 4, 4)
+    pipeline = CubePipeline(shape, "chip-bucket", "naip", depth=2, dtype="uint8")
+    pipeline.start()
+    try:
+        for cube_id in range(6):
+            buffer = pipeline.acquire()
+            buffer[0].array(buffer[1])[:] = cube_id
+            pipeline.submit({}, cube_id, buffer, chipids=[f"{cube_id}-0", "1"])
+    finally:
+        pipeline.close()
+
+    # Cubes are written in the order they were submitted, with their pixels
+    cube_ids = [call.args[1] for call in upload_cube_mock.call_args_list]
+    assert cube_ids == list(range(6))
+    for cube_id, call in enumerate(upload_cube_mock.call_args_list):
+        cube = CubeFormat().decode(call.args[0])
+        assert (cube["pixels"] == cube_id).all()
+        assert cube["chipid"][0] == f"{cube_id}-0"
+    assert set(pipeline.timings) >= {"compress", "upload"}
+
+
+@mock.patch("stacchip.processors.prechip.upload_cube")
+def test_cube_pipeline_writer_error(upload_cube_mock):
+    upload_cube_mock.side_effect = ValueError("Upload failed")
+    pipeline = CubePipeline((2, 3, 4, 4), "chip-bucket", "naip", depth=1)
+    names = [buffer.name for buffer, _ in pipeline._buffers]
+    pipeline.start()
+    with pytest.raises(RuntimeError, match="Writing cube failed") as info:
+        try:
+            for cube_id in range(4):
+                pipeline.submit({}, cube_id, pipeline.acquire())
+        finally:
+            pipeline.close()
+
+    # The error of the writer thread is raised in the caller, later cubes
+    # are not written and the buffers are freed
+    assert isinstance(info.value.__cause__, ValueError)
+    assert upload_cube_mock.call_count == 1
+    assert all(is_unlinked(name) for name in names)
+
+
+@mock.patch("stacchip.processors.prechip.get_s3_client")
+def test_upload_cube(get_s3_client):
+    upload_cube(b"cube", 3, "chip-bucket", "naip", "npz")
+    upload_cube(b"cube", 4, "chip-bucket", "naip", "npz")
+    # The pooled client is used for all cubes
+    assert get_s3_client.call_count == 2
+    client = get_s3_client.return_value
+    keys = [call.kwargs["Key"] for call in client.upload_fileobj.call_args_list]
+    assert keys == [
+        "mode_v1_chipper_v2/naip/cube_3.npz",
+        "mode_v1_chipper_v2/naip/cube_4.npz",
+    ]
+
+
+def test_cube_manifest():
+    client = mock.MagicMock()
+    # Manifest of a previous run, written before cubes were verified
+    previous = pa.table({"cube_id": [1], "key": ["cube_1.npz"], "size": [10]})
+    sink = pa.BufferOutputStream()
+    pq.write_table(previous, sink)
+    client.get_object.return_value = {"Body": pa.BufferReader(sink.getvalue())}
+
+    manifest = CubeManifest("chip-bucket", "manifest.parquet", client=client)
+    manifest.load()
+    assert 1 in manifest
+    manifest.add(2, "cube_2.npz", ["a", "b"], ["item"], 20, "abc")
+    manifest.add(3, "cube_3.npz", [], [], 30, verified=False)
+
+    body = client.put_object.call_args_list[-1].kwargs["Body"]
+    rows = pq.read_table(pa.BufferReader(body)).to_pylist()
+    assert [row["cube_id"] for row in rows] == [1, 2, 3]
+    assert [row["verified"] for row in rows] == [None, True, False]
+    assert rows[1]["chipids"] == ["a", "b"]
+    assert rows[2]["chipids"] == []
+    assert rows[2]["checksum"] is None
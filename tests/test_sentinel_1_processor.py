@@ -0,0 +1,43 @@
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from stacchip.processors.sentinel_1_processor import copy_raster
+
+
+def test_copy_raster():
+    data = np.random.random((1, 700, 600)).astype("float32")
+    data[0, :100, :50] = -32768
+
+    with TemporaryDirectory() as dirname:
+        source = f"{dirname}/source.tif"
+        with rasterio.open(
+            source,
+            "w",
+            driver="GTiff",
+            width=600,
+            height=700,
+            count=1,
+            dtype="float32",
+            nodata=-32768,
+            crs="EPSG:32633",
+            transform=from_origin(500000, 5000000, 10, 10),
+        ) as dst:
+            dst.write(data)
+
+        target = f"{dirname}/target.tif"
+        with rasterio.open(source) as dataset:
+            nodata_mask = copy_raster(dataset, target, block_size=256)
+            assert (
+                copy_raster(dataset, f"{dirname}/nomask.tif", with_mask=False) is None
+            )
+
+        with rasterio.open(target) as result:
+            assert result.block_shapes[0] == (256, 256)
+            assert result.compression.value == "DEFLATE"
+            assert result.nodata == -32768
+            np.testing.assert_array_equal(result.read(), data)
+
+        np.testing.assert_array_equal(nodata_mask, data[0] == -32768)
@@ -0,0 +1,295 @@
+import io
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import mock
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from stacchip.processors.bands import PLATFORM_BANDS, get_platform_bands
+from stacchip.processors.cube_formats import (
+    CUBE_FORMATS,
+    ArrowFormat,
+    ChunkedFormat,
+    get_cube_format,
+)
+from stacchip.processors.stats import (
+    BandHistogram,
+    BandStats,
+    StatsState,
+    get_stats_keys,
+    iter_cube_chunks,
+    iter_npz_chunks,
+    list_cube_keys,
+    sample_stats,
+)
+
+
+def get_chunks(nodata: float = 0):
+    rng = np.random.default_rng(42)
+    chunks = [rng.integers(0, 1000, (3, 500)).astype("float64") for _ in range(4)]
+    chunks[1][0, :100] = nodata
+    # The last band of the last chunk has no valid pixels
+    chunks[3][2] = nodata
+    return chunks
+
+
+def test_band_stats_update():
+    chunks = get_chunks()
+    stats = BandStats.empty(3)
+    for chunk in chunks:
+        stats.update(chunk, nodata=0)
+
+    pixels = np.concatenate(chunks, axis=1)
+    for band, values in enumerate(pixels):
+        values = values[values != 0]
+        assert stats.count[band] == values.size
+        assert stats.mean[band] == pytest.approx(values.mean())
+        assert stats.std[band] == pytest.approx(values.std())
+
+
+def test_band_stats_merge():
+    chunks = get_chunks()
+    expected = BandStats.empty(3)
+    for chunk in chunks:
+        expected.update(chunk, nodata=0)
+
+    # Partial stats give the same result as updating a single accumulator
+    first = BandStats.empty(3).update(chunks[0], 0).update(chunks[1], 0)
+    second = BandStats.empty(3).update(chunks[2], 0).update(chunks[3], 0)
+    merged = BandStats.empty(3).merge(first).merge(BandStats.empty(3)).merge(second)
+    np.testing.assert_array_equal(merged.count, expected.count)
+    np.testing.assert_allclose(merged.mean, expected.mean)
+    np.testing.assert_allclose(merged.m2, expected.m2)
+
+    empty = BandStats.empty(3)
+    assert np.isnan(empty.std).all()
+
+
+def test_iter_npz_chunks():
+    pixels = np.arange(4 * 3 * 8 * 8, dtype="uint16").reshape(4, 3, 8, 8)
+    content = get_cube_format("npz").encode(
+        {"pixels": pixels, "lat_norm": np.zeros((4, 2))}
+    )
+    chunks = list(iter_npz_chunks(io.BytesIO(content)))
+    assert len(chunks) == 4
+    for chunk, expected in zip(chunks, pixels):
+        assert chunk.dtype == pixels.dtype
+        np.testing.assert_array_equal(chunk, expected)
+
+    chunks = list(iter_npz_chunks(io.BytesIO(content), key="lat_norm"))
+    assert [chunk.shape for chunk in chunks] == [(2,)] * 4
+
+
+@pytest.mark.parametrize("name", list(CUBE_FORMATS))
+def test_iter_cube_chunks(name):
+    pixels = np.arange(4 * 3 * 8 * 8, dtype="float32").reshape(4, 3, 8, 8)
+    cube_format = get_cube_format(name)
+    with TemporaryDirectory() as dirname:
+        path = Path(dirname) / f"cube_0.{cube_format.extension}"
+        path.write_bytes(cube_format.encode({"pixels": pixels}))
+        chunks = list(iter_cube_chunks(path))
+        assert len(chunks) == 4
+        for chunk, expected in zip(chunks, pixels):
+            np.testing.assert_array_equal(chunk, expected)
+        del chunks
+
+
+@pytest.mark.parametrize("name", ["zstd", "lz4", "arrow-lz4"])
+def test_iter_cube_chunks_compressed(name):
+    pixels = np.arange(4 * 3 * 8 * 8, dtype="float32").reshape(4, 3, 8, 8)
+    cube_format = get_cube_format(name)
+    with TemporaryDirectory() as dirname:
+        path = Path(dirname) / f"cube_0.{cube_format.extension}"
+        path.write_bytes(cube_format.encode({"pixels": pixels}))
+
+        # Compressed cubes are never decoded as a whole
+        decoded = []
+        decode_chunk = ChunkedFormat._decode_chunk
+
+        def record_chunk(self, data, out):
+            decoded.append(out.shape)
+            decode_chunk(self, data, out)
+
+        with (
+            mock.patch.object(ChunkedFormat, "decode", side_effect=AssertionError),
+            mock.patch.object(ArrowFormat, "read_table", side_effect=AssertionError),
+            mock.patch.object(ChunkedFormat, "_decode_chunk", record_chunk),
+        ):
+            for chunk, expected in zip(iter_cube_chunks(path), pixels):
+                np.testing.assert_array_equal(chunk, expected)
+
+        if isinstance(cube_format, ChunkedFormat):
+            assert decoded == [pixels.shape[1:]] * len(pixels)
+        else:
+            # One record batch per chip, decompressed separately
+            reader = pa.ipc.open_file(pa.memory_map(str(path)))
+            assert reader.num_record_batches == len(pixels)
+
+
+def test_list_cube_keys():
+    keys = [
+        "mode_v1_chipper_v2/naip/cube_1.npz",
+        "mode_v1_chipper_v2/naip/cube_2.cube",
+        "mode_v1_chipper_v2/naip/cube_3.arrow",
+        "mode_v1_chipper_v2/naip/manifests/manifest_0.parquet",
+        "mode_v1_chipper_v2/naip/stats/state_0.npz",
+        "mode_v1_chipper_v2/naip/cube_4.npz",
+    ]
+    client = mock.MagicMock()
+    client.get_paginator.return_value.paginate.return_value = [
+        {"Contents": [{"Key": key} for key in keys[:3]]},
+        {"Contents": [{"Key": key} for key in keys[3:]]},
+    ]
+    assert list_cube_keys(client, "naip") == [keys[0], keys[1], keys[2], keys[5]]
+    assert list_cube_keys(client, "naip", max_cubes=2) == keys[:2]
+
+
+@pytest.mark.parametrize("name", ["npz", "zstd", "arrow"])
+def test_get_stats_keys(name):
+    spec = get_platform_bands("naip")
+    pixels = np.random.default_rng(0).integers(0, 256, (2, 4, 8, 8)).astype("uint8")
+    cube_format = get_cube_format(name)
+    content = cube_format.encode({"pixels": pixels})
+
+    client = mock.MagicMock()
+    client.download_fileobj.side_effect = lambda bucket, key, file: file.write(content)
+    with mock.patch("stacchip.processors.stats.get_s3_client", return_value=client):
+        state = get_stats_keys(f"naip/cube_0.{cube_format.extension}", spec)
+
+    expected = BandStats.empty(4)
+    for chip in pixels:
+        expected.update(chip.reshape(4, -1), spec.nodata)
+    np.testing.assert_array_equal(state.stats.count, expected.count)
+    np.testing.assert_allclose(state.stats.mean, expected.mean)
+
+
+def test_band_histogram_quantiles():
+    rng = np.random.default_rng(42)
+    chunk = np.stack(
+        [
+            rng.uniform(0, 1000, 100000),
+            rng.normal(500, 50, 100000),
+            np.concatenate([np.full(50000, -10.0), np.full(50000, 2000.0)]),
+        ]
+    )
+    histogram = BandHistogram.empty(3, (0, 1000), 1000).update(chunk, nodata=-1)
+
+    quantiles = histogram.quantiles([0.01, 0.5, 0.99])
+    assert quantiles.shape == (3, 3)
+    # Quantiles are exact to the bin width of 1
+    for band in range(2):
+        expected = np.quantile(chunk[band], [0.01, 0.5, 0.99])
+        np.testing.assert_allclose(quantiles[band], expected, atol=1)
+    # Values outside of the range are counted in the overflow bins
+    assert histogram.counts[2, 0] == 50000
+    assert histogram.counts[2, -1] == 50000
+    np.testing.assert_array_equal(quantiles[2], [0, 0, 1000])
+    # Quantiles in the overflow bins are flagged
+    clipped = histogram.clipped([0.01, 0.5, 0.99])
+    np.testing.assert_array_equal(clipped[:2], False)
+    np.testing.assert_array_equal(clipped[2], [True, True, True])
+
+    # Nodata is skipped, and bands without pixels have no quantiles
+    histogram = BandHistogram.empty(2, (0, 10), 10)
+    histogram.update(np.array([[-1, -1, 5], [-1, -1, -1]]), nodata=-1)
+    assert histogram.counts[0].sum() == 1
+    assert np.isnan(histogram.quantiles(0.5)[1]).all()
+
+
+def test_band_histogram_merge():
+    rng = np.random.default_rng(1)
+    chunks = [rng.integers(0, 256, (4, 1000)) for _ in range(3)]
+    expected = BandHistogram.empty(4, (0, 256), 256)
+    for chunk in chunks:
+        expected.update(chunk, nodata=0)
+
+    merged = BandHistogram.empty(4, (0, 256), 256)
+    for chunk in chunks:
+        merged.merge(BandHistogram.empty(4, (0, 256), 256).update(chunk, nodata=0))
+    np.testing.assert_array_equal(merged.counts, expected.counts)
+
+    with pytest.raises(ValueError):
+        merged.merge(BandHistogram.empty(4, (0, 256), 128))
+    with pytest.raises(ValueError):
+        merged.merge(BandHistogram.empty(4, (0, 512), 256))
+
+
+def test_stats_state_roundtrip():
+    spec = get_platform_bands("sentinel-2-l2a")
+    chunk = np.random.default_rng(2).integers(0, 20000, (len(spec.bands), 1000))
+    state = StatsState.empty(spec).update(chunk, spec.nodata)
+
+    restored = StatsState.from_bytes(state.to_bytes())
+    np.testing.assert_array_equal(restored.stats.count, state.stats.count)
+    np.testing.assert_array_equal(restored.stats.mean, state.stats.mean)
+    np.testing.assert_array_equal(restored.stats.m2, state.stats.m2)
+    assert restored.histogram.hist_range == state.histogram.hist_range
+    assert restored.histogram.bins == spec.hist_bins
+    np.testing.assert_array_equal(restored.histogram.counts, state.histogram.counts)
+
+    # Restored states can be merged with new ones
+    restored.merge(StatsState.empty(spec).update(chunk, spec.nodata))
+    np.testing.assert_array_equal(restored.stats.count, 2 * state.stats.count)
+
+
+def test_stats_state_report(capsys):
+    spec = get_platform_bands("sentinel-1-rtc")
+    chunk = np.stack([np.linspace(0, 1, 1000), np.full(1000, 20.0)])
+    StatsState.empty(spec).update(chunk, spec.nodata).report(spec.bands)
+
+    lines = capsys.readouterr().out.splitlines()
+    percentiles = lines[lines.index("-- Percentiles p1, p50, p99 by band") + 1 :]
+    # Only percentiles above the histogram range are flagged
+    assert "outside histogram range" not in percentiles[0]
+    assert percentiles[1].count("(outside histogram range)") == 3
+
+
+def test_platform_histogram_bins():
+    for platform, spec in PLATFORM_BANDS.items():
+        low, high = spec.hist_range
+        assert low < high, platform
+        assert spec.hist_bins > 0, platform
+        if np.issubdtype(np.dtype(spec.dtype), np.integer):
+            info = np.iinfo(spec.dtype)
+            # The range covers the valid values of the data type
+            assert info.min <= low and high <= info.max + 1, platform
+            # Integer values do not straddle bin edges
+            assert (high - low) % spec.hist_bins == 0, platform
+
+    assert get_platform_bands("naip").hist_range == (0, 256)
+    assert get_platform_bands("naip").hist_bins == 256
+    assert get_platform_bands("sentinel-2-l2a").hist_range == (0, 20000)
+    assert get_platform_bands("modis").hist_range == (-100, 16000)
+    # Bright backscatter is within the range of the Sentinel-1 histogram
+    assert get_platform_bands("sentinel-1-rtc").hist_range[1] >= 10
+
+
+def test_sample_stats_early_stopping():
+    spec = get_platform_bands("naip")
+
+    def cube_stats(key, spec):
+        rng = np.random.default_rng(int(key.split("_")[-1].split(".")[0]))
+        # Cubes with similar means, or very different ones for noisy keys
+        scale = 100 if key.startswith("noisy") else 1
+        offset = rng.normal(0, scale, (len(spec.bands), 1))
+        chunk = 128 + offset + rng.normal(0, 10, (len(spec.bands), 100))
+        return StatsState.empty(spec).update(chunk, spec.nodata)
+
+    keys = [f"cube_{i}.npz" for i in range(100)]
+    with mock.patch(
+        "stacchip.processors.stats.get_stats_keys", side_effect=cube_stats
+    ) as get_stats:
+        state = sample_stats(keys, spec, pool_size=2, target_se=0.01, min_cubes=5)
+    # Processing stops after the minimum number of cubes
+    assert (state.stats.count == 5 * 100).all()
+    assert get_stats.call_count <= 5 + 2
+
+    keys = [f"noisy_cube_{i}.npz" for i in range(20)]
+    with mock.patch(
+        "stacchip.processors.stats.get_stats_keys", side_effect=cube_stats
+    ) as get_stats:
+        state = sample_stats(keys, spec, pool_size=2, target_se=0.01, min_cubes=5)
+    assert (state.stats.count == 20 * 100).all()
+    assert get_stats.call_count == 20
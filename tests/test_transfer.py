@@ -0,0 +1,187 @@
+import io
+import shutil
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+
+from stacchip.processors.transfer import Transfer, copy_objects, upload_file
+
+
+class LocalClient:
+    """
+    Stand-in for an s3 client that stores buckets as local folders
+    """
+
+    def __init__(self, root: str, throttle: int = 0):
+        """
+        Init LocalClient
+        """
+        self.root = Path(root)
+        self.throttle = throttle
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _path(self, bucket: str, key: str) -> Path:
+        return self.root / bucket / key
+
+    def _maybe_throttle(self):
+        with self.lock:
+            throttled = self.throttle > 0
+            self.throttle -= throttled
+        if throttled:
+            raise ClientError({"Error": {"Code": "SlowDown"}}, "CopyObject")
+
+    def head_object(self, Bucket, Key, **kwargs):
+        """
+        Size of a local object
+        """
+        self.calls.append(("head_object", Bucket, Key, kwargs))
+        path = self._path(Bucket, Key)
+        if not path.exists():
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ContentLength": path.stat().st_size}
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs=None, Config=None):
+        """
+        Copy between local buckets
+        """
+        self.calls.append(("copy", CopySource["Key"], Key, ExtraArgs))
+        self._maybe_throttle()
+        target = self._path(Bucket, Key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy(self._path(CopySource["Bucket"], CopySource["Key"]), target)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        """
+        Stream a local object
+        """
+        self.calls.append(("get_object", Bucket, Key, kwargs))
+        path = self._path(Bucket, Key)
+        return {"Body": io.BytesIO(path.read_bytes())}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config=None):
+        """
+        Write a stream in chunks into a local bucket
+        """
+        self._maybe_throttle()
+        target = self._path(Bucket, Key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with open(target, "wb") as dst:
+            while chunk := Fileobj.read(7):
+                dst.write(chunk)
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        """
+        Copy a file into a local bucket, wrapping errors like boto3 does
+        """
+        try:
+            self._maybe_throttle()
+        except ClientError as e:
+            # boto3 raises without chaining, only the context is set
+            raise S3UploadFailedError(f"Failed to upload {Filename}: {e}")  # noqa: B904
+        target = self._path(Bucket, Key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy(Filename, target)
+
+
+def test_copy_objects():
+    with TemporaryDirectory() as dirname:
+        for band in ["red", "green", "blue"]:
+            path = Path(dirname) / "source" / "scene" / f"{band}.tif"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(band.encode() * 100)
+
+        client = LocalClient(dirname, throttle=2)
+        transfers = [
+            Transfer(
+                source=f"s3://source/scene/{band}.tif",
+                bucket="target",
+                key=f"platform/scene/{band}.tif",
+                requester_pays=True,
+            )
+            for band in ["red", "green", "blue"]
+        ]
+        report = copy_objects(transfers, client=client, max_workers=2, backoff=0)
+
+        assert report.objects == 3
+        assert report.nbytes == 1200
+        assert report.rate > 0
+        for band in ["red", "green", "blue"]:
+            path = Path(dirname) / "target" / "platform" / "scene" / f"{band}.tif"
+            assert path.read_bytes() == band.encode() * 100
+        # Throttled copies are retried
+        copies = [call for call in client.calls if call[0] == "copy"]
+        assert len(copies) == 5
+        assert all(call[3] == {"RequestPayer": "requester"} for call in copies)
+
+
+def test_copy_objects_fallback():
+    with TemporaryDirectory() as dirname:
+        path = Path(dirname) / "source" / "block" / "image.tif"
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b"image")
+
+        client = LocalClient(dirname)
+        transfer = Transfer(
+            source="s3://source/block/subblock/image.tif",
+            bucket="target",
+            key="naip/image.tif",
+            fallbacks=("s3://source/block/image.tif",),
+        )
+        report = copy_objects([transfer], client=client, backoff=0)
+        assert report.nbytes == 5
+        assert (Path(dirname) / "target" / "naip" / "image.tif").exists()
+
+        # Missing sources raise once all fallbacks failed
+        transfer = Transfer(source="s3://source/missing.tif", bucket="t", key="k")
+        with pytest.raises(ClientError):
+            copy_objects([transfer], client=client, backoff=0)
+
+
+def test_upload_file_retries_until_limit():
+    with TemporaryDirectory() as dirname:
+        path = Path(dirname) / "data.tif"
+        path.write_bytes(b"data")
+
+        client = LocalClient(dirname, throttle=1)
+        assert upload_file(str(path), "target", "data.tif", client, backoff=0) == 4
+        assert (Path(dirname) / "target" / "data.tif").read_bytes() == b"data"
+
+        # Throttling is detected through the error wrapped by boto3
+        client = LocalClient(dirname, throttle=3)
+        with pytest.raises(S3UploadFailedError):
+            upload_file(str(path), "target", "data.tif", client, retries=2, backoff=0)
+
+
+def test_copy_objects_local_copy():
+    with TemporaryDirectory() as dirname:
+        path = Path(dirname) / "source" / "scene" / "qa.tif"
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b"quality" * 10)
+
+        # Throttled streams are restarted from the beginning
+        client = LocalClient(dirname, throttle=1)
+        local_path = Path(dirname) / "scratch" / "qa.tif"
+        local_path.parent.mkdir()
+        transfer = Transfer(
+            source="s3://source/scene/qa.tif",
+            bucket="target",
+            key="platform/scene/qa.tif",
+            requester_pays=True,
+            local_path=str(local_path),
+        )
+        report = copy_objects([transfer], client=client, backoff=0)
+
+        assert report.nbytes == 70
+        assert local_path.read_bytes() == b"quality" * 10
+        target = Path(dirname) / "target" / "platform" / "scene" / "qa.tif"
+        assert target.read_bytes() == b"quality" * 10
+        # The source is downloaded instead of copied on the server
+        gets = [call for call in client.calls if call[0] == "get_object"]
+        assert len(gets) == 2
+        assert gets[0][3] == {"RequestPayer": "requester"}
+        assert not [call for call in client.calls if call[0] == "copy"]
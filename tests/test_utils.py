@@ -0,0 +1,143 @@
+import io
+import json
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import mock
+import pyarrow.parquet as pq
+from pystac import Item
+
+from stacchip.indexer import ChipIndexer, NoStatsChipIndexer
+from stacchip.utils import (
+    ItemStore,
+    catalog_table,
+    get_env_flag,
+    load_catalog,
+    load_indexers_catalog,
+)
+
+ITEM_PATH = "tests/data/naip_m_4207009_ne_19_060_20211024.json"
+
+
+def get_object_mock(Bucket: str, Key: str) -> dict:
+    with open(ITEM_PATH, "rb") as src:
+        return {"Body": io.BytesIO(src.read())}
+
+
+def test_item_store_s3():
+    client = mock.MagicMock()
+    client.get_object.side_effect = get_object_mock
+    with TemporaryDirectory() as dirname:
+        store = ItemStore(bucket="example-bucket", cache_dir=dirname, client=client)
+        item = store.get_item("naip", "item1")
+        assert item.id == "m_4207009_ne_19_060_20211024.tif"
+        client.get_object.assert_called_once_with(
+            Bucket="example-bucket", Key="naip/item1/stac_item.json"
+        )
+        assert (Path(dirname) / "naip/item1/stac_item.json").exists()
+
+        # Cached items are copies
+        item.assets.clear()
+        assert store.get_item("naip", "item1").assets
+        assert client.get_object.call_count == 1
+
+        # Disk cache is used by a new store
+        store = ItemStore(bucket="example-bucket", cache_dir=dirname, client=client)
+        store.get_item("naip", "item1")
+        assert client.get_object.call_count == 1
+
+
+def test_item_store_concurrent_cache_writes():
+    barrier = threading.Barrier(8)
+
+    def get_object_together(Bucket: str, Key: str) -> dict:
+        barrier.wait()
+        return get_object_mock(Bucket, Key)
+
+    client = mock.MagicMock()
+    client.get_object.side_effect = get_object_together
+    with open(ITEM_PATH, "rb") as src:
+        expected = src.read()
+    with TemporaryDirectory() as dirname:
+        store = ItemStore(bucket="example-bucket", cache_dir=dirname, client=client)
+        # Threads of one process write the same cache file at the same time
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(
+                executor.map(lambda _: store.fetch("naip", "item1"), range(8))
+            )
+        assert all(result == expected for result in results)
+        cache_dir = Path(dirname) / "naip/item1"
+        assert [path.name for path in cache_dir.iterdir()] == ["stac_item.json"]
+        assert (cache_dir / "stac_item.json").read_bytes() == expected
+
+
+def test_item_store_local():
+    with TemporaryDirectory() as dirname:
+        mountpath = Path(dirname)
+        for item_id in ["item1", "item2"]:
+            (mountpath / "naip" / item_id).mkdir(parents=True)
+            shutil.copy(ITEM_PATH, mountpath / "naip" / item_id / "stac_item.json")
+
+        store = ItemStore(mountpath=mountpath, cache_size=1)
+        keys = [("naip", "item1"), ("naip", "item2"), ("naip", "item1")]
+        items = store.get_items(keys)
+        assert len(items) == 3
+        assert all(isinstance(item, Item) for item in items)
+        assert len(store._cache) == 1
+
+        indexers = store.load_indexers(keys[:2], indexer_class=NoStatsChipIndexer)
+        assert all(isinstance(indexer, NoStatsChipIndexer) for indexer in indexers)
+        with open(ITEM_PATH) as src:
+            expected = json.load(src)["properties"]["proj:shape"]
+        assert indexers[0].shape == expected
+
+
+def test_catalog_roundtrip():
+    paths = [
+        ITEM_PATH,
+        "tests/data/sentinel-2-l2a-S2A_T20HNJ_20240311T140636_L2A.json",
+        "tests/data/landsat-c2l2-sr-LC09_L2SR_086107_20240311_20240312_02_T2_SR.json",
+    ]
+    items = [Item.from_file(path) for path in paths]
+    with TemporaryDirectory() as dirname:
+        for item in items:
+            target = Path(dirname) / item.id
+            target.mkdir()
+            pq.write_table(
+                catalog_table([item], "test-platform"),
+                target / f"catalog_{item.id}.parquet",
+            )
+
+        catalog = load_catalog(dirname)
+        assert len(catalog) == len(items)
+        indexers = load_indexers_catalog(
+            dirname, platform="test-platform", item_ids=[items[1].id]
+        )
+        assert list(indexers) == [items[1].id]
+
+    for item in items:
+        original = ChipIndexer(item)
+        rebuilt = ChipIndexer(catalog[item.id])
+        assert rebuilt.crs == original.crs
+        assert rebuilt.shape == original.shape
+        assert rebuilt.transform == original.transform
+        assert rebuilt.item.datetime == item.datetime
+        assert {key: asset.href for key, asset in rebuilt.item.assets.items()} == {
+            key: asset.href for key, asset in item.assets.items()
+        }
+        assert rebuilt.get_chip_bbox(1, 2).equals(original.get_chip_bbox(1, 2))
+
+
+def test_get_env_flag():
+    with mock.patch.dict("os.environ", {}, clear=True):
+        assert get_env_flag("STACCHIP_FLAG") is False
+        assert get_env_flag("STACCHIP_FLAG", True) is True
+    for value in ["", "0", "false", "False", "no", "OFF", " 0 "]:
+        with mock.patch.dict("os.environ", {"STACCHIP_FLAG": value}):
+            assert get_env_flag("STACCHIP_FLAG", True) is False
+    for value in ["1", "true", "yes", "on"]:
+        with mock.patch.dict("os.environ", {"STACCHIP_FLAG": value}):
+            assert get_env_flag("STACCHIP_FLAG") is True